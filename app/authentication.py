@@ -1,8 +1,27 @@
 from rest_framework.authentication import BaseAuthentication
 from rest_framework.exceptions import AuthenticationFailed
-import boto3
 from django.conf import settings
-from .models import CustomUser
+from django.db import IntegrityError, transaction
+from .models import CustomUser, Users
+from .utils.cognito_client import get_cognito_client
+from .utils.cognito_jwks import JWKSUnavailableError, TokenVerificationError, verify_access_token
+from .utils.principal_cache import Principal, principal_cache
+
+def remember_cognito_sub(user, sub):
+    """
+    Record the Cognito sub of a user created before subs were stored, the
+    first time one of their tokens is matched some other way.
+    """
+    if not sub or user.cognito_sub:
+        return
+    try:
+        with transaction.atomic():
+            if CustomUser.objects.filter(pk=user.pk, cognito_sub__isnull=True).update(cognito_sub=sub):
+                user.cognito_sub = sub
+    except IntegrityError:
+        # Another account already holds this sub; leave both as they are
+        pass
+
 
 class CognitoJWTAuthentication(BaseAuthentication):
     def authenticate(self, request):
@@ -16,14 +35,63 @@ class CognitoJWTAuthentication(BaseAuthentication):
         else:
             raise AuthenticationFailed('Authorization header must start with Bearer')
 
-        client = boto3.client('cognito-idp', region_name=settings.AWS_COGNITO_REGION)
+        # A token we already validated skips verification and the user lookups
+        principal = principal_cache.get(token)
+        if principal is not None:
+            return (principal.user, principal)
+
+        # 'local' checks the JWT against the cached user pool keys, 'remote' asks Cognito every time
+        if getattr(settings, 'AWS_COGNITO_TOKEN_VERIFICATION', 'local') == 'remote':
+            user, expires_at = self.authenticate_with_cognito(token)
+        else:
+            user, expires_at = self.authenticate_locally(token)
+
+        customer_ref = Users.objects.filter(User_ID=user.email).values_list('customer_ref', flat=True).first()
+        principal = Principal(user, customer_ref)
+        principal_cache.set(token, principal, expires_at=expires_at)
+        return (user, principal)
+
+    def authenticate_locally(self, token):
+        fallback = getattr(settings, 'AWS_COGNITO_GET_USER_FALLBACK', False)
+        try:
+            claims = verify_access_token(token)
+        except TokenVerificationError as e:
+            raise AuthenticationFailed(str(e))
+        except JWKSUnavailableError as e:
+            if fallback:
+                return self.authenticate_with_cognito(token)
+            raise AuthenticationFailed(f'Error during authentication: {str(e)}')
+
+        user = self.get_user_from_claims(claims)
+        if user is None:
+            # Access tokens carry no email claim, so users we cannot match by sub need Cognito
+            if fallback:
+                return self.authenticate_with_cognito(token)
+            raise AuthenticationFailed('User not found')
+        return user, claims.get('exp')
+
+    def get_user_from_claims(self, claims):
+        sub = claims.get('sub')
+        user = CustomUser.objects.filter(cognito_sub=sub).first() if sub else None
+        if user is None:
+            username = claims.get('username') or ''
+            if '@' in username:
+                user, created = CustomUser.objects.get_or_create(email=username)
+                remember_cognito_sub(user, sub)
+        return user
+
+    def authenticate_with_cognito(self, token):
+        client = get_cognito_client()
 
         try:
             # Verify token with AWS Cognito
             response = client.get_user(AccessToken=token)
-            user_email = response['UserAttributes'][0]['Value']  # Assuming email is the first attribute
+            attributes = {attr['Name']: attr['Value'] for attr in response['UserAttributes']}
+            user_email = attributes.get('email') or response['UserAttributes'][0]['Value']
             user, created = CustomUser.objects.get_or_create(email=user_email)
-            return (user, None)
+            # Lets this user's next token be matched locally by sub
+            remember_cognito_sub(user, attributes.get('sub'))
+            return user, None
         except client.exceptions.NotAuthorizedException:
             raise AuthenticationFailed('Invalid token or expired token')
         except client.exceptions.InvalidParameterException as e:
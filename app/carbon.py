@@ -0,0 +1,37 @@
+# BestMatch.error_code values produced by the carbon stage
+ERROR_NONE = 0
+ERROR_QUANTITY = 2
+ERROR_SCALING_FACTOR_MISSING = 4
+ERROR_GIA_MISSING = 5
+
+EXCEPTIONS = {
+    ERROR_SCALING_FACTOR_MISSING: "Scaling factor is missing",
+    ERROR_GIA_MISSING: "Building GIA is missing",
+}
+
+
+def _present(value):
+    # Mirrors the old `if value:` checks: missing, NaN and zero all count as absent
+    return value is not None and value == value and value != 0
+
+
+def compute_carbon(gwp, scaling_factor, quantity, gia, error_code=ERROR_NONE):
+    """
+    kgCO2 for one delivery-note line. Returns (kgco2, scaling_factor,
+    error_code):
+
+    - kgco2: gwp / scaling_factor * quantity / gia, 0 where it cannot be computed
+    - scaling_factor: the input, 0 where the line cannot be computed
+    - error_code: `error_code` (a bad quantity's 2 is kept) unless gwp,
+      scaling factor or quantity is missing (4), or all three are there but
+      the building has no GIA (5)
+
+    A plain function called once per row: the rows arrive as model
+    instances, and copying their fields into arrays cost more than a
+    vectorised pass saved (see bench_carbon).
+    """
+    if not (_present(gwp) and _present(scaling_factor) and _present(quantity)):
+        return 0.0, 0.0, ERROR_SCALING_FACTOR_MISSING
+    if not _present(gia):
+        return 0.0, float(scaling_factor), ERROR_GIA_MISSING
+    return float(gwp) / float(scaling_factor) * (float(quantity) / float(gia)), float(scaling_factor), error_code
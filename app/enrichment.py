@@ -0,0 +1,843 @@
+import hashlib
+import logging
+from datetime import timedelta
+
+import requests
+from django.conf import settings
+from django.db import DatabaseError, connection, transaction
+from django.db.models import BigIntegerField, Case, F, OuterRef, Q, Subquery, Value, When
+from django.db.models.functions import Cast
+from django.utils import timezone
+
+from .carbon import (
+    ERROR_GIA_MISSING, ERROR_NONE, ERROR_QUANTITY, ERROR_SCALING_FACTOR_MISSING, EXCEPTIONS, compute_carbon,
+)
+from .models import BestMatch, Building, Country, EnrichmentJob, InvoiceData, Phase, Region, Users
+from .reports import SUMMARY_SOURCE_FIELDS, CarbonSummaryDelta
+from .utils.best_client import RETRY_STATUSES, get_best_client
+from .utils.best_match_cache import best_match_cache, cache_key
+from .utils.best_token import best_token_manager
+
+logger = logging.getLogger(__name__)
+
+# Columns written back to app_deliverynote_data for every matched row
+ENRICHED_FIELDS = [
+    'product_name', 'material_name', 'product_company_name', 'product_match_score',
+    'global_warming_potential_fossil', 'declared_unit', 'scaling_factor', 'data_source',
+    'processed', 'processed_timestamp', 'customer_ref', 'quantity', 'kgco2', 'exception',
+    'error_code', 'approved',
+    'package_type', 'package_unit_type', 'package_unit_item_count', 'package_unit_item_length',
+    'package_unit_item_width', 'package_unit_item_height', 'package_unit_item_dimension_uom',
+    'package_unit_item_area', 'package_unit_item_area_uom', 'package_unit_item_volume',
+    'package_unit_item_volume_uom', 'mass_per_declared_unit', 'density', 'linear_density',
+    'enrichment_hash',
+]
+FAILED_FIELDS = ['error_code', 'approved']
+# A revised row whose inputs hash the same is only marked done again
+UNCHANGED_FIELDS = ['approved', 'processed_timestamp']
+# InvoiceData columns invoice_for() fills; a re-enriched row's existing copy is rewritten with these
+INVOICE_FIELDS = [
+    'customer_ref', 'delivery_note_ref_no', 'supplier_name', 'data_source', 'product_description', 'material_name',
+    'entry_time', 'quantity', 'unit_of_measure', 'country_name', 'region_name', 'city_name', 'building_name',
+    'phase_name', 'kgco2', 'product_manufacturing_company',
+]
+
+
+# Row columns that feed the BEST request and the carbon calculation
+HASHED_FIELDS = [
+    'product_description', 'revised_product_description', 'delivery_country',
+    'unit_of_measure', 'revised_unit_of_measure', 'quantity', 'revised_quantity',
+    'phase_id', 'revised_phase_id', 'user_id', 'revised_user_id', 'building_id',
+]
+
+
+class BestUnavailableError(Exception):
+    """
+    BEST could not answer some of a run's requests: it was unreachable,
+    overloaded (429/5xx once retries ran out), the circuit breaker was open,
+    or it rejected a fresh token. The rows involved stay pending.
+    """
+
+    def __init__(self, message, results=None):
+        super().__init__(message)
+        self.results = results or {}
+
+
+def pending_filters(now=None):
+    """
+    The pending set as separate conditions, each backed by one of
+    BestMatch's partial indexes so the id scan stays index-only.
+
+    In incremental mode (BEST_MATCH_INCREMENTAL) a processed row only comes
+    back when it was revised after it was last enriched; otherwise every
+    approved row is rematched, as before. Rows another worker holds an
+    unexpired claim on are left out.
+    """
+    unclaimed = Q(enrichment_claimed_until__isnull=True) | Q(enrichment_claimed_until__lt=now or timezone.now())
+    new = Q(processed=False, approved__isnull=False, error_code=0) & unclaimed
+    if not getattr(settings, 'BEST_MATCH_INCREMENTAL', True):
+        return [new, Q(processed=True, approved=True, error_code=0) & unclaimed]
+    return [new, Q(processed=True, approved=True, error_code=0) & unclaimed & (
+        Q(processed_timestamp__isnull=True) | Q(revised_date__gt=F('processed_timestamp'))
+    )]
+
+
+def pending_records(now=None):
+    condition = Q()
+    for pending in pending_filters(now):
+        condition |= pending
+    return BestMatch.objects.filter(condition).order_by('id')
+
+
+def pending_ids(after_id, limit):
+    """The next `limit` pending ids above the `after_id` watermark, one index-only scan per condition."""
+    ids = set()
+    for pending in pending_filters():
+        ids.update(
+            BestMatch.objects.filter(pending, id__gt=after_id).order_by('id').values_list('id', flat=True)[:limit]
+        )
+    return sorted(ids)[:limit]
+
+
+def input_hash(record):
+    """Fingerprint of a row's enrichment inputs, stored as enrichment_hash."""
+    values = '\x1f'.join('' if getattr(record, field) is None else str(getattr(record, field)) for field in HASHED_FIELDS)
+    return hashlib.sha256(values.encode('utf-8')).hexdigest()
+
+
+def save_isolated(objects, save_many, save_one, label):
+    """
+    save_many(objects) in a savepoint; if that fails, save_one() each object
+    in its own savepoint so a bad row only loses itself. Returns the objects
+    written. Must run inside a transaction.
+    """
+    if not objects:
+        return []
+    try:
+        with transaction.atomic():
+            save_many(objects)
+        return objects
+    except (DatabaseError, TypeError, ValueError) as e:
+        logger.error(f"Writing {len(objects)} {label} in one statement failed ({e}), writing them one by one")
+    saved = []
+    for obj in objects:
+        try:
+            with transaction.atomic():
+                save_one(obj)
+        except (DatabaseError, TypeError, ValueError) as e:
+            logger.error(f"Could not write {label} for record ID {getattr(obj, 'best_match_id', None) or obj.pk}: {e}")
+        else:
+            saved.append(obj)
+    return saved
+
+
+def update_rows(records, fields):
+    """
+    Write `fields` of the BestMatch `records` back. On PostgreSQL this is one
+    UPDATE ... FROM (VALUES ...) statement, which unlike bulk_update() costs
+    no per-row CASE WHEN to build; elsewhere it is bulk_update().
+    """
+    if not records:
+        return
+    if connection.vendor != 'postgresql':
+        BestMatch.objects.bulk_update(records, fields)
+        return
+    qn = connection.ops.quote_name
+    model_fields = [BestMatch._meta.get_field(field) for field in fields]
+    casts = ", ".join(["%s::bigint"] + [f"%s::{field.db_type(connection)}" for field in model_fields])
+    columns = [qn(field.column) for field in model_fields]
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"UPDATE {qn(BestMatch._meta.db_table)} AS t SET "
+            + ", ".join(f"{column} = v.{column}" for column in columns)
+            + " FROM (VALUES " + ", ".join([f"({casts})"] * len(records))
+            + ") AS v(id, " + ", ".join(columns) + ") WHERE t.id = v.id",
+            [value for record in records for value in (
+                record.id, *(field.get_db_prep_save(getattr(record, field.attname), connection) for field in model_fields)
+            )],
+        )
+
+
+def _number(value):
+    """A numeric figure from a BEST result as a float; anything else raises, failing only that row."""
+    return None if value is None else float(value)
+
+
+def _integer(value):
+    """A text id (such as a customer_ref) as an int for InvoiceData's integer columns; None when it isn't one."""
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def product_description(record):
+    return record.revised_product_description if record.revised_product_description else record.product_description
+
+
+def match_key(record):
+    """The input item sent to BEST for a row; results come back keyed by the same string."""
+    desc = product_description(record)
+    if desc is None or record.delivery_country is None:
+        return None
+    return desc + " " + record.delivery_country
+
+
+def building_gia_map(building_ids):
+    """{building id: gia} in one query; gia is not on the Building model, hence .extra()."""
+    building_ids = {building_id for building_id in building_ids if building_id is not None}
+    if not building_ids:
+        return {}
+    return dict(Building.objects.extra(select={'gia': 'gia'}).filter(id__in=building_ids).values_list('id', 'gia'))
+
+
+def row_user_id(record):
+    return record.revised_user_id if record.revised_user_id else record.user_id
+
+
+def row_phase_id(record):
+    return record.revised_phase_id if record.revised_phase_id else record.phase_id
+
+
+class ReferenceData:
+    """
+    Lookup tables the enrichment of one batch needs, loaded up front with one
+    id__in query each so applying results to rows runs no queries:
+    Users.customer_ref by User_ID, Building gia and location by id and
+    Phase by id.
+    """
+
+    def __init__(self, customer_refs, gias, phases, locations=None):
+        self.customer_refs = customer_refs
+        self.gias = gias
+        self.phases = phases
+        self.locations = locations or {}
+
+    @classmethod
+    def load(cls, records):
+        user_ids = {row_user_id(record) for record in records} - {None}
+        building_ids = {record.building_id for record in records} - {None}
+        phase_ids = set()
+        for record in records:
+            try:
+                phase_ids.add(int(row_phase_id(record)))
+            except (TypeError, ValueError):
+                pass
+
+        customer_refs = {}
+        if user_ids:
+            # Several Users rows can share a User_ID; like .first(), the lowest ID wins
+            for user_id, customer_ref in Users.objects.filter(User_ID__in=user_ids).order_by('-ID').values_list('User_ID', 'customer_ref'):
+                customer_refs[user_id] = customer_ref
+        gias = {}
+        locations = {}
+        if building_ids:
+            # Building.region_id/country_id are text columns rather than foreign keys, hence the casts
+            buildings = Building.objects.extra(select={'gia': 'gia'}).filter(id__in=building_ids).annotate(
+                city_name=F('city__name'),
+                region_name=Subquery(Region.objects.filter(id=Cast(OuterRef('region_id'), BigIntegerField())).values('name')[:1]),
+                country_name=Subquery(Country.objects.filter(id=Cast(OuterRef('country_id'), BigIntegerField())).values('name')[:1]),
+            )
+            for building_id, gia, country, region, city, name in buildings.values_list(
+                'id', 'gia', 'country_name', 'region_name', 'city_name', 'name',
+            ):
+                gias[building_id] = gia
+                locations[building_id] = (country, region, city, name)
+        phases = Phase.objects.in_bulk(phase_ids) if phase_ids else {}
+        return cls(customer_refs, gias, phases, locations)
+
+    def customer_ref(self, record):
+        return self.customer_refs.get(row_user_id(record), "")
+
+    def gia(self, record):
+        return self.gias.get(record.building_id)
+
+    def location(self, record):
+        """(country, region, city, building name) of the row's building; all None when it has none."""
+        return self.locations.get(record.building_id, (None, None, None, None))
+
+    def phase(self, record):
+        phase_id = row_phase_id(record)
+        if not phase_id:
+            return None
+        try:
+            phase = self.phases.get(int(phase_id))
+        except (TypeError, ValueError):
+            phase = None
+        if phase is None:
+            logger.error(f"Phase with ID {phase_id} does not exist for record ID {record.id}")
+        return phase
+
+
+def invoice_for(record, reference):
+    """The InvoiceData copy of a matched row, or None when it has no carbon figure."""
+    if record.scaling_factor == 0 or record.error_code == ERROR_GIA_MISSING:
+        return None
+
+    phase_instance = reference.phase(record)
+    # Set explicitly: the model's defaults (customer 12346, London, ...) would file the line under someone else
+    country_name, region_name, city_name, building_name = reference.location(record)
+
+    return InvoiceData(
+        customer_ref=_integer(record.customer_ref),
+        delivery_note_ref_no=record.delivery_note_ref_no,
+        supplier_name=record.supplier_name,
+        data_source=record.data_source,
+        product_description=product_description(record),
+        material_name=record.material_name,
+        entry_time=record.entry_time.date() if record.entry_time else timezone.now().date(),
+        quantity=record.quantity,
+        unit_of_measure=record.unit_of_measure,
+        country_name=country_name,
+        region_name=region_name,
+        city_name=city_name,
+        building_name=building_name,
+        phase_name=phase_instance,
+        kgco2=record.kgco2,
+        product_manufacturing_company=record.product_company_name,
+        best_match=record,
+    )
+
+
+def store_invoices(record_ids, invoices):
+    """
+    Write `invoices`, the InvoiceData copies of the just-matched rows
+    `record_ids`, and move carbon_summary with them. A row copied by an
+    earlier run (a revised row being re-enriched) has that copy rewritten
+    in place instead of gaining a second one; if it no longer yields a
+    copy, the old one keeps its place with a NULL kgco2, as in
+    write_carbon(). Must run inside a transaction. Returns the copies
+    written.
+    """
+    summary = CarbonSummaryDelta()
+    fresh = {invoice.best_match_id: invoice for invoice in invoices}
+    copied = set()
+    rewritten = []
+    duplicates = []
+    # Locked so a concurrent write_carbon() can't move the same copies between this read and the update
+    for current in InvoiceData.objects.select_for_update().filter(best_match_id__in=list(record_ids)).order_by('id'):
+        if current.best_match_id in copied:
+            # A second copy left by earlier runs; the delete signal takes it out of the summary
+            duplicates.append(current.id)
+            continue
+        copied.add(current.best_match_id)
+        summary.add_invoices([current], -1)
+        invoice = fresh.pop(current.best_match_id, None)
+        if invoice is None:
+            current.kgco2 = None
+            invoice = current
+        else:
+            invoice.id = current.id
+        rewritten.append(invoice)
+    if duplicates:
+        InvoiceData.objects.filter(id__in=duplicates).delete()
+
+    saved = save_isolated(
+        rewritten,
+        lambda rows: InvoiceData.objects.bulk_update(rows, INVOICE_FIELDS),
+        lambda row: InvoiceData.objects.bulk_update([row], INVOICE_FIELDS),
+        "InvoiceData rows",
+    )
+    # A copy that could not be rewritten keeps its old figures, so its share of the summary goes back
+    failed = {invoice.id for invoice in rewritten} - {invoice.id for invoice in saved}
+    if failed:
+        summary.add_invoices(InvoiceData.objects.filter(id__in=failed))
+    created = save_isolated(
+        list(fresh.values()),
+        InvoiceData.objects.bulk_create,
+        # Not save(): the summary is moved below, and the InvoiceData signals would move it again
+        lambda invoice: InvoiceData.objects.bulk_create([invoice]),
+        "InvoiceData rows",
+    )
+    summary.add_invoices(saved + created)
+    summary.apply()
+    return saved + created
+
+
+class BestMatchEnricher:
+    """
+    Matches pending BestMatch rows against the BEST API and persists the results.
+
+    Descriptions are first looked up in best_match_cache; only the misses are
+    sent to BEST, and their results are cached for the next run. Those are
+    grouped into batches of BEST_MATCH_BATCH_SIZE input items and each
+    batch costs one POST to /get_best_match/; up to BEST_API_MAX_IN_FLIGHT
+    batches are sent concurrently through the shared BestClient. Results are
+    fanned back to rows by input item, matched rows are written with one
+    update_rows() and their InvoiceData copies by store_invoices(). Rows whose
+    item BEST answered without a match get error_code 1. When a request
+    fails instead, BestUnavailableError stops the run and the chunk's rows
+    stay pending for the retry job run_job() queues.
+    """
+    API_PATH = "/get_best_match/"
+
+    def __init__(self, token_manager=None, client=None, batch_size=None):
+        self.token_manager = token_manager or best_token_manager
+        self.client = client or get_best_client()
+        self.batch_size = batch_size or getattr(settings, 'BEST_MATCH_BATCH_SIZE', 50)
+
+    def run(self):
+        """
+        Claim and process pending rows until none are left.
+
+        Each chunk (one batch per in-flight request slot) is claimed in a
+        short transaction that stamps a lease on its rows, so concurrent
+        workers split the backlog instead of matching the same rows twice.
+        No transaction or row lock is held while BEST is being called.
+        """
+        chunk_size = self.batch_size * self.client.max_in_flight
+        processed = 0
+        # Ids only move forward, so rows that raised are not retried until the next run
+        watermark = 0
+        while True:
+            ids = pending_ids(watermark, chunk_size)
+            if not ids:
+                break
+            watermark = ids[-1]
+            # Any token refresh happens here, outside the claim transaction, so
+            # its row is committed before other workers go looking for it
+            self.token_manager.get_token()
+            records = self.claim(ids)
+            if records:
+                processed += len(self.process_batch(records))
+        return processed
+
+    def claim(self, ids):
+        """Lease the rows among `ids` that are still pending and unclaimed for BEST_MATCH_CLAIM_TIMEOUT; returns them."""
+        now = timezone.now()
+        claimed_until = now + timedelta(seconds=getattr(settings, 'BEST_MATCH_CLAIM_TIMEOUT', 900))
+        with transaction.atomic():
+            # Re-checked under the lock: another worker may have just claimed or finished them
+            records = list(pending_records(now).filter(id__in=ids).select_for_update(skip_locked=True))
+            if records:
+                BestMatch.objects.filter(id__in=[record.id for record in records]).update(enrichment_claimed_until=claimed_until)
+        for record in records:
+            record.enrichment_claimed_until = claimed_until
+        return records
+
+    def release(self, claims):
+        """
+        Drop the leases in `claims` ({id: (input hash, claimed_until)}) that
+        are still ours. Returns the ids among them whose inputs are unchanged
+        since they were claimed, i.e. the rows results may be written to.
+        """
+        held = set()
+        for row in BestMatch.objects.select_for_update().filter(id__in=list(claims)).only('id', 'enrichment_claimed_until', *HASHED_FIELDS):
+            if row.enrichment_claimed_until == claims[row.id][1]:
+                held.add(row.id)
+                # Revised while BEST was being asked: stays pending for the next run instead of taking stale results
+                if input_hash(row) != claims[row.id][0]:
+                    claims[row.id] = (None, claims[row.id][1])
+        if held:
+            BestMatch.objects.filter(id__in=held).update(enrichment_claimed_until=None)
+        return {record_id for record_id in held if claims[record_id][0] is not None}
+
+    def process_batch(self, records):
+        """
+        Match claimed `records` against BEST and write the results in one
+        short transaction. Rows revised or re-claimed in the meantime are
+        left alone, and a row that cannot be written only fails itself.
+        Returns the rows written as matched.
+        """
+        claims = {record.id: (input_hash(record), record.enrichment_claimed_until) for record in records}
+        try:
+            unchanged, matched, failed, invoices = self.enrich(records)
+        except Exception:
+            with transaction.atomic():
+                self.release(claims)
+            raise
+
+        with transaction.atomic():
+            current = self.release(claims)
+            stale = len(claims) - len(current)
+            if stale:
+                logger.info(f"{stale} records were revised or reclaimed while being matched; left for the next run")
+            unchanged = save_isolated(
+                [record for record in unchanged if record.id in current],
+                lambda rows: update_rows(rows, UNCHANGED_FIELDS),
+                lambda row: update_rows([row], UNCHANGED_FIELDS),
+                "unchanged records",
+            )
+            matched = save_isolated(
+                [record for record in matched if record.id in current],
+                lambda rows: update_rows(rows, ENRICHED_FIELDS),
+                lambda row: update_rows([row], ENRICHED_FIELDS),
+                "matched records",
+            )
+            failed = save_isolated(
+                [record for record in failed if record.id in current],
+                lambda rows: update_rows(rows, FAILED_FIELDS),
+                lambda row: update_rows([row], FAILED_FIELDS),
+                "failed records",
+            )
+            written = {record.id for record in matched}
+            invoices = store_invoices(written, [invoice for invoice in invoices if invoice.best_match_id in written])
+
+        logger.info(
+            f"Batch of {len(records)} records: {len(matched)} matched, {len(failed)} failed, "
+            f"{len(unchanged)} unchanged, {len(invoices)} copied to InvoiceData"
+        )
+        return matched
+
+    def enrich(self, records):
+        """
+        Everything process_batch() computes before writing: returns the
+        (unchanged, matched, failed, InvoiceData copies) for `records`. Calls
+        BEST but writes no rows; a row whose result can't be applied is left
+        out of all four and stays pending.
+        """
+        unchanged = [record for record in records if record.processed and record.enrichment_hash == input_hash(record)]
+        if unchanged:
+            now = timezone.now()
+            for record in unchanged:
+                record.approved = False
+                record.processed_timestamp = now
+            logger.info(f"Skipped {len(unchanged)} revised records whose inputs did not change")
+            records = [record for record in records if record not in unchanged]
+
+        # One input item per normalised description + country, whichever row spelled it first
+        items = {}
+        for record in records:
+            item = match_key(record)
+            if item is not None:
+                items.setdefault(cache_key(product_description(record), record.delivery_country), (item, record))
+
+        results = self.lookup(items) if items else {}
+
+        reference = ReferenceData.load(records)
+        matched = []
+        error_codes = []
+        failed = []
+        for record in records:
+            item = results.get(cache_key(product_description(record), record.delivery_country)) if match_key(record) else None
+            if item is None:
+                record.error_code = 1
+                record.approved = False
+                failed.append(record)
+                logger.error(f"No BEST result for record ID {record.id}")
+                continue
+            try:
+                error_codes.append(self.apply_result(record, item, reference))
+            except Exception as e:
+                # Left unprocessed so the next run picks it up again
+                logger.error(f"Errored ocuured for ID {record.id} The error is {e}.")
+                continue
+            matched.append(record)
+
+        invoices = []
+        if matched:
+            self.apply_carbon(matched, error_codes, reference)
+            invoices = [invoice for invoice in (invoice_for(record, reference) for record in matched) if invoice is not None]
+        return unchanged, matched, failed, invoices
+
+    def lookup(self, items):
+        """
+        Resolve {cache key: (input item, row)} to {cache key: result}, asking
+        BEST only for the keys best_match_cache has no live entry for.
+        """
+        results = best_match_cache.get_many(list(items))
+        missing = {key: value for key, value in items.items() if key not in results}
+        if missing:
+            try:
+                fetched = self.fetch_results([item for item, record in missing.values()])
+            except BestUnavailableError as e:
+                # Whatever did come back is kept for the retry
+                self.cache_results(missing, e.results, results)
+                raise
+            self.cache_results(missing, fetched, results)
+        logger.info(f"BEST match cache: {len(items) - len(missing)} of {len(items)} items served from cache")
+        return results
+
+    def cache_results(self, missing, fetched, results):
+        """Add the `fetched` results for the `missing` keys to `results` and best_match_cache."""
+        entries = {}
+        for key, (item, record) in missing.items():
+            if item in fetched:
+                results[key] = fetched[item]
+                entries[key] = (product_description(record), record.delivery_country, fetched[item])
+        best_match_cache.set_many(entries)
+
+    def fetch_results(self, input_items):
+        """
+        POST the input items in batches of batch_size, concurrently. Returns
+        the merged results keyed by input item; items BEST found no match for
+        are absent. Raises BestUnavailableError, carrying the results that
+        did come back, when any batch failed for a reason a later retry can
+        fix. A batch BEST rejected outright (any other 4xx) counts as
+        answered without matches.
+        """
+        batches = [input_items[i:i + self.batch_size] for i in range(0, len(input_items), self.batch_size)]
+        payloads = [{
+            "input_items": batch,
+            "include_product_data": True,
+            "include_material_data": True
+        } for batch in batches]
+        token = self.token_manager.get_token()
+        responses = self.client.post_many(self.API_PATH, payloads, headers={"Authorization": "Bearer " + token})
+
+        rejected = [i for i, response in enumerate(responses) if getattr(response, 'status_code', None) == 401]
+        if rejected:
+            # The token was revoked or expired early: swap it once and resend those batches
+            self.token_manager.invalidate(token)
+            token = self.token_manager.get_token()
+            retried = self.client.post_many(self.API_PATH, [payloads[i] for i in rejected], headers={"Authorization": "Bearer " + token})
+            for i, response in zip(rejected, retried):
+                responses[i] = response
+
+        results = {}
+        unavailable = []
+        for batch, response in zip(batches, responses):
+            if isinstance(response, requests.RequestException):
+                logger.error(f"RequestException for batch of {len(batch)} items: {response}")
+                unavailable.append(str(response))
+                continue
+            logger.info(f"API response status code: {response.status_code}")
+            if response.status_code != 200:
+                logger.error(f"API request failed for batch of {len(batch)} items: {response.status_code} - {response.text}")
+                if response.status_code == 401 or response.status_code in RETRY_STATUSES:
+                    unavailable.append(f"HTTP {response.status_code}")
+                continue
+            results.update(response.json().get('results', {}))
+        if unavailable:
+            raise BestUnavailableError(f"{len(unavailable)} of {len(batches)} BEST requests failed: {unavailable[0]}", results)
+        return results
+
+    def apply_result(self, record, item, reference):
+        """Copy one BEST result onto its row; returns the row's error code before the carbon stage."""
+        best_product = item.get('best_product', {})
+        best_material = item.get('best_material', {})
+        classification = item.get('classification', {})
+        quality_info = item.get('quantity_info', {})
+        material_facts = best_product.get('product_data', {}).get('material_facts', {})
+        scaling_factors = material_facts.get('scaling_factors', {})
+
+        customerref = reference.customer_ref(record)
+
+        record.product_name = best_product.get("product_name")
+        record.material_name = classification.get("material_type")
+        record.product_company_name = best_product.get("product_company_name")
+        record.product_match_score = best_product.get("product_match_score")
+        record.global_warming_potential_fossil = _number(material_facts.get("global_warming_potential_fossil", {}).get("A1A2A3"))
+        record.declared_unit = material_facts.get("declared_unit")
+        # Keyed on the revised unit only when the description was revised
+        if record.revised_product_description:
+            record.scaling_factor = _number(scaling_factors.get(record.revised_unit_of_measure, {}).get("value"))
+        else:
+            record.scaling_factor = _number(scaling_factors.get(record.unit_of_measure, {}).get("value"))
+        record.data_source = material_facts.get("data_source")
+        record.processed = True
+        record.processed_timestamp = timezone.now()
+        record.customer_ref = customerref
+        record.package_unit_item_height = best_material.get('material_data', {}).get('thickness', {}) or None
+        record.density = best_product.get('product_data', {}).get('density') or None
+        record.package_unit_item_dimension_uom = best_material.get('material_data', {}).get('length_units') or None
+        record.mass_per_declared_unit = material_facts.get('mass_per_declared_unit', {}) or None
+        record.linear_density = best_product.get('product_data', {}).get('linear_density', {}) or None
+        if quality_info:
+            record.package_type = quality_info.get('package', {}).get('type') or None
+            record.package_unit_type = quality_info.get('item_details', {}).get('base_unit') or None
+            record.package_unit_item_count = quality_info.get('package', {}).get('item_count') or None
+            record.package_unit_item_length = quality_info.get('item_details', {}).get('length') or None
+            record.package_unit_item_width = quality_info.get('item_details', {}).get('width') or None
+            record.package_unit_item_dimension_uom = quality_info.get('item_details', {}).get('length_units') or None
+            record.package_unit_item_area = quality_info.get('item_details', {}).get('area') or None
+            record.package_unit_item_area_uom = quality_info.get('item_details', {}).get('area_units') or None
+            record.package_unit_item_volume = None
+            record.package_unit_item_volume_uom = None
+            if record.package_unit_item_height is None:
+                record.package_unit_item_height = quality_info.get('item_details', {}).get('thickness') or None
+
+        error_code = ERROR_NONE
+        try:
+            record.quantity = float(record.revised_quantity) if record.revised_quantity is not None else (float(record.quantity) if record.quantity else None)
+        except ValueError:
+            error_code = ERROR_QUANTITY
+        record.approved = False
+        # Taken after quantity is rewritten, so it matches the row as stored
+        record.enrichment_hash = input_hash(record)
+        return error_code
+
+    def apply_carbon(self, records, error_codes, reference):
+        """Compute kgco2 for the matched rows of a batch."""
+        for record, error_code in zip(records, error_codes):
+            record.kgco2, record.scaling_factor, record.error_code = compute_carbon(
+                record.global_warming_potential_fossil, record.scaling_factor, record.quantity, reference.gia(record), error_code,
+            )
+            record.exception = EXCEPTIONS.get(record.error_code, "")
+
+
+def enqueue_job(run_after=None):
+    """
+    Queue an enrichment run, reusing the job already waiting if there is one:
+    a queued job picks up every row pending when it starts, so a second one
+    would have nothing left to do. A new job is not claimed before `run_after`.
+    """
+    with transaction.atomic():
+        job = EnrichmentJob.objects.select_for_update().filter(status=EnrichmentJob.QUEUED).order_by('id').first()
+        if job is None:
+            job = EnrichmentJob.objects.create(run_after=run_after)
+    return job
+
+
+def claim_job(worker):
+    """Lock and mark running the oldest claimable job, or return None."""
+    stale_before = timezone.now() - timedelta(seconds=getattr(settings, 'ENRICHMENT_JOB_TIMEOUT', 3600))
+    with transaction.atomic():
+        job = (
+            EnrichmentJob.objects
+            .select_for_update(skip_locked=True)
+            # Jobs left running by a worker that died are handed out again
+            .filter(
+                Q(status=EnrichmentJob.QUEUED, run_after__isnull=True)
+                | Q(status=EnrichmentJob.QUEUED, run_after__lte=timezone.now())
+                | Q(status=EnrichmentJob.RUNNING, started_at__lt=stale_before)
+            )
+            .order_by('id')
+            .first()
+        )
+        if job is None:
+            return None
+        job.status = EnrichmentJob.RUNNING
+        job.started_at = timezone.now()
+        job.worker = worker
+        job.save(update_fields=['status', 'started_at', 'worker'])
+    return job
+
+
+def run_job(job, enricher):
+    """
+    Run `job` to completion. A job stopped by a BEST outage fails and a
+    retry job is queued for ENRICHMENT_RETRY_DELAY seconds later, unless
+    one is already waiting.
+    """
+    try:
+        job.processed = enricher.run()
+        job.status = EnrichmentJob.DONE
+    except BestUnavailableError as e:
+        logger.error(f"Enrichment job {job.id} stopped, BEST is unavailable: {e}")
+        job.status = EnrichmentJob.FAILED
+        job.error = str(e)
+        enqueue_job(run_after=timezone.now() + timedelta(seconds=getattr(settings, 'ENRICHMENT_RETRY_DELAY', 60)))
+    except Exception as e:
+        logger.exception(f"Enrichment job {job.id} failed")
+        job.status = EnrichmentJob.FAILED
+        job.error = str(e)
+    job.finished_at = timezone.now()
+    job.save(update_fields=['status', 'processed', 'error', 'finished_at'])
+    return job
+
+
+CARBON_FIELDS = ['global_warming_potential_fossil', 'kgco2', 'scaling_factor', 'error_code', 'exception']
+
+
+def write_carbon(records):
+    """
+    Persist recalculated carbon columns for `records` and bring their
+    InvoiceData copies along, moving the carbon_summary totals with them:
+    a copy gets the row's new kgco2, or NULL when the row lost its figure
+    (ERROR_SCALING_FACTOR_MISSING or ERROR_GIA_MISSING), and a row that
+    gained a figure but was never copied gets its InvoiceData row now. On
+    PostgreSQL each table's update is a single UPDATE ... FROM (VALUES ...)
+    statement. Must run inside a transaction. Returns the InvoiceData rows
+    created.
+    """
+    new_kgco2 = {
+        record.id: None if record.error_code in (ERROR_SCALING_FACTOR_MISSING, ERROR_GIA_MISSING) else int(record.kgco2)
+        for record in records
+    }
+    summary = CarbonSummaryDelta()
+    copied = set()
+    # Locked so a concurrent write can't move the same rows between this read and the UPDATE
+    for row in InvoiceData.objects.select_for_update().filter(best_match_id__in=list(new_kgco2)).values('best_match_id', *SUMMARY_SOURCE_FIELDS):
+        copied.add(row['best_match_id'])
+        summary.add(row, -1)
+        summary.add({**row, 'kgco2': new_kgco2[row['best_match_id']]})
+    invoice_rows = [(record_id, kgco2) for record_id, kgco2 in new_kgco2.items() if record_id in copied]
+
+    if connection.vendor != 'postgresql':
+        BestMatch.objects.bulk_update(records, CARBON_FIELDS)
+        if invoice_rows:
+            InvoiceData.objects.filter(best_match_id__in=[row[0] for row in invoice_rows]).update(kgco2=Case(
+                *[When(best_match_id=record_id, then=Value(kgco2)) for record_id, kgco2 in invoice_rows],
+                output_field=BigIntegerField(),
+            ))
+    else:
+        update_rows(records, CARBON_FIELDS)
+        if invoice_rows:
+            qn = connection.ops.quote_name
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    f"UPDATE {qn(InvoiceData._meta.db_table)} AS t SET kgco2 = v.kgco2"
+                    + " FROM (VALUES " + ", ".join(["(%s::bigint, %s::bigint)"] * len(invoice_rows))
+                    + ") AS v(best_match_id, kgco2) WHERE t.best_match_id = v.best_match_id",
+                    [value for row in invoice_rows for value in row],
+                )
+
+    # Read back after the update above, so the copies carry the new figures
+    uncopied = [record_id for record_id, kgco2 in new_kgco2.items() if kgco2 is not None and record_id not in copied]
+    created = []
+    if uncopied:
+        rows = list(BestMatch.objects.filter(id__in=uncopied).order_by('id'))
+        reference = ReferenceData.load(rows)
+        created = save_isolated(
+            [invoice for invoice in (invoice_for(row, reference) for row in rows) if invoice is not None],
+            InvoiceData.objects.bulk_create,
+            # Not save(): the summary is moved below, and the InvoiceData signals would move it again
+            lambda invoice: InvoiceData.objects.bulk_create([invoice]),
+            "InvoiceData rows",
+        )
+        summary.add_invoices(created)
+        if created:
+            logger.info(f"Created InvoiceData rows for {len(created)} records that gained a carbon figure")
+    summary.apply()
+    return created
+
+
+def recalculate_carbon(queryset, chunk_size=5000, gwp=None, dry_run=False):
+    """
+    Recompute kgco2 for already-matched rows (e.g. after a building's GIA or
+    a material's emission factor changed) without calling BEST. Walks
+    `queryset` by id in chunks; each chunk costs one SELECT, one GIA lookup
+    and one write_carbon() for the rows whose figures changed. `gwp`
+    replaces the rows' global_warming_potential_fossil first. With
+    dry_run nothing is written. Returns (rows_checked, rows_changed).
+    """
+    queryset = queryset.filter(processed=True).exclude(error_code=1).only(
+        'id', 'building_id', 'global_warming_potential_fossil', 'scaling_factor', 'quantity', 'kgco2', 'error_code', 'exception',
+    ).order_by('id')
+    checked = 0
+    changed = 0
+    last_id = 0
+    while True:
+        records = list(queryset.filter(id__gt=last_id)[:chunk_size])
+        if not records:
+            break
+        last_id = records[-1].id
+
+        gias = building_gia_map(record.building_id for record in records)
+        before = [
+            (record.global_warming_potential_fossil, record.kgco2, record.scaling_factor, record.error_code)
+            for record in records
+        ]
+        if gwp is not None:
+            for record in records:
+                record.global_warming_potential_fossil = gwp
+        updated = []
+        for record, old in zip(records, before):
+            kgco2, scaling_factor, error_code = compute_carbon(
+                record.global_warming_potential_fossil, record.scaling_factor, record.quantity, gias.get(record.building_id),
+                # A bad quantity is only known at enrichment time, so it is carried over
+                ERROR_QUANTITY if record.error_code == ERROR_QUANTITY else ERROR_NONE,
+            )
+            if old != (record.global_warming_potential_fossil, kgco2, scaling_factor, error_code):
+                record.kgco2 = kgco2
+                record.scaling_factor = scaling_factor
+                record.error_code = error_code
+                record.exception = EXCEPTIONS.get(error_code, "")
+                updated.append(record)
+        if updated and not dry_run:
+            with transaction.atomic():
+                write_carbon(updated)
+        checked += len(records)
+        changed += len(updated)
+    return checked, changed
@@ -0,0 +1,333 @@
+"""
+Reviewer edits to delivery-note lines (app_deliverynote_data rows), shared
+by UpdateDeliveryNoteAPI (one line) and BulkUpdateDeliveryNoteAPI (many
+lines in one transaction). An edit is the request dict the single-line
+endpoint has always taken: delivery_note_ref_no, item_no and the revised_*
+values.
+"""
+from django.db import connection, transaction
+from django.db.models import Max
+from django.utils import timezone
+
+from .carbon import ERROR_QUANTITY
+from .enrichment import save_isolated
+from .models import AppDeliveryNoteChangeLog, BestMatch, ProductMapping
+from .utils.best_match_cache import best_match_cache
+from .utils.units_cache import units_cache
+
+ERROR_UNIT = 1  # revised_unit_of_measure is not a Unit_of_Measure name
+
+DUPLICATE_MAPPING = "Duplicate mapped_product_description already exists for this customer_ref and product_description"
+
+# app_deliverynote_change_log ids come from this sequence on PostgreSQL; every writer must use next_change_log_ids()
+CHANGE_LOG_SEQUENCE = 'app_deliverynote_change_log_id_seq'
+_sequence_ready = False
+
+
+def _changed(revised, old_revised, original, normalise=lambda value: value):
+    """Whether `revised` differs from the line's current value: its earlier revision if any, else the original."""
+    if not revised:
+        return False
+    current = old_revised if old_revised else original
+    return normalise(revised) != normalise(current)
+
+
+def apply_line_edit(delivery_note, edit, timestamp):
+    """
+    Copy the revised values in `edit` that differ from `delivery_note` onto
+    it. Returns (updated fields, error_code, revised_quantity as a number);
+    no fields means nothing changed and nothing should be saved.
+    """
+    revised_phase_id = edit.get("revised_phase_id")
+    revised_product_description = edit.get("revised_product_description")
+    revised_unit_of_measure = edit.get("revised_unit_of_measure")
+    revised_quantity = edit.get("revised_quantity")
+
+    error_code = 0
+    if revised_unit_of_measure and not units_cache.is_valid(revised_unit_of_measure):
+        error_code = ERROR_UNIT
+    try:
+        revised_quantity = float(revised_quantity) if revised_quantity else None
+    except (TypeError, ValueError):
+        # Left unrevised rather than written to a numeric column
+        revised_quantity = None
+        error_code = ERROR_QUANTITY
+
+    updated_fields = []
+    if _changed(revised_phase_id, delivery_note.revised_phase_id, delivery_note.phase_id):
+        delivery_note.revised_phase_id = revised_phase_id
+        updated_fields.append("revised_phase_id")
+    if _changed(revised_product_description, delivery_note.revised_product_description, delivery_note.product_description):
+        delivery_note.revised_product_description = revised_product_description
+        updated_fields.append("revised_product_description")
+    if _changed(revised_unit_of_measure, delivery_note.revised_unit_of_measure, delivery_note.unit_of_measure,
+                lambda unit: unit.lower() if unit else ""):
+        delivery_note.revised_unit_of_measure = revised_unit_of_measure
+        updated_fields.append("revised_unit_of_measure")
+    if _changed(revised_quantity, delivery_note.revised_quantity, delivery_note.quantity):
+        delivery_note.revised_quantity = revised_quantity
+        updated_fields.append("revised_quantity")
+
+    if updated_fields:
+        delivery_note.revised_user_id = edit.get("revised_user_id")
+        delivery_note.revised_date = timestamp
+        delivery_note.approved = True
+        delivery_note.error_code = error_code
+        updated_fields += ["revised_user_id", "revised_date", "approved", "error_code"]
+    return updated_fields, error_code, revised_quantity
+
+
+def _change_log_sequence_ready():
+    global _sequence_ready
+    _sequence_ready = True
+
+
+def _ensure_change_log_sequence(cursor):
+    """
+    Create CHANGE_LOG_SEQUENCE if needed and move it past the table's
+    highest id, once per process. Only ever moves it forward, so ids
+    already handed out elsewhere are never reissued.
+    """
+    if _sequence_ready:
+        return
+    qn = connection.ops.quote_name
+    with transaction.atomic():
+        cursor.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", [CHANGE_LOG_SEQUENCE])
+        cursor.execute(f"CREATE SEQUENCE IF NOT EXISTS {qn(CHANGE_LOG_SEQUENCE)}")
+        cursor.execute(
+            f"SELECT setval(%s, max_id) FROM (SELECT max(id) AS max_id FROM {qn(AppDeliveryNoteChangeLog._meta.db_table)}) AS t, "
+            # Strictly past: once the sequence is in use, resetting it to its own last_value would rewind
+            # it past ids other connections have drawn since the read
+            f"{qn(CHANGE_LOG_SEQUENCE)} AS s WHERE max_id > s.last_value OR NOT s.is_called",
+            [CHANGE_LOG_SEQUENCE],
+        )
+        # Only trust the sequence once it is committed; a rolled-back request retries next time
+        transaction.on_commit(_change_log_sequence_ready)
+
+
+def next_change_log_ids(count):
+    """
+    `count` unused ids for new AppDeliveryNoteChangeLog rows (the table has
+    no id default), drawn from CHANGE_LOG_SEQUENCE in one round trip, so
+    concurrent edits never pick the same id.
+    """
+    if count <= 0:
+        return []
+    if connection.vendor != 'postgresql':
+        last_id = AppDeliveryNoteChangeLog.objects.aggregate(last_id=Max('id'))['last_id'] or 0
+        return list(range(last_id + 1, last_id + 1 + count))
+    with connection.cursor() as cursor:
+        _ensure_change_log_sequence(cursor)
+        cursor.execute("SELECT nextval(%s) FROM generate_series(1, %s)", [CHANGE_LOG_SEQUENCE, count])
+        return [row[0] for row in cursor.fetchall()]
+
+
+def change_log_entry(delivery_note, original, edit, revised_quantity):
+    """The change log row for an edit, `original` holding the line's values before it."""
+    return AppDeliveryNoteChangeLog(
+        delivery_note_ref_no=delivery_note.delivery_note_ref_no,
+        item_id=delivery_note.item_no,
+        product_description=original['product_description'],
+        unit_of_measure=original['unit_of_measure'],
+        quantity=original['quantity'],
+        phase_id=original['phase_id'],
+        revised_product_description=edit.get("revised_product_description"),
+        revised_unit_of_measure=edit.get("revised_unit_of_measure"),
+        revised_quantity=revised_quantity,
+        revised_phase_id=edit.get("revised_phase_id"),
+        revised_user_id=edit.get("revised_user_id"),
+        revised_date=delivery_note.revised_date,
+        customer_ref_no=delivery_note.customer_ref,
+    )
+
+
+def _line_key(delivery_note_ref_no, item_no):
+    """
+    (delivery_note_ref_no, item_no) as the columns store them, a string and
+    an integer, so "01", 1 and 1.0 all name item 1. None when item_no is not
+    a whole number, as no line can match it.
+    """
+    try:
+        item = int(item_no) if not isinstance(item_no, float) or item_no.is_integer() else None
+    except (TypeError, ValueError):
+        item = None
+    if item is None:
+        return None
+    return (str(delivery_note_ref_no), item)
+
+
+def locked_lines(keys):
+    """
+    The lines that may match the _line_key() `keys`, locked for update, in
+    one query on (delivery_note_ref_no, item_no). Candidates only: a ref
+    paired with another key's item comes back too.
+    """
+    return BestMatch.objects.select_for_update().filter(
+        delivery_note_ref_no__in={ref for ref, _ in keys},
+        item_no__in={item for _, item in keys},
+    ).order_by('id')
+
+
+def _edit_problem(delivery_note, edit):
+    """
+    Why `edit` would fail to write for `delivery_note`, checked before
+    anything is written so it only fails its own line; None when it can be
+    written.
+    """
+    revised_phase_id = edit.get("revised_phase_id")
+    if revised_phase_id not in (None, "") and not str(revised_phase_id).strip().lstrip('-').isdigit():
+        # The change log keeps it in an integer column
+        return "revised_phase_id must be an integer"
+    revised_product_description = edit.get("revised_product_description")
+    if revised_product_description and revised_product_description.strip():
+        # A revised description is recorded as a ProductMapping, none of whose columns may be NULL
+        if not delivery_note.customer_ref:
+            return "The line has no customer_ref until it is matched, so its description can't be remapped yet"
+        if not delivery_note.product_description:
+            return "The line has no product_description to remap"
+        if not edit.get("revised_user_id"):
+            return "revised_user_id is required with revised_product_description"
+    return None
+
+
+def _result(edit, status, **fields):
+    return {
+        "delivery_note_ref_no": edit.get("delivery_note_ref_no"),
+        "item_no": edit.get("item_no"),
+        "status": status,
+        **fields,
+    }
+
+
+def bulk_edit_lines(edits):
+    """
+    Apply many line edits in one transaction: the lines are read (and
+    locked) in one query, units are checked against units_cache, and the
+    changed lines, product mappings and change log rows are each written
+    with one bulk statement. Returns one result per edit, in order, with
+    the HTTP status the single-line endpoint would have answered.
+
+    A bad line doesn't hold up the rest: an edit the writes would reject
+    (see _edit_problem()) is answered 400 before anything is written, and
+    if the bulk writes still fail, each line is retried in its own
+    savepoint (save_isolated()) and only the lines that fail are answered
+    500.
+    """
+    timestamp = timezone.now()
+    results = [None] * len(edits)
+    wanted = {}
+    for position, edit in enumerate(edits):
+        if not isinstance(edit, dict) or not edit.get("delivery_note_ref_no") or not edit.get("item_no"):
+            results[position] = _result(edit if isinstance(edit, dict) else {}, 400,
+                                        error="delivery_note_ref_no and item_no are required")
+            continue
+        key = _line_key(edit["delivery_note_ref_no"], edit["item_no"])
+        if key is None:
+            results[position] = _result(edit, 404, error="Record not found")
+        else:
+            wanted.setdefault(key, []).append(position)
+
+    with transaction.atomic():
+        lines = {}
+        ambiguous = set()
+        if wanted:
+            for delivery_note in locked_lines(wanted):
+                key = _line_key(delivery_note.delivery_note_ref_no, delivery_note.item_no)
+                if key in wanted:
+                    if key in lines:
+                        ambiguous.add(key)
+                    lines[key] = delivery_note
+
+        edited = {}
+        changed = {}
+        mappings = []
+        logged = {}
+        for key, positions in wanted.items():
+            for position in positions:
+                edit = edits[position]
+                if key not in lines:
+                    results[position] = _result(edit, 404, error="Record not found")
+                    continue
+                if key in ambiguous:
+                    results[position] = _result(edit, 409, error="More than one record matches this delivery_note_ref_no and item_no")
+                    continue
+                delivery_note = lines[key]
+                problem = _edit_problem(delivery_note, edit)
+                if problem:
+                    results[position] = _result(edit, 400, error=problem)
+                    continue
+                original = {field: getattr(delivery_note, field)
+                            for field in ('product_description', 'unit_of_measure', 'quantity', 'phase_id')}
+                updated_fields, error_code, revised_quantity = apply_line_edit(delivery_note, edit, timestamp)
+                if not updated_fields:
+                    results[position] = _result(edit, 200, message="No changes", error_code=error_code)
+                    continue
+                edited.setdefault(key, set()).update(updated_fields)
+                changed.setdefault(key, []).append(position)
+                revised_product_description = edit.get("revised_product_description")
+                if not (revised_product_description and revised_product_description.strip()):
+                    results[position] = _result(edit, 200, message="revised_product_description is null", error_code=400)
+                    continue
+                mapping = (delivery_note.customer_ref, original['product_description'], revised_product_description)
+                mappings.append((position, key, mapping, edit.get("revised_user_id")))
+                logged[position] = (position, change_log_entry(delivery_note, original, edit, revised_quantity), error_code)
+
+        if not edited:
+            return results
+
+        existing = set(
+            ProductMapping.objects.filter(
+                customer_ref__in={customer_ref for _, _, (customer_ref, _, _), _ in mappings},
+                product_description__in={description for _, _, (_, description, _), _ in mappings},
+                mapped_product_description__in={mapped for _, _, (_, _, mapped), _ in mappings},
+            ).values_list('customer_ref', 'product_description', 'mapped_product_description')
+        )
+        new_mappings = {key: [] for key in edited}
+        entries = {key: [] for key in edited}
+        for position, key, mapping, user_id in mappings:
+            if mapping in existing:
+                # As with the single-line endpoint, the line keeps its revision but gets no mapping or log
+                results[position] = _result(edits[position], 409, error=DUPLICATE_MAPPING)
+                continue
+            existing.add(mapping)
+            customer_ref, product_description, mapped_product_description = mapping
+            new_mappings[key].append(ProductMapping(
+                customer_ref=customer_ref,
+                product_description=product_description,
+                mapped_product_description=mapped_product_description,
+                user_id=user_id,
+            ))
+            entries[key].append(logged[position])
+
+        keys_by_id = {lines[key].pk: key for key in edited}
+
+        def save_edits(delivery_notes):
+            keys = [keys_by_id[delivery_note.pk] for delivery_note in delivery_notes]
+            BestMatch.objects.bulk_update(delivery_notes, sorted(set().union(*(edited[key] for key in keys))))
+            created = [mapping for key in keys for mapping in new_mappings[key]]
+            for mapping in created:
+                # Numbered by a bulk attempt that was rolled back
+                mapping.pk = None
+            ProductMapping.objects.bulk_create(created)
+            logs = [entry for key in keys for _, entry, _ in entries[key]]
+            for entry, entry_id in zip(logs, next_change_log_ids(len(logs))):
+                entry.id = entry_id
+            AppDeliveryNoteChangeLog.objects.bulk_create(logs)
+
+        saved = {keys_by_id[delivery_note.pk] for delivery_note in save_isolated(
+            [lines[key] for key in edited], save_edits, lambda delivery_note: save_edits([delivery_note]), "line edits",
+        )}
+        for key in edited:
+            if key not in saved:
+                for position in changed[key]:
+                    results[position] = _result(edits[position], 500, error="The edit could not be saved")
+                continue
+            for position, _, error_code in entries[key]:
+                results[position] = _result(edits[position], 200, message="Record updated successfully", error_code=error_code)
+
+        # bulk_create sends no post_save, so drop the remapped descriptions' cached matches here
+        best_match_cache.invalidate_descriptions(*{
+            description for key in saved for mapping in new_mappings[key]
+            for description in (mapping.product_description, mapping.mapped_product_description)
+        })
+    return results
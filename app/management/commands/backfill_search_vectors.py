@@ -0,0 +1,27 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from app.search import backfill_search_vectors, full_text_available, install_search_trigger
+
+
+class Command(BaseCommand):
+    help = (
+        "Install the triggers that keep invoice_data.search_vector current and fill the column for existing rows. "
+        "Run once after deploying full-text search, and again if the search document changes."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=10000, help="Rows updated per statement")
+
+    def handle(self, *args, **options):
+        if not full_text_available():
+            raise CommandError("Full-text search needs PostgreSQL")
+        install_search_trigger()
+        started = time.monotonic()
+        updated = backfill_search_vectors(batch_size=options["batch_size"])
+        elapsed = time.monotonic() - started
+        rate = updated / elapsed if elapsed else 0
+        self.stdout.write(self.style.SUCCESS(
+            f"Indexed {updated} invoice lines in {elapsed:.2f}s ({rate:,.0f} rows/s)"
+        ))
@@ -0,0 +1,95 @@
+import random
+import time
+
+from django.core.management.base import BaseCommand
+
+from app.carbon import compute_carbon
+from app.models import BestMatch
+
+try:
+    import numpy as np
+except ImportError:  # only needed for the comparison run
+    np = None
+
+
+def synthetic_rows(count, seed):
+    """Unsaved BestMatch rows with the spread of missing and zero inputs production has."""
+    rng = random.Random(seed)
+    gias = {building_id: rng.choice([None, 0, rng.uniform(100, 20000)]) for building_id in range(50)}
+    rows = [
+        BestMatch(
+            id=i,
+            global_warming_potential_fossil=rng.uniform(1, 500) if rng.random() > 0.05 else rng.choice([None, 0]),
+            scaling_factor=rng.choice([None, 0, 1.0, 2.4, 1000.0]),
+            quantity=rng.uniform(0, 100),
+            building_id=rng.randrange(50),
+            error_code=0,
+        )
+        for i in range(count)
+    ]
+    return rows, gias
+
+
+def per_row(records, gias):
+    for record in records:
+        record.kgco2, record.scaling_factor, record.error_code = compute_carbon(
+            record.global_warming_potential_fossil, record.scaling_factor, record.quantity,
+            gias.get(record.building_id), record.error_code,
+        )
+
+
+def vectorised(records, gias):
+    """The same arithmetic as compute_carbon over NumPy columns, copied in from and back onto the rows."""
+    gwp = np.asarray([record.global_warming_potential_fossil for record in records], dtype=float)
+    scaling_factor = np.asarray([record.scaling_factor for record in records], dtype=float)
+    quantity = np.asarray([record.quantity for record in records], dtype=float)
+    gia = np.asarray([gias.get(record.building_id) for record in records], dtype=float)
+    error_code = np.asarray([record.error_code for record in records], dtype=np.int64)
+
+    def present(values):
+        return ~np.isnan(values) & (values != 0)
+
+    computable = present(gwp) & present(scaling_factor) & present(quantity)
+    ok = computable & present(gia)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        kgco2 = np.where(ok, gwp / scaling_factor * (quantity / gia), 0.0)
+    error_code[~computable] = 4
+    error_code[computable & ~present(gia)] = 5
+    for record, row_kgco2, row_scaling_factor, row_error_code in zip(
+        records, kgco2.tolist(), np.where(computable, scaling_factor, 0.0).tolist(), error_code.tolist()
+    ):
+        record.kgco2 = row_kgco2
+        record.scaling_factor = row_scaling_factor
+        record.error_code = row_error_code
+
+
+class Command(BaseCommand):
+    help = ("Time compute_carbon over synthetic delivery-note rows in enrichment- and recalc_carbon-sized chunks, "
+            "against a NumPy pass over the same rows when numpy is installed. Touches no database")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rows", type=int, default=1_000_000)
+        parser.add_argument("--chunk-size", type=int, action="append",
+                            help="Rows per batch (repeatable); defaults to 400 (enrichment) and 5000 (recalc_carbon)")
+        parser.add_argument("--seed", type=int, default=1)
+
+    def handle(self, *args, **options):
+        chunk_sizes = options["chunk_size"] or [400, 5000]
+        kernels = [("per row", per_row)]
+        if np is not None:
+            kernels.append(("numpy", vectorised))
+        else:
+            self.stdout.write("numpy is not installed; timing the per-row path only")
+
+        for chunk_size in chunk_sizes:
+            for label, kernel in kernels:
+                # Fresh rows each time: the kernels write their results back onto them
+                rows, gias = synthetic_rows(options["rows"], options["seed"])
+                started = time.perf_counter()
+                for i in range(0, len(rows), chunk_size):
+                    kernel(rows[i:i + chunk_size], gias)
+                elapsed = time.perf_counter() - started
+                self.stdout.write(
+                    f"{label:<8} chunks of {chunk_size:<6} {elapsed:6.2f}s  {options['rows'] / elapsed:12,.0f} rows/s"
+                )
+        self.stdout.write(self.style.SUCCESS("Done"))
@@ -0,0 +1,112 @@
+import itertools
+import statistics
+import time
+import uuid
+from unittest import mock
+
+from django.core.management.base import BaseCommand
+from django.test import RequestFactory
+
+from app.middleware import SyncCognitoMiddleware
+from app.models import CustomUser
+from app.utils import cognito_sync
+
+
+class SlowCognitoClient:
+    """Answers admin_get_user after a fixed delay, like a Cognito round trip."""
+
+    class exceptions:
+        class UserNotFoundException(Exception):
+            pass
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.calls = 0
+
+    def admin_get_user(self, **kwargs):
+        self.calls += 1
+        time.sleep(self.latency)
+        return {'UserAttributes': [{'Name': 'email_verified', 'Value': 'true'}]}
+
+
+class UnsavedUsers:
+    """
+    Stands in for CustomUser.objects while the benchmark runs: the queued
+    syncs look its unsaved users up by their fake pk, and their writes are
+    dropped.
+    """
+
+    def __init__(self):
+        self.users = {}
+
+    def add(self, user):
+        self.users[user.pk] = user
+        return user
+
+    def filter(self, pk):
+        return UnsavedUserQuery(self.users.get(pk))
+
+
+class UnsavedUserQuery:
+    def __init__(self, user):
+        self.user = user
+
+    def first(self):
+        return self.user
+
+    def update(self, **fields):
+        return int(self.user is not None)
+
+
+def summarise(samples):
+    cuts = statistics.quantiles(samples, n=100)
+    return f"p50 {cuts[49] * 1000:.2f}ms  p95 {cuts[94] * 1000:.2f}ms  max {max(samples) * 1000:.2f}ms"
+
+
+class Command(BaseCommand):
+    help = ("Time SyncCognitoMiddleware for users whose Cognito sync is stale, against syncing inline, "
+            "with a simulated Cognito latency. Touches no database: the users are never saved and their "
+            "syncs' reads and writes are stubbed")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--requests", type=int, default=200)
+        parser.add_argument("--cognito-latency", type=float, default=0.1, help="Seconds per admin_get_user call")
+
+    def handle(self, *args, **options):
+        client = SlowCognitoClient(options["cognito_latency"])
+        middleware = SyncCognitoMiddleware(lambda request: None)
+        factory = RequestFactory()
+        users = UnsavedUsers()
+        fake_pks = itertools.count(-1, -1)
+
+        def stale_user():
+            # A distinct pk each, or schedule_sync() would dedup every request on pk None
+            return users.add(CustomUser(pk=next(fake_pks), email=f"bench-{uuid.uuid4().hex}@example.com",
+                                        cognito_sub=uuid.uuid4().hex))
+
+        with mock.patch.object(cognito_sync, "get_cognito_client", return_value=client), \
+                mock.patch.object(cognito_sync.CustomUser, "objects", users):
+            inline = []
+            for _ in range(options["requests"]):
+                user = stale_user()
+                started = time.perf_counter()
+                cognito_sync.sync_user(user)
+                inline.append(time.perf_counter() - started)
+
+            queued = []
+            for _ in range(options["requests"]):
+                request = factory.get("/")
+                request.user = stale_user()
+                started = time.perf_counter()
+                middleware.process_request(request)
+                queued.append(time.perf_counter() - started)
+            # Let the background syncs drain before the patch is undone
+            cognito_sync._executor.submit(lambda: None).result()
+
+        self.stdout.write(f"inline sync_user:      {summarise(inline)}")
+        self.stdout.write(f"SyncCognitoMiddleware: {summarise(queued)}")
+        self.stdout.write(f"Background syncs run:  {client.calls - options['requests']} of {options['requests']}")
+        self.stdout.write(self.style.SUCCESS(
+            f"Median request-path cost: {statistics.median(inline) * 1000:.2f}ms inline, "
+            f"{statistics.median(queued) * 1000:.2f}ms queued"
+        ))
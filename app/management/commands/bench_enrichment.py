@@ -0,0 +1,64 @@
+import time
+import uuid
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from app.enrichment import BestMatchEnricher
+from app.models import BestMatch
+from app.utils.best_client import BestClient
+from app.utils.best_stub import BestStubServer, StubTokenManager
+
+
+class Command(BaseCommand):
+    help = ("Time BestMatchEnricher against a local BEST stub with a fixed per-request latency: one item per "
+            "request (the old per-row loop) against batched and concurrent requests. Runs in a transaction that "
+            "is rolled back, on rows it creates itself")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rows", type=int, default=1000)
+        parser.add_argument("--latency", type=float, default=0.05, help="Seconds the stub takes per request")
+        parser.add_argument("--batch-size", type=int, default=50)
+        parser.add_argument("--in-flight", type=int, default=8)
+
+    def handle(self, *args, **options):
+        setups = [
+            ("1 item per request, sequential", 1, 1),
+            (f"{options['batch_size']} items per request, sequential", options["batch_size"], 1),
+            (f"{options['batch_size']} items per request, {options['in_flight']} in flight", options["batch_size"], options["in_flight"]),
+        ]
+        with BestStubServer(latency=options["latency"]) as stub:
+            for label, batch_size, in_flight in setups:
+                requests_before = stub.requests
+                elapsed, matched = self.run_once(stub, options["rows"], batch_size, in_flight)
+                self.stdout.write(
+                    f"{label:<40} {elapsed:7.2f}s  {options['rows'] / elapsed:8.1f} rows/s  "
+                    f"{stub.requests - requests_before:5d} requests  {matched} matched"
+                )
+        self.stdout.write(self.style.SUCCESS("Done; every row written was rolled back"))
+
+    def run_once(self, stub, rows, batch_size, in_flight):
+        enricher = BestMatchEnricher(
+            token_manager=StubTokenManager(),
+            client=BestClient(stub.url, max_in_flight=in_flight, max_retries=0),
+            batch_size=batch_size,
+        )
+        run = uuid.uuid4().hex
+        with transaction.atomic():
+            # Unique descriptions, so every row is a cache miss and goes to the stub
+            created = BestMatch.objects.bulk_create([
+                BestMatch(product_description=f"bench {run} {i}", delivery_country="UK", unit_of_measure="m3",
+                          quantity=10, processed=False, approved=True, error_code=0)
+                for i in range(rows)
+            ])
+            ids = [record.id for record in created]
+            chunk_size = batch_size * in_flight
+            matched = 0
+            started = time.perf_counter()
+            # Drives claim + process_batch over its own rows only, as run() would over the pending set
+            for i in range(0, len(ids), chunk_size):
+                records = enricher.claim(ids[i:i + chunk_size])
+                matched += len(enricher.process_batch(records))
+            elapsed = time.perf_counter() - started
+            transaction.set_rollback(True)
+        return elapsed, matched
@@ -0,0 +1,89 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import Q
+
+from app.models import InvoiceData, Phase
+from app.search import full_text_available, install_search_trigger, search
+from app.views import InvoiceDataListMixin
+
+PRODUCTS = [
+    'Ready-mix concrete C32/40', 'Steel rebar B500B 12mm', 'Timber CLS 38x89', 'Plasterboard 12.5mm',
+    'Mineral wool insulation 100mm', 'Facing brick red multi', 'Cement CEM I 25kg', 'Aggregate 20mm',
+]
+SUPPLIERS = ['Hanson', 'Travis Perkins', 'Jewson', 'Tarmac', 'Wolseley', 'J.Smith & Sons']
+CITIES = ['Westminster', 'Camden', 'Leeds', 'Bristol', 'Manchester', 'Glasgow']
+
+
+class Command(BaseCommand):
+    help = ("Time invoice search on PostgreSQL: full-text (search_vector) against the icontains fallback, on "
+            "synthetic invoice_data rows, plus the cost of renaming a phase. Runs in a transaction that is rolled back")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rows", type=int, default=5_000_000)
+        parser.add_argument("--term", action="append", help="Search term (repeatable)")
+        parser.add_argument("--batch-size", type=int, default=500_000, help="Rows inserted per statement")
+
+    def handle(self, *args, **options):
+        if not full_text_available():
+            raise CommandError("bench_search needs PostgreSQL")
+        terms = options["term"] or ["concrete", "c32/40", "smith", "glasgow", "no such product"]
+        install_search_trigger()
+
+        with transaction.atomic():
+            phases = Phase.objects.bulk_create([Phase(name=f"Bench phase {i}") for i in range(20)])
+            started = time.perf_counter()
+            self.insert_rows(options["rows"], options["batch_size"], [phase.id for phase in phases])
+            with connection.cursor() as cursor:
+                cursor.execute(f"ANALYZE {connection.ops.quote_name(InvoiceData._meta.db_table)}")
+            self.stdout.write(f"Inserted {options['rows']:,} rows (trigger included) in {time.perf_counter() - started:.1f}s")
+
+            for term in terms:
+                fts = self.timed(lambda: search(InvoiceData.objects.all(), [term]).count())
+                page = self.timed(lambda: list(
+                    search(InvoiceData.objects.all(), [term]).order_by('-search_rank', '-id').values_list('id', flat=True)[:100]
+                ))
+                ilike = self.timed(lambda: InvoiceData.objects.filter(self.icontains(term)).count())
+                self.stdout.write(
+                    f"{term!r:<20} full-text count {fts[0]:>9,} in {fts[1] * 1000:8.1f}ms, first page {page[1] * 1000:8.1f}ms | "
+                    f"icontains count {ilike[0]:>9,} in {ilike[1] * 1000:8.1f}ms"
+                )
+
+            phase = phases[0]
+            rows = InvoiceData.objects.filter(phase_name=phase).count()
+            phase.name = "Bench phase renamed"
+            _, elapsed = self.timed(lambda: phase.save(update_fields=['name']))
+            found = search(InvoiceData.objects.all(), ["renamed"]).count()
+            self.stdout.write(f"Renaming a phase rewrote {rows:,} search vectors in {elapsed:.2f}s; {found:,} rows now match its new name")
+            transaction.set_rollback(True)
+        self.stdout.write(self.style.SUCCESS("Done; every row written was rolled back"))
+
+    def timed(self, query):
+        started = time.perf_counter()
+        result = query()
+        return result, time.perf_counter() - started
+
+    def icontains(self, term):
+        condition = Q()
+        for field in InvoiceDataListMixin.search_fields:
+            condition |= Q(**{f"{field}__icontains": term})
+        return condition
+
+    def insert_rows(self, count, batch_size, phase_ids):
+        table = connection.ops.quote_name(InvoiceData._meta.db_table)
+        with connection.cursor() as cursor:
+            for start in range(0, count, batch_size):
+                cursor.execute(
+                    f"""
+                    INSERT INTO {table} (customer_ref, delivery_note_ref_no, supplier_name, data_source, product_description,
+                        material_name, entry_time, quantity, unit_of_measure, country_name, region_name, city_name,
+                        building_name, phase_name_id, kgco2)
+                    SELECT i %% 50, i, (%s::text[])[1 + i %% %s], 'EPD', (%s::text[])[1 + i %% %s] || ' lot ' || i,
+                        'Material ' || (i %% 40), DATE '2020-01-01' + (i %% 1800), i %% 100, 'm3', 'UK', 'Region ' || (i %% 12),
+                        (%s::text[])[1 + i %% %s], 'Building ' || (i %% 300), (%s::bigint[])[1 + i %% %s], i %% 5000
+                    FROM generate_series(%s, %s) AS i
+                    """,
+                    [SUPPLIERS, len(SUPPLIERS), PRODUCTS, len(PRODUCTS), CITIES, len(CITIES), phase_ids, len(phase_ids),
+                     start, min(start + batch_size, count) - 1],
+                )
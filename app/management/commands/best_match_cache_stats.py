@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from app.utils.best_match_cache import best_match_cache
+
+
+class Command(BaseCommand):
+    help = "Show how many BEST matches are cached and how many input items the cache has kept off the API"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--purge-expired", action="store_true", help="Delete expired and old-version entries first")
+
+    def handle(self, *args, **options):
+        if options["purge_expired"]:
+            purged = best_match_cache.purge_expired()
+            self.stdout.write(f"Purged {purged} expired entries")
+        stats = best_match_cache.table_stats()
+        self.stdout.write(self.style.SUCCESS(
+            f"{stats['live_entries']} live of {stats['entries']} cached matches, "
+            f"{stats['api_items_saved']} input items served without calling BEST"
+        ))
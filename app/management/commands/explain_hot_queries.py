@@ -0,0 +1,114 @@
+import re
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.utils import timezone
+
+from app.enrichment import pending_filters
+from app.line_edits import locked_lines
+from app.models import BestMatch
+from app.views import (
+    DeliveryNoteListByCustomerRefAPI, DeliveryNoteListByDeliveryNoteRefNoAPI, DeliveryNoteListByUserAPI,
+    Get_App_Deleivery_Note_API, getCount,
+)
+
+
+def hot_queries():
+    """
+    (name, queryset, index) for each app_deliverynote_data access path the
+    views and enrichment rely on, built by the code that runs them, with the
+    BestMatch Meta index each one is expected to use.
+    """
+    now = timezone.now()
+    today = now.date()
+    deliverynotes = BestMatch.objects
+    queries = [
+        # aggregate() runs at once, so the same filter and counters are grouped on the (single) customer instead
+        ("getCount counters",
+         deliverynotes.filter(customer_ref="0").values("customer_ref").annotate(**getCount.aggregates(getCount.windows(today))),
+         "deliverynote_counts_idx"),
+        ("list by customer_ref + entry_time",
+         DeliveryNoteListByCustomerRefAPI.notes("0", today - timedelta(days=30), today),
+         "deliverynote_counts_idx"),
+        ("revise: delivery_note_ref_no + item_no",
+         locked_lines({("0", 1)}),
+         "deliverynote_ref_item_idx"),
+        ("list by delivery_note_ref_no",
+         DeliveryNoteListByDeliveryNoteRefNoAPI.lines("0", None),
+         "deliverynote_ref_item_idx"),
+        ("list by user_id + entry_time",
+         DeliveryNoteListByUserAPI.matches("someone@example.com", now - timedelta(days=30), now),
+         "deliverynote_user_time_idx"),
+        ("documents: building_id + entry_time",
+         Get_App_Deleivery_Note_API.notes([1, 2], f"{today - timedelta(days=30):%Y-%m-%d}", f"{today:%Y-%m-%d}"),
+         "deliverynote_building_idx"),
+    ]
+    queries += [
+        (f"enrichment pending set {n}", deliverynotes.filter(pending, id__gt=0).order_by("id").values_list("id", flat=True)[:1000], index)
+        for n, (pending, index) in enumerate(zip(pending_filters(), ["deliverynote_pending_new_idx", "deliverynote_pending_rev_idx"]), 1)
+    ]
+    return queries
+
+
+def plan_indexes(plan):
+    """Names of the indexes an EXPLAIN plan reads."""
+    return set(re.findall(r"Index(?: Only)? Scan(?: Backward)? using (\S+) on", plan) + re.findall(r"Bitmap Index Scan on (\S+)", plan))
+
+
+def index_family(cursor, index):
+    """`index` and, once the table is partitioned, the per-partition indexes attached to it."""
+    cursor.execute(
+        "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid WHERE i.inhparent = to_regclass(%s)",
+        [index],
+    )
+    return {index} | {row[0] for row in cursor.fetchall()}
+
+
+def check_plan(cursor, queryset, index):
+    """EXPLAIN `queryset`; returns (plan, problem or None). A sequential scan of the table or a partition fails, as does missing `index`."""
+    sql, params = queryset.query.sql_with_params()
+    cursor.execute("EXPLAIN " + sql, params)
+    plan = "\n".join(row[0] for row in cursor.fetchall())
+    # Partitions are named <table>_..., so this also catches a scan of any one of them
+    if f"Seq Scan on {BestMatch._meta.db_table}" in plan:
+        return plan, "sequential scan"
+    if not plan_indexes(plan) & index_family(cursor, index):
+        return plan, f"does not use {index}"
+    return plan, None
+
+
+class Command(BaseCommand):
+    help = (
+        "EXPLAIN each hot app_deliverynote_data query and fail if any of them would scan the table sequentially "
+        "or not use the index meant for it. "
+        "Sequential scans are disabled while planning unless --real-costs is given, so small dev databases still "
+        "show whether an index is usable."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--real-costs", action="store_true", help="Plan with the database's normal settings")
+        parser.add_argument("--verbose-plans", action="store_true", help="Print every plan, not only failing ones")
+
+    def handle(self, *args, **options):
+        if connection.vendor != "postgresql":
+            raise CommandError("explain_hot_queries needs PostgreSQL")
+
+        table = BestMatch._meta.db_table
+        failures = []
+        with transaction.atomic(), connection.cursor() as cursor:
+            if not options["real_costs"]:
+                cursor.execute("SET LOCAL enable_seqscan = off")
+            for name, queryset, index in hot_queries():
+                plan, problem = check_plan(cursor, queryset, index)
+                if problem is None:
+                    self.stdout.write(f"ok    {name}")
+                else:
+                    failures.append(name)
+                    self.stdout.write(self.style.ERROR(f"FAIL  {name}: {problem}"))
+                if options["verbose_plans"] or problem is not None:
+                    self.stdout.write(plan + "\n")
+
+        if failures:
+            raise CommandError(f"{len(failures)} hot queries miss their index on {table}: {', '.join(failures)}")
+        self.stdout.write(self.style.SUCCESS("Every hot query uses its index"))
@@ -0,0 +1,45 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from app import partitions
+
+
+class Command(BaseCommand):
+    help = (
+        "Pre-create monthly entry_time partitions of app_deliverynote_data (run daily from cron once the table "
+        "is partitioned). --convert prints the one-off conversion SQL; add --execute to run it."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--months-ahead", type=int, default=getattr(settings, "BEST_MATCH_PARTITION_MONTHS_AHEAD", 3),
+            help="Months after the current one to keep partitions for",
+        )
+        parser.add_argument("--convert", action="store_true", help="Switch the table to monthly partitions (prints the SQL)")
+        parser.add_argument("--execute", action="store_true", help="With --convert, run the conversion in one transaction")
+
+    def handle(self, *args, **options):
+        if connection.vendor != "postgresql":
+            raise CommandError("Partitioning needs PostgreSQL")
+
+        if options["convert"]:
+            if partitions.is_partitioned():
+                raise CommandError(f"{partitions.TABLE} is already partitioned")
+            if not options["execute"]:
+                for statement in partitions.convert_statements(options["months_ahead"]):
+                    self.stdout.write(statement + ";")
+                return
+            statements = partitions.convert(options["months_ahead"])
+            self.stdout.write(self.style.SUCCESS(
+                f"Converted {partitions.TABLE} in {len(statements)} statements; "
+                f"drop {partitions.TABLE}_unpartitioned once the new table checks out"
+            ))
+            return
+
+        if not partitions.is_partitioned():
+            raise CommandError(f"{partitions.TABLE} is not partitioned; see --convert")
+        created = partitions.ensure_partitions(options["months_ahead"])
+        self.stdout.write(self.style.SUCCESS(
+            f"Created {len(created)} partitions" + (f": {', '.join(created)}" if created else "")
+        ))
@@ -0,0 +1,25 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from app.reports import rebuild_carbon_summary
+
+
+class Command(BaseCommand):
+    help = (
+        "Recompute the carbon_summary table behind /api/search/ totals from invoice_data. migrate fills an empty "
+        "table on its own; run this after changes that bypassed enrichment and the InvoiceData signals "
+        "(raw SQL, restores, bulk fixes to invoice_data)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--customer-ref", type=int, help="Only rebuild this customer's rows")
+        parser.add_argument("--batch-size", type=int, default=1000, help="Summary rows per INSERT")
+
+    def handle(self, *args, **options):
+        started = time.monotonic()
+        written = rebuild_carbon_summary(customer_ref=options["customer_ref"], batch_size=options["batch_size"])
+        scope = f"customer {options['customer_ref']}" if options["customer_ref"] is not None else "all customers"
+        self.stdout.write(self.style.SUCCESS(
+            f"Rebuilt carbon summary for {scope}: {written} rows in {time.monotonic() - started:.2f}s"
+        ))
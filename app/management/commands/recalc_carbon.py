@@ -0,0 +1,57 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from app.enrichment import recalculate_carbon
+from app.models import BestMatch
+
+
+class Command(BaseCommand):
+    help = (
+        "Recompute kgCO2 on matched delivery-note lines and their InvoiceData copies from stored BEST data "
+        "and current building GIA, e.g. after a GIA or emission factor change. Does not call BEST."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--customer-ref", help="Only rows for this customer_ref")
+        parser.add_argument("--building", type=int, action="append", help="Only rows for this building id (repeatable)")
+        parser.add_argument("--since", help="Only rows with entry_time on or after this date (YYYY-MM-DD)")
+        parser.add_argument("--until", help="Only rows with entry_time on or before this date (YYYY-MM-DD)")
+        parser.add_argument("--material", help="Only rows with this material_name")
+        parser.add_argument("--gwp", type=float, help="New global_warming_potential_fossil (A1-A3) for the selected rows; needs --material")
+        parser.add_argument("--all", action="store_true", help="Recalculate every matched row")
+        parser.add_argument("--chunk-size", type=int, default=5000, help="Rows loaded and written per round trip")
+        parser.add_argument("--dry-run", action="store_true", help="Report what would change without writing")
+
+    def handle(self, *args, **options):
+        queryset = BestMatch.objects.all()
+        if options["customer_ref"]:
+            queryset = queryset.filter(customer_ref=options["customer_ref"])
+        if options["building"]:
+            queryset = queryset.filter(building_id__in=options["building"])
+        if options["since"]:
+            queryset = queryset.filter(entry_time__date__gte=options["since"])
+        if options["until"]:
+            queryset = queryset.filter(entry_time__date__lte=options["until"])
+        if options["material"]:
+            queryset = queryset.filter(material_name=options["material"])
+
+        if options["gwp"] is not None and not options["material"]:
+            raise CommandError("--gwp applies to a single material; pass --material as well")
+        scoped = any(options[name] for name in ("customer_ref", "building", "since", "until", "material"))
+        if not scoped and not options["all"]:
+            raise CommandError("Pass a scope (--customer-ref, --building, --since/--until, --material) or --all")
+
+        started = time.monotonic()
+        checked, changed = recalculate_carbon(
+            queryset,
+            chunk_size=options["chunk_size"],
+            gwp=options["gwp"],
+            dry_run=options["dry_run"],
+        )
+        elapsed = time.monotonic() - started
+        rate = checked / elapsed if elapsed else 0
+        verb = "would update" if options["dry_run"] else "updated"
+        self.stdout.write(self.style.SUCCESS(
+            f"Checked {checked} rows, {verb} {changed} in {elapsed:.2f}s ({rate:,.0f} rows/s)"
+        ))
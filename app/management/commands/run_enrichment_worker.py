@@ -0,0 +1,61 @@
+import socket
+import threading
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections, connection
+
+from app.enrichment import BestMatchEnricher, claim_job, run_job
+from app.utils.best_match_cache import best_match_cache
+
+
+class Command(BaseCommand):
+    help = "Claim queued BEST enrichment jobs (SELECT ... FOR UPDATE SKIP LOCKED) and run them"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--concurrency", type=int, default=1, help="Worker threads, each claiming its own job and row batches")
+        parser.add_argument("--poll-interval", type=float, default=5.0, help="Seconds to sleep when the queue is empty")
+        parser.add_argument("--once", action="store_true", help="Exit once the queue is empty instead of polling")
+
+    def handle(self, *args, **options):
+        self.stop = threading.Event()
+        threads = [
+            threading.Thread(target=self.work, args=(f"{socket.gethostname()}:{i}", options), daemon=True)
+            for i in range(options["concurrency"])
+        ]
+        for thread in threads:
+            thread.start()
+        try:
+            for thread in threads:
+                while thread.is_alive():
+                    thread.join(1)
+        except KeyboardInterrupt:
+            self.stop.set()
+            self.stdout.write("Stopping after the current job...")
+            for thread in threads:
+                thread.join()
+
+    def work(self, worker, options):
+        try:
+            while not self.stop.is_set():
+                close_old_connections()
+                job = claim_job(worker)
+                if job is None:
+                    if options["once"]:
+                        break
+                    self.stop.wait(options["poll_interval"])
+                    continue
+
+                started = time.monotonic()
+                job = run_job(job, BestMatchEnricher())
+                elapsed = time.monotonic() - started
+                style = self.style.SUCCESS if job.status == job.DONE else self.style.ERROR
+                self.stdout.write(style(
+                    f"[{worker}] Job {job.id} {job.status}: {job.processed} records in {elapsed:.2f}s "
+                    f"(cache hit rate {best_match_cache.stats()['hit_rate']:.0%})"
+                ))
+        finally:
+            try:
+                best_match_cache.flush_hits()
+            finally:
+                connection.close()
@@ -0,0 +1,20 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from app.utils.cognito_sync import sync_email_verified
+
+
+class Command(BaseCommand):
+    help = "Copy email_verified (and missing cognito_sub values) from the Cognito user pool onto CustomUser (run periodically, e.g. from cron)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--page-size", type=int, default=60, help="Users per list_users call (Cognito max is 60)")
+
+    def handle(self, *args, **options):
+        started = time.monotonic()
+        checked, updated = sync_email_verified(page_size=options["page_size"])
+        elapsed = time.monotonic() - started
+        self.stdout.write(self.style.SUCCESS(
+            f"Checked {checked} users, updated {updated} in {elapsed:.2f}s"
+        ))
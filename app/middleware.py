@@ -1,25 +1,19 @@
-import boto3
-from django.conf import settings
 from django.utils.deprecation import MiddlewareMixin
 from django.contrib.auth import get_user_model
 
+from .utils.cognito_sync import is_sync_stale, schedule_sync
+
 User = get_user_model()
 
 class SyncCognitoMiddleware(MiddlewareMixin):
+    """
+    Cognito attributes are kept current by the sync_cognito_users command.
+    When that has not happened for COGNITO_SYNC_MAX_AGE seconds the user is
+    queued for a single-user sync on a background thread, so a request only
+    ever pays for a timestamp check.
+    """
     def process_request(self, request):
         if request.user.is_authenticated:
             user = request.user
-            if user.cognito_sub:
-                client = boto3.client('cognito-idp', region_name=settings.AWS_COGNITO_REGION)
-                try:
-                    response = client.admin_get_user(
-                        UserPoolId=settings.AWS_COGNITO_USER_POOL_ID,
-                        Username=user.email
-                    )
-                    # Update user attributes from Cognito to Django
-                    for attribute in response['UserAttributes']:
-                        if attribute['Name'] == 'email_verified':
-                            user.email_verified = attribute['Value'] == 'true'
-                    user.save()
-                except client.exceptions.UserNotFoundException:
-                    pass
+            if user.cognito_sub and is_sync_stale(user):
+                schedule_sync(user)
@@ -1,4 +1,6 @@
 from datetime import timedelta
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVectorField
 from django.db import models
 from django.contrib.auth.models import AbstractUser
 
@@ -7,6 +9,7 @@ class CustomUser(AbstractUser):
     email = models.EmailField(unique=True)  # Set email as unique identifier
     cognito_sub = models.CharField(max_length=100, unique=True, null=True, blank=True)
     email_verified = models.BooleanField(default=False)
+    cognito_synced_at = models.DateTimeField(null=True, blank=True)  # last time attributes were copied from Cognito
 
     USERNAME_FIELD = 'email'  # Set email as the primary identifier
     REQUIRED_FIELDS = []  # No additional required fields
@@ -75,10 +78,75 @@ class BestMatch(models.Model):
     linear_density = models.FloatField(db_column='linear_density', null=True, blank=True)
     package_unit_item_volume = models.FloatField(db_column='package_unit_item_volume', null=True, blank=True)
     package_unit_item_volume_uom = models.TextField(db_column='package_unit_item_volume_uom', null=True, blank=True)
+    enrichment_hash = models.CharField(db_column='enrichment_hash', max_length=64, null=True, blank=True)  # sha256 of the inputs last sent to BEST
+    enrichment_claimed_until = models.DateTimeField(db_column='enrichment_claimed_until', null=True, blank=True)  # lease held by the worker matching the row, see app.enrichment
 
 
     class Meta:
         db_table = 'app_deliverynote_data'
+        indexes = [
+            # Pending-set scans in app.enrichment.pending_ids: id-only, index-only
+            models.Index(
+                fields=['id'], include=['approved', 'enrichment_claimed_until'],
+                condition=models.Q(processed=False, error_code=0),
+                name='deliverynote_pending_new_idx',
+            ),
+            models.Index(
+                fields=['id'], include=['revised_date', 'processed_timestamp', 'enrichment_claimed_until'],
+                condition=models.Q(processed=True, approved=True, error_code=0),
+                name='deliverynote_pending_rev_idx',
+            ),
+            # getCount dashboard counters and the per-customer date-range lists: one index-only scan per customer
+            models.Index(
+                fields=['customer_ref', 'entry_time'], include=['delivery_note_ref_no', 'account_number'],
+                name='deliverynote_counts_idx',
+            ),
+            # Line lookups by delivery note (revise, list by ref no)
+            models.Index(fields=['delivery_note_ref_no', 'item_no'], name='deliverynote_ref_item_idx'),
+            # A user's uploads over a date range
+            models.Index(fields=['user_id', 'entry_time'], name='deliverynote_user_time_idx'),
+            # Documents screen: a customer's buildings over a date range
+            models.Index(fields=['building_id', 'entry_time'], name='deliverynote_building_idx'),
+        ]
+
+class EnrichmentJob(models.Model):
+    """A request to run BEST enrichment over pending BestMatch rows, claimed by run_enrichment_worker."""
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (QUEUED, 'Queued'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    ]
+
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=QUEUED, db_index=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    worker = models.CharField(max_length=255, null=True, blank=True)
+    run_after = models.DateTimeField(null=True, blank=True)  # not claimed before this; set on retries after a BEST outage
+    processed = models.IntegerField(default=0)
+    error = models.TextField(null=True, blank=True)
+
+    def __str__(self):
+        return f"EnrichmentJob {self.id} ({self.status})"
+
+class BestMatchCache(models.Model):
+    """BEST /get_best_match/ result for one normalised product description + delivery country."""
+    key = models.TextField(unique=True)
+    product_description = models.TextField()
+    delivery_country = models.TextField()
+    result = models.JSONField()
+    version = models.IntegerField(default=1)
+    fetched_at = models.DateTimeField()
+    expires_at = models.DateTimeField(db_index=True)
+    hit_count = models.BigIntegerField(default=0)
+
+    def __str__(self):
+        return self.key
 
 class Phase(models.Model):
     name = models.CharField(max_length=300)
@@ -103,12 +171,44 @@ class InvoiceData(models.Model):
     phase_name = models.ForeignKey(Phase, null=True, blank=True, on_delete=models.CASCADE)
     kgco2 = models.BigIntegerField(null=True, blank=True)
     product_manufacturing_company = models.CharField(max_length=300, null=True, blank=True)
+    best_match = models.ForeignKey(BestMatch, null=True, blank=True, on_delete=models.SET_NULL, related_name='invoices')  # delivery-note line this was copied from
+    search_vector = SearchVectorField(null=True, editable=False)  # maintained by a trigger, see app.search
 
     def __str__(self):
         return f"Invoice {self.customer_ref}"
 
     class Meta:
         db_table = 'invoice_data'
+        indexes = [
+            # Keyset pages of a customer's lines (InvoiceDataListMixin)
+            models.Index(fields=['customer_ref', 'entry_time', 'id'], name='invoice_data_keyset_idx'),
+            GinIndex(fields=['search_vector'], name='invoice_data_search_idx'),
+        ]
+
+class CarbonSummary(models.Model):
+    """
+    kgco2 of invoice_data rolled up per customer, location, phase, material,
+    data source and month, kept current by app.reports.CarbonSummaryDelta.
+    """
+    key = models.CharField(max_length=32, unique=True)  # md5 of the grouping columns, NULLs included
+    customer_ref = models.BigIntegerField(null=True, blank=True, db_index=True)
+    region_name = models.CharField(max_length=300, null=True, blank=True)
+    city_name = models.CharField(max_length=300, null=True, blank=True)
+    building_name = models.CharField(max_length=300, null=True, blank=True)
+    phase_name = models.ForeignKey(Phase, null=True, blank=True, on_delete=models.CASCADE, related_name='+')
+    material_name = models.CharField(max_length=500, null=True, blank=True)
+    data_source = models.CharField(max_length=300, null=True, blank=True)
+    month = models.DateField(null=True, blank=True)
+    kgco2 = models.BigIntegerField(default=0)  # sum of the non-NULL figures
+    kgco2_count = models.IntegerField(default=0)  # rows with a figure; 0 means the total is NULL
+    row_count = models.IntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"CarbonSummary {self.customer_ref} {self.month}"
+
+    class Meta:
+        db_table = 'carbon_summary'
 
 #####################################  Common ############################
 class Country(models.Model):
@@ -0,0 +1,131 @@
+"""
+Opt-in monthly range partitioning of app_deliverynote_data on entry_time.
+
+convert_statements() is the one-off switch: the existing table is renamed
+to <table>_unpartitioned, a partitioned table with the same columns and
+indexes takes its name, and the rows are copied across. Rows without an
+entry_time (or outside every monthly range) land in <table>_default.
+Monthly partitions are then kept ahead of the calendar with
+ensure_partitions(), run from the partition_deliverynotes command.
+
+PostgreSQL only allows unique constraints on a partitioned table when they
+include the partition key, so after conversion id is indexed but not a
+primary key, and foreign keys pointing at it (invoice_data.best_match_id)
+are dropped; the columns and the ORM relations stay as they were.
+"""
+from datetime import date
+
+from dateutil.relativedelta import relativedelta
+from django.db import connection, transaction
+
+from .models import BestMatch
+
+TABLE = BestMatch._meta.db_table
+PARTITION_KEY = BestMatch._meta.get_field('entry_time').column
+
+
+def is_partitioned():
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(%s)", [TABLE])
+        return cursor.fetchone() is not None
+
+
+def partition_name(month):
+    return f"{TABLE}_{month:%Y_%m}"
+
+
+def month_range(first, last):
+    """First days of every month from `first` to `last`, inclusive."""
+    month = first.replace(day=1)
+    while month <= last:
+        yield month
+        month += relativedelta(months=1)
+
+
+def create_partition_sql(month):
+    qn = connection.ops.quote_name
+    return (
+        f"CREATE TABLE IF NOT EXISTS {qn(partition_name(month))} PARTITION OF {qn(TABLE)} "
+        f"FOR VALUES FROM ('{month:%Y-%m-%d}') TO ('{month + relativedelta(months=1):%Y-%m-%d}')"
+    )
+
+
+def ensure_partitions(months_ahead=3, today=None):
+    """Create any missing monthly partitions from this month to `months_ahead` months out; returns the names created."""
+    today = today or date.today()
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid WHERE i.inhparent = to_regclass(%s)",
+            [TABLE],
+        )
+        existing = {row[0] for row in cursor.fetchall()}
+        created = []
+        for month in month_range(today, today + relativedelta(months=months_ahead)):
+            if partition_name(month) not in existing:
+                cursor.execute(create_partition_sql(month))
+                created.append(partition_name(month))
+    return created
+
+
+def convert_statements(months_ahead=3, today=None):
+    """
+    The SQL that turns app_deliverynote_data into a partitioned table, for
+    review or to run inside one transaction (convert()). Read from the live
+    catalog, so it reflects the table's current indexes and referencing
+    foreign keys.
+    """
+    qn = connection.ops.quote_name
+    today = today or date.today()
+    old = f"{TABLE}_unpartitioned"
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT indexname, indexdef FROM pg_indexes WHERE schemaname = current_schema() AND tablename = %s",
+            [TABLE],
+        )
+        indexes = cursor.fetchall()
+        cursor.execute(
+            "SELECT conrelid::regclass::text, conname FROM pg_constraint WHERE contype = 'f' AND confrelid = to_regclass(%s)",
+            [TABLE],
+        )
+        foreign_keys = cursor.fetchall()
+        cursor.execute("SELECT pg_get_serial_sequence(%s, 'id')", [TABLE])
+        sequence = cursor.fetchone()[0]
+        cursor.execute(f"SELECT min({qn(PARTITION_KEY)}) FROM {qn(TABLE)}")
+        oldest = cursor.fetchone()[0]
+
+    statements = [f"LOCK TABLE {qn(TABLE)} IN ACCESS EXCLUSIVE MODE"]
+    statements += [f"ALTER TABLE {table} DROP CONSTRAINT {qn(name)}" for table, name in foreign_keys]
+    statements.append(f"ALTER TABLE {qn(TABLE)} RENAME TO {qn(old)}")
+    # Index names are schema-wide, so the old table's give theirs up first
+    statements += [
+        f"ALTER INDEX {qn(name)} RENAME TO {qn((name + '_unpartitioned')[:63])}" for name, _ in indexes
+    ]
+    statements.append(
+        f"CREATE TABLE {qn(TABLE)} (LIKE {qn(old)} INCLUDING DEFAULTS INCLUDING STORAGE INCLUDING COMMENTS) "
+        f"PARTITION BY RANGE ({qn(PARTITION_KEY)})"
+    )
+    if sequence:
+        # Keeps the id sequence alive when the old table is eventually dropped
+        statements.append(f"ALTER SEQUENCE {sequence} OWNED BY {qn(TABLE)}.id")
+    statements.append(f"CREATE TABLE {qn(TABLE + '_default')} PARTITION OF {qn(TABLE)} DEFAULT")
+    first = oldest.date() if oldest else today
+    statements += [create_partition_sql(month) for month in month_range(first, today + relativedelta(months=months_ahead))]
+    for name, definition in indexes:
+        if definition.startswith("CREATE UNIQUE INDEX"):
+            # Unique indexes (the primary key) can't exclude the partition key; keep id lookups indexed
+            statements.append(f"CREATE INDEX {qn(name)} ON {qn(TABLE)} (id)")
+        else:
+            statements.append(definition)
+    statements.append(f"INSERT INTO {qn(TABLE)} SELECT * FROM {qn(old)}")
+    statements.append(f"ANALYZE {qn(TABLE)}")
+    return statements
+
+
+def convert(months_ahead=3):
+    """Run convert_statements() in one transaction. The old table is left in place for the operator to drop."""
+    with transaction.atomic():
+        statements = convert_statements(months_ahead)
+        with connection.cursor() as cursor:
+            for statement in statements:
+                cursor.execute(statement)
+    return statements
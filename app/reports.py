@@ -0,0 +1,263 @@
+import hashlib
+
+from django.core.exceptions import EmptyResultSet
+from django.db import connection, connections, transaction
+from django.db.models import BigIntegerField, Case, Count, F, Sum, When
+from django.db.models.functions import TruncMonth
+from django.utils import timezone
+
+from .models import CarbonSummary, InvoiceData
+
+# Grouping columns of the rollup, in GROUPING() bit order (first = most significant)
+ROLLUP_COLUMNS = ['region_name', 'city_name', 'building_name', 'phase', 'material_name', 'data_source']
+
+
+def _mask(*grouped):
+    """GROUPING() value of a grouping set: a bit is set for every column *not* grouped on."""
+    mask = 0
+    for column in ROLLUP_COLUMNS:
+        mask = (mask << 1) | (0 if column in grouped else 1)
+    return mask
+
+
+BY_PHASE = _mask('region_name', 'city_name', 'building_name', 'phase')
+BY_BUILDING_IN_CITY = _mask('region_name', 'city_name', 'building_name')
+BY_CITY_IN_REGION = _mask('region_name', 'city_name')
+BY_REGION = _mask('region_name')
+OVERALL = _mask()
+BY_CITY = _mask('city_name')
+BY_BUILDING = _mask('building_name')
+BY_MATERIAL = _mask('material_name')
+BY_DATA_SOURCE = _mask('data_source')
+
+
+def _total(value):
+    # SUM(bigint) comes back as numeric; Sum('kgco2') through the ORM gave ints
+    return None if value is None else int(value)
+
+
+def carbon_rollup_rows(queryset, kgco2=F('kgco2')):
+    """
+    All kgco2 totals InvoiceDataView reports, from one GROUPING SETS query
+    over `queryset`: the region > city > building > phase rollup plus flat
+    totals per city, building, material and data source. Rows come back
+    as (grouping mask, region, city, building, phase, material, data source,
+    total), coarsest set first and each set ordered by its grouped columns,
+    so every level sorts the way its own ORDER BY used to. `kgco2` is the
+    per-row figure summed.
+    """
+    base = queryset.order_by().annotate(phase=F('phase_name__name'), carbon=kgco2).values(*ROLLUP_COLUMNS, 'carbon')
+    db = connections[queryset.db]
+    try:
+        sql, params = base.query.get_compiler(queryset.db).as_sql()
+    except EmptyResultSet:
+        # .none() and friends: only the grand total, which is NULL like Sum() over no rows
+        return [(OVERALL,) + (None,) * len(ROLLUP_COLUMNS) + (None,)]
+    qn = db.ops.quote_name
+    columns = ", ".join(qn(column) for column in ROLLUP_COLUMNS)
+    rollup = ", ".join(qn(column) for column in ROLLUP_COLUMNS[:4])
+    with db.cursor() as cursor:
+        cursor.execute(
+            f"SELECT GROUPING({columns}) AS grouping_id, {columns}, SUM({qn('carbon')}) "
+            f"FROM ({sql}) AS invoice_rows "
+            f"GROUP BY GROUPING SETS (ROLLUP({rollup}), ({qn('city_name')}), ({qn('building_name')}), "
+            f"({qn('material_name')}), ({qn('data_source')})) "
+            f"ORDER BY grouping_id DESC, {columns}",
+            params,
+        )
+        return cursor.fetchall()
+
+
+def carbon_rollup(queryset, kgco2=F('kgco2')):
+    """
+    Fold carbon_rollup_rows() into the aggregate blocks of the
+    InvoiceDataView response (everything except 'results').
+    """
+    overall = None
+    sets = {mask: [] for mask in (BY_REGION, BY_CITY, BY_BUILDING, BY_MATERIAL)}
+    by_data_source = {}
+    regions = {}
+    cities = {}
+    buildings = {}
+
+    for grouping_id, region, city, building, phase, material, data_source, total in carbon_rollup_rows(queryset, kgco2):
+        total = _total(total)
+        if grouping_id == OVERALL:
+            overall = total
+        elif grouping_id == BY_DATA_SOURCE:
+            by_data_source[data_source] = total
+        elif grouping_id in sets:
+            column = {BY_REGION: region, BY_CITY: city, BY_BUILDING: building, BY_MATERIAL: material}[grouping_id]
+            sets[grouping_id].append((column, total))
+            if grouping_id == BY_REGION:
+                regions[region] = {'region_name': region, 'total_kgco2': total, 'cities': []}
+        elif grouping_id == BY_CITY_IN_REGION:
+            cities[(region, city)] = {'city_name': city, 'total_kgco2': total, 'buildings': []}
+        elif grouping_id == BY_BUILDING_IN_CITY:
+            buildings[(region, city, building)] = {'building_name': building, 'total_kgco2': total, 'phases': []}
+        elif grouping_id == BY_PHASE:
+            buildings[(region, city, building)]['phases'].append({'phase_name__name': phase, 'total_kgco2': total})
+
+    # Rows are ordered within each set, so appending keeps every level sorted
+    for (region, city, building), building_data in buildings.items():
+        cities[(region, city)]['buildings'].append(building_data)
+    for (region, city), city_data in cities.items():
+        regions[region]['cities'].append(city_data)
+
+    total_kgco2 = overall or 0
+    estimate_kgco2 = by_data_source.get('EPD')
+    actual_kgco2 = by_data_source.get('Average')
+    if total_kgco2 > 0:
+        estimate_percentage = (estimate_kgco2 or 0) / total_kgco2 * 100
+        actual_percentage = (actual_kgco2 or 0) / total_kgco2 * 100
+    else:
+        estimate_percentage = 0
+        actual_percentage = 0
+
+    return {
+        'overall_aggregates': {'total_kgco2': overall},
+        'material_name_aggregates': [{'material_name': name, 'total_kgco2': total} for name, total in sets[BY_MATERIAL]],
+        'carbon_status_totals': {
+            'estimate': {
+                'total_kgco2': estimate_kgco2 or 0
+            },
+            'actual': {
+                'total_kgco2': actual_kgco2 or 0
+            }
+        },
+        'carbon_status_percentage': {
+            'EPD': estimate_percentage,
+            'average': actual_percentage,
+        },
+        'region_aggregates': [{'region_name': name, 'total_kgco2': total} for name, total in sets[BY_REGION]],
+        'city_aggregates': [{'city_name': name, 'total_kgco2': total} for name, total in sets[BY_CITY]],
+        'building_aggregates': [{'building_name': name, 'total_kgco2': total} for name, total in sets[BY_BUILDING]],
+        'nested_structure': list(regions.values()),
+    }
+
+
+# InvoiceData columns a summary row is keyed on, plus the figure it sums
+SUMMARY_DIMENSIONS = ['customer_ref', 'region_name', 'city_name', 'building_name', 'phase_name_id', 'material_name', 'data_source']
+SUMMARY_SOURCE_FIELDS = SUMMARY_DIMENSIONS + ['entry_time', 'kgco2']
+# A summary group with no non-NULL figure reports NULL, as Sum() over the raw rows does
+SUMMARY_KGCO2 = Case(When(kgco2_count__gt=0, then=F('kgco2')), output_field=BigIntegerField())
+
+
+def summary_key(dimensions):
+    """Unique key of a summary group; NULL and '' stay distinct."""
+    text = "\x1f".join("n" if value is None else "v" + str(value) for value in dimensions)
+    return hashlib.md5(text.encode()).hexdigest()
+
+
+def month_of(entry_time):
+    return entry_time.replace(day=1) if entry_time else None
+
+
+class CarbonSummaryDelta:
+    """
+    Changes to carbon_summary collected from InvoiceData rows going in
+    (sign=1) and out (sign=-1), written by apply() in one statement. Call
+    apply() in the transaction that changes the rows themselves.
+    """
+
+    def __init__(self):
+        self.groups = {}
+
+    def add(self, row, sign=1):
+        """`row` is a dict of SUMMARY_SOURCE_FIELDS, e.g. from .values()."""
+        dimensions = tuple(row[field] for field in SUMMARY_DIMENSIONS) + (month_of(row['entry_time']),)
+        group = self.groups.setdefault(summary_key(dimensions), [dimensions, 0, 0, 0])
+        if row['kgco2'] is not None:
+            group[1] += sign * int(row['kgco2'])
+            group[2] += sign
+        group[3] += sign
+
+    def add_invoices(self, invoices, sign=1):
+        for invoice in invoices:
+            self.add({field: getattr(invoice, field) for field in SUMMARY_SOURCE_FIELDS}, sign)
+
+    def apply(self):
+        changes = sorted(
+            (key, group) for key, group in self.groups.items() if any(group[1:])
+        )
+        self.groups = {}
+        if not changes:
+            return
+        keys = [key for key, _ in changes]
+        now = timezone.now()
+        with transaction.atomic():
+            if connection.vendor == 'postgresql':
+                table = connection.ops.quote_name(CarbonSummary._meta.db_table)
+                columns = ['key'] + SUMMARY_DIMENSIONS + ['month', 'kgco2', 'kgco2_count', 'row_count', 'updated_at']
+                with connection.cursor() as cursor:
+                    # Keys are sorted so concurrent batches lock summary rows in the same order
+                    cursor.execute(
+                        f"INSERT INTO {table} ({', '.join(columns)}) VALUES "
+                        + ", ".join(["(" + ", ".join(["%s"] * len(columns)) + ")"] * len(changes))
+                        + " ON CONFLICT (key) DO UPDATE SET"
+                        f" kgco2 = {table}.kgco2 + EXCLUDED.kgco2,"
+                        f" kgco2_count = {table}.kgco2_count + EXCLUDED.kgco2_count,"
+                        f" row_count = {table}.row_count + EXCLUDED.row_count,"
+                        " updated_at = EXCLUDED.updated_at",
+                        [value for key, (dimensions, kgco2, kgco2_count, row_count) in changes
+                         for value in (key, *dimensions, kgco2, kgco2_count, row_count, now)],
+                    )
+            else:
+                for key, (dimensions, kgco2, kgco2_count, row_count) in changes:
+                    CarbonSummary.objects.get_or_create(
+                        key=key, defaults=dict(zip(SUMMARY_DIMENSIONS + ['month'], dimensions)),
+                    )
+                    CarbonSummary.objects.filter(key=key).update(
+                        kgco2=F('kgco2') + kgco2,
+                        kgco2_count=F('kgco2_count') + kgco2_count,
+                        row_count=F('row_count') + row_count,
+                        updated_at=now,
+                    )
+            CarbonSummary.objects.filter(key__in=keys, row_count__lte=0).delete()
+
+
+def rebuild_carbon_summary(customer_ref=None, batch_size=1000):
+    """
+    Recompute carbon_summary from invoice_data, for one customer or all of
+    them, in one grouped query. Returns the number of summary rows written.
+    """
+    invoices = InvoiceData.objects.all()
+    summaries = CarbonSummary.objects.all()
+    if customer_ref is not None:
+        invoices = invoices.filter(customer_ref=customer_ref)
+        summaries = summaries.filter(customer_ref=customer_ref)
+    groups = (
+        invoices.order_by()
+        .annotate(month=TruncMonth('entry_time'))
+        .values(*SUMMARY_DIMENSIONS, 'month')
+        .annotate(total=Sum('kgco2'), kgco2_count=Count('kgco2'), row_count=Count('id'))
+    )
+    with transaction.atomic():
+        if connection.vendor == 'postgresql':
+            # Incremental writers wait for the rebuild instead of being overwritten by it
+            with connection.cursor() as cursor:
+                cursor.execute(f"LOCK TABLE {connection.ops.quote_name(CarbonSummary._meta.db_table)} IN SHARE ROW EXCLUSIVE MODE")
+        summaries.delete()
+        now = timezone.now()
+        rows = []
+        for group in groups.iterator():
+            dimensions = tuple(group[field] for field in SUMMARY_DIMENSIONS) + (group['month'],)
+            rows.append(CarbonSummary(
+                key=summary_key(dimensions),
+                month=group['month'],
+                kgco2=group['total'] or 0,
+                kgco2_count=group['kgco2_count'],
+                row_count=group['row_count'],
+                updated_at=now,
+                **{field: group[field] for field in SUMMARY_DIMENSIONS},
+            ))
+        CarbonSummary.objects.bulk_create(rows, batch_size=batch_size)
+    return len(rows)
+
+
+def summary_rollup(customer_ref=None):
+    """carbon_rollup() for a customer's (or everyone's) invoices, read from carbon_summary."""
+    summaries = CarbonSummary.objects.all()
+    if customer_ref:
+        summaries = summaries.filter(customer_ref=customer_ref)
+    return carbon_rollup(summaries, SUMMARY_KGCO2)
@@ -0,0 +1,118 @@
+import re
+
+from django.contrib.postgres.search import SearchQuery, SearchRank
+from django.db import connection
+from django.db.models import F, FloatField
+from django.db.models.functions import Cast
+
+from .models import InvoiceData
+
+SEARCH_CONFIG = 'simple'  # no stemming or stop words: supplier, product and place names aren't English prose
+
+_word = re.compile(r"\w")
+_separators = re.compile(r"[./]")  # split in the document too, see SEARCH_DOCUMENT_SQL
+
+# The invoice_data row as a tsvector, weighted so product matches rank above
+# supplier/site matches, which rank above place and date matches. Dots and
+# slashes split words, so "smith" finds "J.Smith" and "40" finds "C32/40";
+# dates are spelled out so "2024-01" finds January's lines. The phase name
+# is read from app_phase, so renaming a phase rewrites its rows' vectors
+# through a second trigger on that table.
+SEARCH_DOCUMENT_SQL = """
+CREATE OR REPLACE FUNCTION invoice_data_search_document(invoice invoice_data) RETURNS tsvector AS $$
+    SELECT
+        setweight(to_tsvector('{config}', translate(concat_ws(' ', invoice.product_description, invoice.material_name), './', '  ')), 'A') ||
+        setweight(to_tsvector('{config}', translate(concat_ws(' ', invoice.supplier_name, invoice.building_name,
+            (SELECT name FROM app_phase WHERE id = invoice.phase_name_id)), './', '  ')), 'B') ||
+        setweight(to_tsvector('{config}', translate(concat_ws(' ', invoice.country_name, invoice.region_name, invoice.city_name,
+            invoice.data_source, to_char(invoice.entry_time, 'YYYY-MM-DD')), './', '  ')), 'C')
+$$ LANGUAGE sql STABLE;
+
+CREATE OR REPLACE FUNCTION invoice_data_search_vector_update() RETURNS trigger AS $$
+BEGIN
+    NEW.search_vector := invoice_data_search_document(NEW);
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS invoice_data_search_vector_trigger ON invoice_data;
+CREATE TRIGGER invoice_data_search_vector_trigger
+    BEFORE INSERT OR UPDATE OF product_description, material_name, supplier_name, building_name, phase_name_id,
+        country_name, region_name, city_name, data_source, entry_time
+    ON invoice_data FOR EACH ROW EXECUTE PROCEDURE invoice_data_search_vector_update();
+
+CREATE OR REPLACE FUNCTION phase_search_vector_update() RETURNS trigger AS $$
+BEGIN
+    UPDATE invoice_data AS t SET search_vector = invoice_data_search_document(t) WHERE t.phase_name_id = NEW.id;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS phase_search_vector_trigger ON app_phase;
+CREATE TRIGGER phase_search_vector_trigger
+    AFTER UPDATE OF name ON app_phase FOR EACH ROW
+    WHEN (OLD.name IS DISTINCT FROM NEW.name)
+    EXECUTE PROCEDURE phase_search_vector_update();
+""".format(config=SEARCH_CONFIG)
+
+
+def full_text_available():
+    return connection.vendor == 'postgresql'
+
+
+def install_search_trigger():
+    """(Re)create the functions and triggers that keep invoice_data.search_vector current on write."""
+    with connection.cursor() as cursor:
+        cursor.execute(SEARCH_DOCUMENT_SQL)
+
+
+def backfill_search_vectors(batch_size=10000):
+    """Fill search_vector for rows written before the trigger existed, batch_size ids at a time."""
+    table = connection.ops.quote_name(InvoiceData._meta.db_table)
+    updated = 0
+    last_id = 0
+    with connection.cursor() as cursor:
+        while True:
+            cursor.execute(f"SELECT max(id) FROM (SELECT id FROM {table} WHERE id > %s ORDER BY id LIMIT %s) AS batch", [last_id, batch_size])
+            upper = cursor.fetchone()[0]
+            if upper is None:
+                break
+            cursor.execute(
+                f"UPDATE {table} AS t SET search_vector = invoice_data_search_document(t) WHERE t.id > %s AND t.id <= %s",
+                [last_id, upper],
+            )
+            updated += cursor.rowcount
+            last_id = upper
+    return updated
+
+
+def _prefix_query(term):
+    """
+    tsquery text matching every whitespace-separated word of `term` as a
+    prefix. Each word is quoted so to_tsquery splits it with the same parser
+    that built the document ("c32/40", "ready-mix", "2024-01" all match).
+    """
+    words = [word for word in _separators.sub(" ", term).split() if _word.search(word)]
+    return " & ".join("'" + word.replace("\\", "\\\\").replace("'", "''") + "':*" for word in words)
+
+
+def search_query(terms):
+    """SearchQuery matching rows that contain any of `terms`, or None when none has a word in it."""
+    query = None
+    for term in terms:
+        text = _prefix_query(term)
+        if not text:
+            continue
+        term_query = SearchQuery(text, search_type='raw', config=SEARCH_CONFIG)
+        query = term_query if query is None else query | term_query
+    return query
+
+
+def search(queryset, terms):
+    """`queryset` narrowed to rows matching `terms`, annotated with search_rank (higher is better)."""
+    query = search_query(terms)
+    if query is None:
+        return queryset.none()
+    # ts_rank() is a real; as double precision it survives the round trip through a keyset cursor exactly
+    rank = Cast(SearchRank(F('search_vector'), query), FloatField())
+    return queryset.filter(search_vector=query).annotate(search_rank=rank)
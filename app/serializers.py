@@ -149,9 +149,11 @@ class BestMatchSerializer(serializers.ModelSerializer):
         return None
 
     def get_kgco2_per_m2(self, obj):
+        # Building GIA comes from the view (context['gia_by_building']); without it there is no per-m2 figure
+        gia = self.context.get('gia_by_building', {}).get(obj.building_id)
         try:
-            if obj.global_warming_potential_fossil and obj.scaling_factor and obj.quantity:
-                return (float(obj.global_warming_potential_fossil) / float(obj.scaling_factor)) * (float(obj.quantity) / float(5000))
+            if obj.global_warming_potential_fossil and obj.scaling_factor and obj.quantity and gia:
+                return (float(obj.global_warming_potential_fossil) / float(obj.scaling_factor)) * (float(obj.quantity) / float(gia))
         except (ValueError, TypeError):
             return None
         return None
@@ -169,11 +171,17 @@ class BestMatchSerializer(serializers.ModelSerializer):
 
         return data
 
+class EnrichmentJobSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = EnrichmentJob
+        fields = ['id', 'status', 'created_at', 'run_after', 'started_at', 'finished_at', 'processed', 'error']
+        read_only_fields = fields
+
 class InvoiceDataSerializer(serializers.ModelSerializer):
     phase_name = serializers.CharField(source='phase_name.name', read_only=True)
     class Meta:
         model = InvoiceData
-        fields = '__all__'
+        exclude = ['search_vector']
 
 class DesignDataSerializer(serializers.ModelSerializer):
     total = serializers.SerializerMethodField()
@@ -1,11 +1,17 @@
 from django.db.models.signals import post_delete
 from django.dispatch import receiver
 from .models import CustomUser
-import boto3
 from django.conf import settings
-from django.db.models.signals import post_save
+from django.db.models.signals import post_migrate, post_save, pre_save
 from .models import WasteCarriersBrokersDealers, WasteExemptionCertificates, WasteOperationsPermits
+from .models import Building, CarbonSummary, City, Country, InvoiceData, Phase, ProductMapping, Region
+from .reports import SUMMARY_SOURCE_FIELDS, CarbonSummaryDelta, rebuild_carbon_summary
+from .search import full_text_available, install_search_trigger
+from app.utils.best_match_cache import best_match_cache
+from app.utils.cognito_client import get_cognito_client
 from app.utils.elasticsearch_client import get_elasticsearch_client
+from app.utils.options_cache import options_cache
+from app.utils.principal_cache import principal_cache
 
 
 
@@ -14,7 +20,7 @@ def delete_user_in_cognito(sender, instance, **kwargs):
     """
     Deletes the user from AWS Cognito when they are deleted in Django.
     """
-    client = boto3.client('cognito-idp', region_name=settings.AWS_COGNITO_REGION)
+    client = get_cognito_client()
     try:
         client.admin_delete_user(
             UserPoolId=settings.AWS_COGNITO_USER_POOL_ID,
@@ -24,6 +30,92 @@ def delete_user_in_cognito(sender, instance, **kwargs):
         pass  # User was already deleted in Cognito
 
 
+@receiver(post_save, sender=CustomUser)
+@receiver(post_delete, sender=CustomUser)
+def evict_user_principals(sender, instance, **kwargs):
+    """
+    Drops cached token -> user entries so a deleted user's tokens stop
+    authenticating and a changed user is read afresh.
+    """
+    principal_cache.invalidate_user(instance.pk)
+
+
+@receiver(post_save, sender=ProductMapping)
+def invalidate_best_match_cache(sender, instance, **kwargs):
+    """
+    A user remapping a description means the cached BEST match for it was
+    wrong; drop both sides so they are matched afresh on the next run.
+    """
+    best_match_cache.invalidate_descriptions(instance.product_description, instance.mapped_product_description)
+
+
+@receiver(pre_save, sender=InvoiceData)
+def remember_invoice_summary_row(sender, instance, **kwargs):
+    """
+    Keeps what the row contributed to carbon_summary before this save, so
+    post_save can move the totals instead of rebuilding them.
+    """
+    instance._summary_before = None
+    if instance.pk:
+        instance._summary_before = InvoiceData.objects.filter(pk=instance.pk).values(*SUMMARY_SOURCE_FIELDS).first()
+
+
+@receiver(post_save, sender=InvoiceData)
+def update_carbon_summary(sender, instance, **kwargs):
+    summary = CarbonSummaryDelta()
+    before = getattr(instance, '_summary_before', None)
+    if before is not None:
+        summary.add(before, -1)
+    summary.add_invoices([instance])
+    summary.apply()
+
+
+@receiver(post_delete, sender=InvoiceData)
+def remove_from_carbon_summary(sender, instance, **kwargs):
+    summary = CarbonSummaryDelta()
+    summary.add_invoices([instance], -1)
+    summary.apply()
+
+
+
+@receiver(post_save, sender=Building)
+@receiver(post_delete, sender=Building)
+@receiver(post_save, sender=Region)
+@receiver(post_delete, sender=Region)
+@receiver(post_save, sender=City)
+@receiver(post_delete, sender=City)
+@receiver(post_save, sender=Country)
+@receiver(post_delete, sender=Country)
+@receiver(post_save, sender=Phase)
+@receiver(post_delete, sender=Phase)
+def invalidate_options_cache(sender, **kwargs):
+    """
+    Drops the GetOptionsAPI payloads cached by this process when anything
+    they list changes; see OptionsCache for how other workers catch up.
+    """
+    options_cache.invalidate()
+
+
+@receiver(post_migrate)
+def create_search_trigger(sender, **kwargs):
+    """
+    invoice_data.search_vector is filled by a database trigger rather than
+    in Python, so raw and bulk writes keep it current too.
+    """
+    if sender.name == 'app' and full_text_available():
+        install_search_trigger()
+
+
+@receiver(post_migrate)
+def fill_carbon_summary(sender, **kwargs):
+    """
+    carbon_summary is only moved along by writes made after it exists, so
+    the migrate that creates it also builds it from the invoice_data
+    already there; otherwise /api/search/ totals would start at nothing.
+    """
+    if sender.name == 'app' and not CarbonSummary.objects.exists() and InvoiceData.objects.exists():
+        rebuild_carbon_summary()
+
 
 @receiver(post_save, sender=WasteCarriersBrokersDealers)
 def index_to_elasticsearch(sender, instance, **kwargs):
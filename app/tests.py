@@ -1,11 +1,1333 @@
-from django.test import TestCase
+import base64
+import csv
+import io
+import itertools
+import json
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+from unittest import mock, skipUnless
 
-# Create your tests here.
-# import requests
+import jwt
+from botocore.exceptions import UnStubbedResponseError
+from cryptography.hazmat.primitives.asymmetric import rsa
+from django.apps import apps
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.db.models import Count, F, Sum
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from jwt.algorithms import RSAAlgorithm
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework.test import APIClient
 
-# def lambda_handler(event, context):
-#     try:
-#         response = requests.get("https://www.google.com", timeout=5)
-#         print("✅ Internet is working. Status code:", response.status_code)
-#     except Exception as e:
-#         print("Internet not working. Error:", str(e))
\ No newline at end of file
+from . import line_edits
+from .authentication import CognitoJWTAuthentication
+from .carbon import ERROR_QUANTITY
+from .enrichment import BestMatchEnricher, ReferenceData, recalculate_carbon, run_job, update_rows
+from .management.commands.explain_hot_queries import check_plan, hot_queries
+from .middleware import SyncCognitoMiddleware
+from .reports import carbon_rollup, rebuild_carbon_summary, summary_rollup
+from .search import search
+from .signals import fill_carbon_summary
+from .models import (
+    AppDeliveryNoteChangeLog, BestAPIToken, BestMatch, BestMatchCache, Building, CarbonSummary, City, Country,
+    CustomerMaster, CustomUser, DeliveryNoteFile, DesignData, EnrichmentJob, InvoiceData, Phase, ProductMapping,
+    Region, Unit_of_Measure, Users,
+)
+from .utils import cognito_sync
+from .utils.best_client import BestClient, CircuitBreaker
+from .utils.best_match_cache import BestMatchResultCache, cache_key
+from .utils.best_stub import STUB_RESULT, BestStubServer, StubTokenManager
+from .utils.best_token import BestTokenManager
+from .utils.cognito_client import get_cognito_client, get_cognito_stubber, reset_cognito_client
+from .utils.cognito_jwks import CognitoJWKSCache, get_cognito_issuer
+from .utils.cognito_sync import sync_email_verified
+from .utils.options_cache import options_cache
+from .utils.principal_cache import Principal, PrincipalCache, principal_cache
+from .utils.units_cache import units_cache
+from .views import getCount
+
+
+class UnmanagedTablesMixin:
+    """
+    Creates the tables of the unmanaged models a test case touches; the test
+    database only gets the ones migrations manage.
+    """
+
+    unmanaged_models = []
+
+    @classmethod
+    def setUpClass(cls):
+        with connection.schema_editor() as editor:
+            for model in cls.unmanaged_models:
+                editor.create_model(model)
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        with connection.schema_editor() as editor:
+            for model in reversed(cls.unmanaged_models):
+                editor.delete_model(model)
+
+
+def rsa_key_pair(kid):
+    """A private key to sign tokens with and the JWKS entry for its public half."""
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    jwk = json.loads(RSAAlgorithm.to_jwk(private_key.public_key()))
+    jwk.update(kid=kid, alg='RS256', use='sig')
+    return private_key, jwk
+
+
+@override_settings(AWS_COGNITO_TOKEN_VERIFICATION='local', AWS_COGNITO_GET_USER_FALLBACK=True)
+class CognitoLocalVerificationTests(UnmanagedTablesMixin, TestCase):
+    """CognitoJWTAuthentication against tokens signed with a locally generated key; nothing reaches Cognito."""
+
+    unmanaged_models = [Users]
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.private_key, jwk = rsa_key_pair('test-key')
+        cls.other_key, _ = rsa_key_pair('test-key')
+        cls.jwks = {'keys': [jwk]}
+
+    def setUp(self):
+        principal_cache.clear()
+        jwks_cache = CognitoJWKSCache(fetcher=lambda url: self.jwks)
+        patcher = mock.patch('app.utils.cognito_jwks.jwks_cache', jwks_cache)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(principal_cache.clear)
+        self.cognito = mock.Mock()
+        patcher = mock.patch('app.authentication.get_cognito_client', return_value=self.cognito)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def token(self, key=None, **claims):
+        payload = {
+            'sub': str(uuid.uuid4()),
+            'username': str(uuid.uuid4()),
+            'iss': get_cognito_issuer(),
+            'token_use': 'access',
+            'client_id': settings.AWS_COGNITO_APP_CLIENT_ID,
+            'exp': int(time.time()) + 3600,
+        }
+        payload.update(claims)
+        return jwt.encode(payload, key or self.private_key, algorithm='RS256', headers={'kid': 'test-key'})
+
+    def authenticate(self, token):
+        request = RequestFactory().get('/', HTTP_AUTHORIZATION=f'Bearer {token}')
+        return CognitoJWTAuthentication().authenticate(request)
+
+    def test_matches_user_by_sub(self):
+        user = CustomUser.objects.create(email='sub@example.com', cognito_sub='sub-1')
+        Users.objects.create(User_ID='sub@example.com', verification_status='verified', customer_ref='C1')
+
+        authenticated, principal = self.authenticate(self.token(sub='sub-1'))
+
+        self.assertEqual(authenticated, user)
+        self.assertEqual(principal.customer_ref, 'C1')
+        self.cognito.get_user.assert_not_called()
+
+    def test_legacy_user_matched_by_email_username_gets_sub(self):
+        user = CustomUser.objects.create(email='legacy@example.com')
+
+        authenticated, _ = self.authenticate(self.token(sub='sub-2', username='legacy@example.com'))
+
+        self.assertEqual(authenticated, user)
+        user.refresh_from_db()
+        self.assertEqual(user.cognito_sub, 'sub-2')
+        self.cognito.get_user.assert_not_called()
+
+    def test_legacy_user_with_uuid_username_is_resolved_once_through_get_user(self):
+        user = CustomUser.objects.create(email='uuid@example.com')
+        self.cognito.get_user.return_value = {'UserAttributes': [
+            {'Name': 'sub', 'Value': 'sub-3'},
+            {'Name': 'email', 'Value': 'uuid@example.com'},
+        ]}
+
+        authenticated, _ = self.authenticate(self.token(sub='sub-3'))
+        self.assertEqual(authenticated, user)
+        user.refresh_from_db()
+        self.assertEqual(user.cognito_sub, 'sub-3')
+
+        # The stored sub lets a fresh token skip Cognito
+        principal_cache.clear()
+        authenticated, _ = self.authenticate(self.token(sub='sub-3'))
+        self.assertEqual(authenticated, user)
+        self.assertEqual(self.cognito.get_user.call_count, 1)
+
+    @override_settings(AWS_COGNITO_GET_USER_FALLBACK=False)
+    def test_unmatched_user_without_fallback_is_rejected(self):
+        with self.assertRaisesMessage(AuthenticationFailed, 'User not found'):
+            self.authenticate(self.token())
+
+    @override_settings(AWS_COGNITO_GET_USER_FALLBACK=False)
+    def test_malformed_jwks_is_an_authentication_failure(self):
+        CustomUser.objects.create(email='malformed@example.com', cognito_sub='sub-8')
+        self.jwks = {'keys': [{'kid': 'test-key', 'kty': 'RSA', 'n': 'not a modulus'}]}
+
+        with self.assertRaisesMessage(AuthenticationFailed, 'Could not fetch Cognito JWKS'):
+            self.authenticate(self.token(sub='sub-8'))
+        self.cognito.get_user.assert_not_called()
+
+    def test_rejects_token_signed_with_another_key(self):
+        CustomUser.objects.create(email='forged@example.com', cognito_sub='sub-4')
+        with self.assertRaises(AuthenticationFailed):
+            self.authenticate(self.token(key=self.other_key, sub='sub-4'))
+
+    def test_rejects_expired_token(self):
+        CustomUser.objects.create(email='expired@example.com', cognito_sub='sub-5')
+        with self.assertRaises(AuthenticationFailed):
+            self.authenticate(self.token(sub='sub-5', exp=int(time.time()) - 60))
+
+    def test_rejects_token_for_another_client(self):
+        CustomUser.objects.create(email='client@example.com', cognito_sub='sub-6')
+        with self.assertRaisesMessage(AuthenticationFailed, 'not issued for this app client'):
+            self.authenticate(self.token(sub='sub-6', client_id='someone-else'))
+
+    def test_rejects_id_token(self):
+        CustomUser.objects.create(email='id@example.com', cognito_sub='sub-7')
+        with self.assertRaisesMessage(AuthenticationFailed, 'not an access token'):
+            self.authenticate(self.token(sub='sub-7', token_use='id'))
+
+
+class PrincipalCacheTests(TestCase):
+    def setUp(self):
+        self.cache = PrincipalCache(max_size=2, ttl=300)
+        self.user = CustomUser.objects.create(email='cached@example.com')
+
+    def principal(self, user=None):
+        return Principal(user or self.user, 'C1')
+
+    def test_the_least_recently_used_entry_is_dropped(self):
+        self.cache.set('a', self.principal())
+        self.cache.set('b', self.principal())
+        self.cache.get('a')
+        self.cache.set('c', self.principal())
+
+        self.assertIsNone(self.cache.get('b'))
+        self.assertIsNotNone(self.cache.get('a'))
+        self.assertIsNotNone(self.cache.get('c'))
+        self.assertEqual(self.cache.stats(), {'hits': 3, 'misses': 1, 'size': 2})
+
+    def test_the_ttl_is_capped_by_the_token_expiry(self):
+        now = time.time()
+        self.cache.set('short', self.principal(), expires_at=now + 10)
+        self.cache.set('long', self.principal(), expires_at=now + 3600)
+
+        with mock.patch('app.utils.principal_cache.time') as clock:
+            clock.time.return_value = now + 60
+            self.assertIsNone(self.cache.get('short'))
+            self.assertIsNotNone(self.cache.get('long'))
+            clock.time.return_value = now + 301
+            self.assertIsNone(self.cache.get('long'))
+
+    def test_saving_or_deleting_a_user_evicts_their_entries(self):
+        other = CustomUser.objects.create(email='other@example.com')
+        principal_cache.set('mine', self.principal())
+        principal_cache.set('theirs', self.principal(other))
+        self.addCleanup(principal_cache.clear)
+
+        self.user.is_active = False
+        self.user.save()
+        self.assertIsNone(principal_cache.get('mine'))
+        self.assertIsNotNone(principal_cache.get('theirs'))
+
+        principal_cache.set('mine', self.principal())
+        with mock.patch('app.signals.get_cognito_client'):
+            self.user.delete()
+        self.assertIsNone(principal_cache.get('mine'))
+
+    def test_each_request_gets_its_own_user(self):
+        self.cache.set('a', self.principal())
+
+        first, second = self.cache.get('a'), self.cache.get('a')
+        first.user.first_name = 'Changed'
+
+        self.assertEqual(first.user, second.user)
+        self.assertNotEqual(second.user.first_name, 'Changed')
+        self.assertNotEqual(self.user.first_name, 'Changed')
+
+
+@override_settings(AWS_COGNITO_CLIENT_STUB=True)
+class CognitoClientStubTests(TestCase):
+
+    def setUp(self):
+        reset_cognito_client()
+        self.addCleanup(reset_cognito_client)
+
+    def admin_get_user(self, client):
+        return client.admin_get_user(UserPoolId='eu-west-2_Stub', Username='stub@example.com')
+
+    def test_the_stubbed_client_answers_from_its_queue(self):
+        client = get_cognito_client()
+        attributes = [{'Name': 'email_verified', 'Value': 'true'}]
+        get_cognito_stubber().add_response(
+            'admin_get_user', {'Username': 'stub@example.com', 'UserAttributes': attributes},
+            {'UserPoolId': 'eu-west-2_Stub', 'Username': 'stub@example.com'},
+        )
+
+        self.assertEqual(self.admin_get_user(client)['UserAttributes'], attributes)
+        get_cognito_stubber().assert_no_pending_responses()
+        # With nothing queued the stub fails rather than reaching Cognito
+        with self.assertRaises(UnStubbedResponseError):
+            self.admin_get_user(client)
+
+    def test_every_caller_shares_one_client(self):
+        threads = 8
+        start = threading.Barrier(threads)
+        clients = []
+
+        def get_client():
+            start.wait(5)
+            clients.append(get_cognito_client())
+
+        workers = [threading.Thread(target=get_client) for _ in range(threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        self.assertEqual(len(clients), threads)
+        self.assertEqual({id(client) for client in clients}, {id(get_cognito_client())})
+
+
+class CognitoSubBackfillTests(TestCase):
+
+    def test_sync_fills_missing_cognito_sub(self):
+        legacy = CustomUser.objects.create(email='legacy@example.com')
+        current = CustomUser.objects.create(email='current@example.com', cognito_sub='kept', email_verified=True)
+        client = mock.Mock()
+        client.list_users.return_value = {'Users': [
+            {'Attributes': [{'Name': 'sub', 'Value': 'sub-1'}, {'Name': 'email', 'Value': 'legacy@example.com'},
+                            {'Name': 'email_verified', 'Value': 'false'}]},
+            {'Attributes': [{'Name': 'sub', 'Value': 'other'}, {'Name': 'email', 'Value': 'current@example.com'},
+                            {'Name': 'email_verified', 'Value': 'true'}]},
+        ]}
+
+        checked, updated = sync_email_verified(client=client)
+
+        self.assertEqual((checked, updated), (2, 1))
+        legacy.refresh_from_db()
+        current.refresh_from_db()
+        self.assertEqual(legacy.cognito_sub, 'sub-1')
+        self.assertEqual(current.cognito_sub, 'kept')
+
+    def test_a_sub_another_user_holds_is_left_out(self):
+        CustomUser.objects.create(email='holder@example.com', cognito_sub='sub-1')
+        legacy = CustomUser.objects.create(email='legacy@example.com')
+        client = mock.Mock()
+        client.list_users.return_value = {'Users': [
+            {'Attributes': [{'Name': 'sub', 'Value': 'sub-1'}, {'Name': 'email', 'Value': 'legacy@example.com'},
+                            {'Name': 'email_verified', 'Value': 'true'}]},
+        ]}
+
+        with self.assertLogs('app.utils.cognito_sync', 'WARNING'):
+            checked, updated = sync_email_verified(client=client)
+
+        self.assertEqual((checked, updated), (1, 1))
+        legacy.refresh_from_db()
+        self.assertEqual((legacy.email_verified, legacy.cognito_sub), (True, None))
+        self.assertIsNotNone(legacy.cognito_synced_at)
+
+
+class ListUsersStreamTests(TestCase):
+
+    def cognito_user(self, email):
+        return {'Attributes': [{'Name': 'email', 'Value': email}, {'Name': 'email_verified', 'Value': 'true'}]}
+
+    def test_a_failed_later_page_ends_the_array_with_an_error(self):
+        client = mock.Mock()
+        client.list_users.side_effect = [
+            {'Users': [self.cognito_user('a@example.com'), self.cognito_user('b@example.com')], 'PaginationToken': 'page-2'},
+            RuntimeError('Rate exceeded'),
+        ]
+
+        with mock.patch('app.views.get_cognito_client', return_value=client):
+            response = APIClient().get('/api/user_list/')
+            body = json.loads(b''.join(response.streaming_content))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([user.get('email') for user in body[:2]], ['a@example.com', 'b@example.com'])
+        self.assertEqual(body[2], {'error': 'Listing stopped early: Rate exceeded', 'next_cursor': 'page-2'})
+        self.assertEqual(len(body), 3)
+        self.assertEqual(client.list_users.call_args.kwargs['PaginationToken'], 'page-2')
+
+
+class SyncCognitoMiddlewareTests(TransactionTestCase):
+
+    def test_stale_user_is_synced_in_the_background(self):
+        user = CustomUser.objects.create(email='stale@example.com', cognito_sub='sub-1')
+        release = threading.Event()
+        client = mock.Mock()
+
+        def admin_get_user(**kwargs):
+            release.wait(5)
+            return {'UserAttributes': [{'Name': 'email_verified', 'Value': 'true'}]}
+
+        client.admin_get_user.side_effect = admin_get_user
+        request = RequestFactory().get('/')
+        request.user = user
+
+        with mock.patch.object(cognito_sync, 'get_cognito_client', return_value=client):
+            # Returns while Cognito is still "answering"
+            SyncCognitoMiddleware(lambda request: None).process_request(request)
+            self.assertFalse(cognito_sync.schedule_sync(user), 'a queued user is not queued twice')
+            release.set()
+            cognito_sync._executor.submit(lambda: None).result(timeout=5)
+
+        user.refresh_from_db()
+        self.assertTrue(user.email_verified)
+        self.assertIsNotNone(user.cognito_synced_at)
+        self.assertEqual(client.admin_get_user.call_count, 1)
+
+
+class FakeResponse:
+    status_code = 200
+
+    def __init__(self, payload):
+        self.payload = payload
+        self.text = json.dumps(payload)
+
+    def json(self):
+        return self.payload
+
+
+class FakeBestClient:
+    """Answers post_many() in process; records whether a transaction was open during each call."""
+
+    max_in_flight = 2
+
+    def __init__(self, results=None, during=None):
+        self.results = results or {}
+        self.during = during
+        self.in_transaction = []
+
+    def post_many(self, path, payloads, headers=None):
+        self.in_transaction.append(connection.in_atomic_block)
+        if self.during:
+            self.during()
+        return [FakeResponse({'results': {
+            item: self.results.get(item, STUB_RESULT) for item in payload['input_items']
+        }}) for payload in payloads]
+
+
+def best_result(gwp):
+    result = json.loads(json.dumps(STUB_RESULT))
+    result['best_product']['product_data']['material_facts']['global_warming_potential_fossil']['A1A2A3'] = gwp
+    return result
+
+
+class EnrichmentTestMixin(UnmanagedTablesMixin):
+    unmanaged_models = [Users]
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        # gia lives on app_building in production but is not a Building field
+        with connection.cursor() as cursor:
+            cursor.execute("ALTER TABLE app_building ADD COLUMN IF NOT EXISTS gia double precision")
+
+    def building(self, gia):
+        country = Country.objects.create(name='UK')
+        region = Region.objects.create(name='London', country=country)
+        city = City.objects.create(name='Camden', region=region)
+        building = Building.objects.create(name='Library', city=city, customer_ref='C1',
+                                           region_id=str(region.id), country_id=str(country.id))
+        with connection.cursor() as cursor:
+            cursor.execute("UPDATE app_building SET gia = %s WHERE id = %s", [gia, building.id])
+        return building
+
+    def line(self, description, **fields):
+        values = dict(product_description=description, delivery_country='UK', unit_of_measure='m3', quantity=10,
+                      processed=False, approved=True, error_code=0, delivery_note_ref_no='1001', user_id='u@example.com')
+        values.update(fields)
+        return BestMatch.objects.create(**values)
+
+    def enricher(self, client):
+        return BestMatchEnricher(token_manager=StubTokenManager(), client=client, batch_size=2)
+
+
+class BestMatchEnricherRunTests(EnrichmentTestMixin, TransactionTestCase):
+
+    def setUp(self):
+        self.building_id = self.building(gia=100).id
+        Users.objects.create(User_ID='u@example.com', verification_status='verified', customer_ref='101')
+
+    def test_best_is_called_outside_any_transaction(self):
+        lines = [self.line(f'Concrete {i}', building_id=self.building_id) for i in range(5)]
+        client = FakeBestClient()
+
+        self.assertEqual(self.enricher(client).run(), 5)
+
+        self.assertTrue(client.in_transaction)
+        self.assertFalse(any(client.in_transaction))
+        for line in lines:
+            line.refresh_from_db()
+            self.assertTrue(line.processed)
+            self.assertIsNone(line.enrichment_claimed_until)
+        self.assertEqual(sorted(InvoiceData.objects.values_list('kgco2', flat=True)), [25] * 5)
+        # Filed under the row's customer and building, not the InvoiceData defaults
+        self.assertEqual(
+            set(InvoiceData.objects.values_list('customer_ref', 'country_name', 'region_name', 'city_name', 'building_name')),
+            {(101, 'UK', 'London', 'Camden', 'Library')},
+        )
+        summary = CarbonSummary.objects.get()
+        self.assertEqual((summary.customer_ref, summary.building_name, summary.kgco2), (101, 'Library', 125))
+
+    def test_re_enriching_a_revised_row_rewrites_its_invoice(self):
+        line = self.line('Concrete', building_id=self.building_id)
+        self.assertEqual(self.enricher(FakeBestClient()).run(), 1)
+        invoice_id = InvoiceData.objects.get(best_match=line).id
+        summary_before = list(CarbonSummary.objects.values_list('key', 'kgco2', 'row_count'))
+
+        # As a reviewer's edit leaves it (see line_edits.apply_line_edit)
+        BestMatch.objects.filter(id=line.id).update(
+            revised_product_description='Concrete C32/40', revised_unit_of_measure='m3', revised_date=timezone.now(), approved=True,
+        )
+        self.assertEqual(self.enricher(FakeBestClient()).run(), 1)
+
+        self.assertEqual(list(InvoiceData.objects.filter(best_match=line).values_list('id', 'product_description')),
+                         [(invoice_id, 'Concrete C32/40')])
+        self.assertEqual(list(CarbonSummary.objects.values_list('key', 'kgco2', 'row_count')), summary_before)
+
+    def test_a_bad_row_only_fails_itself(self):
+        bad_gwp = self.line('Concrete bad gwp', building_id=self.building_id)
+        bad_ref = self.line('Concrete bad ref', building_id=self.building_id, delivery_note_ref_no='DN-7')
+        good = self.line('Concrete good', building_id=self.building_id)
+        client = FakeBestClient(results={'Concrete bad gwp UK': best_result('n/a')})
+
+        self.assertEqual(self.enricher(client).run(), 2)
+
+        bad_gwp.refresh_from_db()
+        self.assertFalse(bad_gwp.processed)
+        self.assertEqual(bad_gwp.error_code, 0)
+        self.assertIsNone(bad_gwp.enrichment_claimed_until)
+        # Its delivery_note_ref_no can't go into InvoiceData, but the row itself is matched
+        bad_ref.refresh_from_db()
+        self.assertTrue(bad_ref.processed)
+        self.assertFalse(InvoiceData.objects.filter(best_match=bad_ref).exists())
+        self.assertEqual(InvoiceData.objects.get(best_match=good).kgco2, 25)
+
+    def test_row_revised_while_matching_is_left_pending(self):
+        revised = self.line('Concrete', building_id=self.building_id)
+        other = self.line('Steel', building_id=self.building_id)
+
+        def revise():
+            BestMatch.objects.filter(id=revised.id).update(revised_product_description='Timber', revised_date=timezone.now())
+
+        self.assertEqual(self.enricher(FakeBestClient(during=revise)).run(), 1)
+
+        revised.refresh_from_db()
+        self.assertFalse(revised.processed)
+        self.assertEqual(revised.revised_product_description, 'Timber')
+        self.assertIsNone(revised.enrichment_claimed_until)
+        other.refresh_from_db()
+        self.assertTrue(other.processed)
+
+    def test_claimed_rows_wait_for_the_claim_to_lapse(self):
+        line = self.line('Concrete', building_id=self.building_id,
+                         enrichment_claimed_until=timezone.now() + timedelta(minutes=10))
+
+        self.assertEqual(self.enricher(FakeBestClient()).run(), 0)
+
+        BestMatch.objects.filter(id=line.id).update(enrichment_claimed_until=timezone.now() - timedelta(minutes=1))
+        self.assertEqual(self.enricher(FakeBestClient()).run(), 1)
+
+    def test_update_rows_writes_each_rows_values(self):
+        lines = [self.line(f'Concrete {i}') for i in range(3)]
+        for i, line in enumerate(lines):
+            line.kgco2 = i * 1.5
+            line.material_name = None if i == 0 else f'material {i}'
+            line.error_code = i
+
+        update_rows(lines, ['kgco2', 'material_name', 'error_code'])
+
+        self.assertEqual(
+            list(BestMatch.objects.order_by('id').values_list('kgco2', 'material_name', 'error_code')),
+            [(0.0, None, 0), (1.5, 'material 1', 1), (3.0, 'material 2', 2)],
+        )
+
+
+class BestMatchAPIViewTests(TestCase):
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(CustomUser.objects.create(email='lister@example.com'))
+
+    def test_listing_queues_one_enrichment_job(self):
+        pending = BestMatch.objects.create(product_description='Concrete', delivery_country='UK', processed=False, error_code=0)
+
+        for _ in range(2):
+            response = self.client.get('/best_match/')
+            self.assertEqual(response.status_code, 200)
+
+        self.assertEqual(EnrichmentJob.objects.filter(status=EnrichmentJob.QUEUED).count(), 1)
+        pending.refresh_from_db()
+        self.assertFalse(pending.processed)
+
+
+class BestClientStubTests(EnrichmentTestMixin, TransactionTestCase):
+    """BestClient and BestMatchEnricher against BestStubServer over real HTTP."""
+
+    def setUp(self):
+        self.stub = BestStubServer().start()
+        self.addCleanup(self.stub.stop)
+
+    def client_for(self, **kwargs):
+        kwargs.setdefault('backoff_base', 0.01)
+        return BestClient(self.stub.url, **kwargs)
+
+    def test_requests_in_flight_are_capped(self):
+        self.stub.latency = 0.05
+        client = self.client_for(max_in_flight=2)
+
+        responses = client.post_many('/get_best_match/', [{'input_items': [f'item {i}']} for i in range(6)])
+
+        self.assertEqual([response.status_code for response in responses], [200] * 6)
+        self.assertEqual(self.stub.max_in_flight, 2)
+
+    def test_transient_failures_are_retried_with_backoff(self):
+        self.stub.fail(503, count=2)
+        client = self.client_for(max_retries=3)
+
+        response = client.post('/get_best_match/', json={'input_items': ['item']})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.stub.requests, 3)
+        self.assertIsNone(client.breaker.opened_at)
+
+    def test_items_without_a_match_fail_their_rows(self):
+        self.stub.no_match.add('Gravel UK')
+        gravel = self.line('Gravel')
+        sand = self.line('Sand')
+
+        self.enricher(self.client_for()).run()
+
+        gravel.refresh_from_db()
+        self.assertEqual((gravel.processed, gravel.error_code), (False, 1))
+        sand.refresh_from_db()
+        self.assertTrue(sand.processed)
+
+    def test_open_circuit_stops_the_job_and_leaves_rows_pending(self):
+        self.stub.fail(503)
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=60)
+        enricher = self.enricher(self.client_for(max_in_flight=1, max_retries=0, breaker=breaker))
+        lines = [self.line(f'Concrete {i}') for i in range(6)]
+
+        job = run_job(EnrichmentJob.objects.create(status=EnrichmentJob.RUNNING), enricher)
+
+        self.assertEqual(job.status, EnrichmentJob.FAILED)
+        self.assertIsNotNone(breaker.opened_at)
+        # The first request opened the circuit and stopped the run
+        self.assertEqual(self.stub.requests, 1)
+        retry = EnrichmentJob.objects.get(status=EnrichmentJob.QUEUED)
+        self.assertGreater(retry.run_after, timezone.now())
+
+        # While the circuit is open nothing is sent and nothing is marked as unmatched
+        job = run_job(EnrichmentJob.objects.create(status=EnrichmentJob.RUNNING), enricher)
+        self.assertIn('circuit open', job.error)
+        self.assertEqual(self.stub.requests, 1)
+        self.assertEqual(EnrichmentJob.objects.filter(status=EnrichmentJob.QUEUED).count(), 1)
+        for line in lines:
+            line.refresh_from_db()
+            self.assertEqual((line.processed, line.error_code, line.enrichment_claimed_until), (False, 0, None))
+
+        # Once BEST is back and the breaker lets a trial through, the retry matches them
+        self.stub.recover()
+        breaker.reset_timeout = 0
+        job = run_job(retry, enricher)
+        self.assertEqual((job.status, job.processed), (EnrichmentJob.DONE, 6))
+
+
+class FakeTokenEndpoint:
+    """A BestClient stand-in that answers the token endpoints slowly and counts the requests."""
+
+    def __init__(self, latency=0.1):
+        self.latency = latency
+        self.requests = []
+        self.lock = threading.Lock()
+
+    def request(self, method, path, **kwargs):
+        with self.lock:
+            self.requests.append((method, path))
+            issued = len(self.requests)
+        # Long enough for every waiting thread to pile up on the locks
+        time.sleep(self.latency)
+        return mock.Mock(status_code=200, json=lambda: {'api_token': f'token-{issued}', 'refresh_token': 'refresh'})
+
+
+class BestTokenManagerTests(TransactionTestCase):
+    def test_a_cached_token_needs_no_query(self):
+        manager = BestTokenManager(client=FakeTokenEndpoint(latency=0))
+        token = manager.get_token()
+
+        with self.assertNumQueries(0):
+            self.assertEqual(manager.get_token(), token)
+
+    @skipUnless(connection.vendor == 'postgresql', 'refreshes are only serialised across processes on PostgreSQL')
+    def test_an_expired_token_is_refreshed_once(self):
+        BestAPIToken.objects.create(TokenName='BEST ACCESS TOKEN', TokenValue='expired', RefreshToken='refresh',
+                                    TokenExpiryTime=timezone.now() - timedelta(minutes=1))
+        endpoint = FakeTokenEndpoint()
+        # Two managers stand in for two processes (the advisory lock), four threads each for the thread lock
+        managers = [BestTokenManager(client=endpoint) for _ in range(2)]
+        threads = 8
+        start = threading.Barrier(threads)
+        tokens = []
+        errors = []
+
+        def get_token(manager):
+            try:
+                start.wait(5)
+                tokens.append(manager.get_token())
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        workers = [threading.Thread(target=get_token, args=(managers[i % 2],)) for i in range(threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(endpoint.requests, [('POST', '/token/refresh/')])
+        self.assertEqual(tokens, ['token-1'] * threads)
+        self.assertEqual(list(BestAPIToken.objects.values_list('TokenValue', flat=True)), ['token-1'])
+
+
+class BestMatchResultCacheTests(UnmanagedTablesMixin, TestCase):
+    unmanaged_models = [ProductMapping]
+
+    def setUp(self):
+        self.cache = BestMatchResultCache()
+
+    def store(self, *items):
+        self.cache.set_many({cache_key(description, country): (description, country, {'match': description})
+                             for description, country in items})
+
+    def test_entries_expire_after_the_ttl(self):
+        with override_settings(BEST_MATCH_CACHE_TTL=3600):
+            self.store(('Concrete', 'UK'))
+        key = cache_key('Concrete', 'UK')
+
+        self.assertEqual(list(self.cache.get_many([key])), [key])
+        with mock.patch('app.utils.best_match_cache.timezone.now', return_value=timezone.now() + timedelta(hours=2)):
+            self.assertEqual(self.cache.get_many([key]), {})
+
+    def test_a_version_bump_drops_every_entry(self):
+        self.store(('Concrete', 'UK'), ('Timber', 'UK'))
+
+        with override_settings(BEST_MATCH_CACHE_VERSION=2):
+            self.assertEqual(self.cache.get_many([cache_key('Concrete', 'UK'), cache_key('Timber', 'UK')]), {})
+            self.assertEqual(self.cache.purge_expired(), 2)
+
+    def test_remapping_a_description_drops_its_entries_in_every_country(self):
+        self.store(('Concrete C32/40', 'UK'), ('Concrete C32/40', 'France'), ('Concrete C32/40 Insitu', 'UK'),
+                   ('Timber', 'UK'), ('Steel', 'UK'))
+
+        ProductMapping.objects.create(customer_ref='101', product_description='concrete  C32/40',
+                                      mapped_product_description='Timber', user_id='reviewer@example.com')
+
+        self.assertEqual(sorted(BestMatchCache.objects.values_list('key', flat=True)),
+                         ['concrete c32/40 insitu|uk', 'steel|uk'])
+
+    @override_settings(BEST_MATCH_CACHE_HIT_FLUSH_INTERVAL=3600)
+    def test_hits_are_counted_and_written_in_batches(self):
+        self.store(('Concrete', 'UK'), ('Timber', 'UK'))
+        keys = [cache_key('Concrete', 'UK'), cache_key('Timber', 'UK'), cache_key('Steel', 'UK')]
+
+        for _ in range(2):
+            with self.assertNumQueries(1):
+                self.cache.get_many(keys)
+        self.cache.get_many(keys[:1])
+
+        self.assertEqual(self.cache.stats(), {'hits': 5, 'misses': 2, 'hit_rate': 5 / 7})
+        self.assertEqual(BestMatchCache.objects.aggregate(total=Sum('hit_count'))['total'], 0)
+        self.assertEqual(self.cache.table_stats()['api_items_saved'], 5)
+        self.assertEqual(dict(BestMatchCache.objects.values_list('key', 'hit_count')), {keys[0]: 3, keys[1]: 2})
+
+
+class RecalculateCarbonTests(EnrichmentTestMixin, TestCase):
+
+    def set_gia(self, building, gia):
+        with connection.cursor() as cursor:
+            cursor.execute("UPDATE app_building SET gia = %s WHERE id = %s", [gia, building.id])
+
+    def test_invoice_copy_follows_the_rows_carbon_figure(self):
+        building = self.building(gia=None)
+        line = self.line('Concrete', building_id=building.id, processed=True, approved=False, error_code=5,
+                         material_name='Concrete', global_warming_potential_fossil=250, scaling_factor=1, kgco2=0)
+
+        # The building gets a GIA: the row becomes computable and is copied to InvoiceData
+        self.set_gia(building, 100)
+        self.assertEqual(recalculate_carbon(BestMatch.objects.all()), (1, 1))
+        invoice = InvoiceData.objects.get(best_match=line)
+        self.assertEqual(invoice.kgco2, 25)
+        self.assertEqual(CarbonSummary.objects.get().kgco2, 25)
+
+        # It loses it again: the copy keeps its place but no longer carries a figure
+        self.set_gia(building, None)
+        self.assertEqual(recalculate_carbon(BestMatch.objects.all()), (1, 1))
+        invoice.refresh_from_db()
+        self.assertIsNone(invoice.kgco2)
+        summary = CarbonSummary.objects.get()
+        self.assertEqual((summary.kgco2, summary.kgco2_count, summary.row_count), (0, 0, 1))
+
+
+class ReferenceDataQueryTests(EnrichmentTestMixin, TestCase):
+
+    def test_a_batch_costs_three_queries_however_many_rows(self):
+        buildings = [self.building(gia=100 + i).id for i in range(5)]
+        phases = [Phase.objects.create(name=f'Phase {i}').id for i in range(5)]
+        Users.objects.bulk_create([
+            Users(User_ID=f'user{i}@example.com', verification_status='verified', customer_ref=f'C{i}') for i in range(10)
+        ])
+        records = BestMatch.objects.bulk_create([
+            BestMatch(product_description=f'Concrete {i}', delivery_country='UK', unit_of_measure='m3', quantity=10,
+                      user_id=f'user{i % 10}@example.com', building_id=buildings[i % 5], phase_id=phases[i % 5])
+            for i in range(1000)
+        ])
+
+        with self.assertNumQueries(3):
+            reference = ReferenceData.load(records)
+        enricher = self.enricher(FakeBestClient())
+        with self.assertNumQueries(0):
+            for record in records:
+                enricher.apply_result(record, STUB_RESULT, reference)
+                reference.gia(record)
+                reference.phase(record)
+
+        self.assertEqual(records[7].customer_ref, 'C7')
+        self.assertEqual(reference.gia(records[7]), 102)
+        self.assertEqual(reference.phase(records[7]).name, 'Phase 2')
+
+
+class DesignDataAPIViewQueryTests(UnmanagedTablesMixin, TestCase):
+    unmanaged_models = [Users]
+
+    def design(self, building_id, **fields):
+        values = dict(
+            region='free text', city='free text', building_name='Library', gia=100, customer_ref='C1', building_id=building_id,
+            substructure=1, superstructure=2, façade=3, internal_walls_partitions=4, internal_finishes=5, ff_fe=6, frame=7,
+            upper_floors=8, roofs=9, stairs_and_ramps=10, external_walls=11, windows_and_external_walls=12,
+            internal_doors=13, wall_finishes=14, floor_finishes=15, ceiling_finishes=16,
+        )
+        values.update(fields)
+        return DesignData(**values)
+
+    def test_list_costs_three_queries_however_many_designs(self):
+        Users.objects.create(User_ID='designer@example.com', verification_status='verified', customer_ref='C1')
+        country = Country.objects.create(name='UK')
+        region = Region.objects.create(name='London', country=country)
+        city = City.objects.create(name='Camden', region=region)
+        building = Building.objects.create(name='Library', city=city, customer_ref='C1',
+                                           region_id=str(region.id), country_id=str(country.id))
+        DesignData.objects.bulk_create(
+            [self.design(str(building.id)) for _ in range(200)]
+            # A design whose building is gone is left out of the rows and the totals
+            + [self.design(str(building.id + 1000), substructure=1000)]
+        )
+
+        # User lookup, rows with their geography, totals
+        with self.assertNumQueries(3):
+            response = APIClient().get('/api/design/', {'email': 'designer@example.com'})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data['data']), 200)
+        row = response.data['data'][0]
+        self.assertEqual((row['region'], row['city'], row['country']), ('London', 'Camden', 'UK'))
+        self.assertEqual(row['total'], 21)
+        self.assertEqual(response.data['totals']['substructure_total'], 200)
+
+
+class DeliveryNoteDocumentsQueryTests(UnmanagedTablesMixin, TestCase):
+    unmanaged_models = [CustomerMaster, DeliveryNoteFile]
+
+    def test_documents_cost_five_queries_however_many_notes(self):
+        CustomerMaster.objects.create(Customer_Ref='C1', Domain_Name='example.com')
+        country = Country.objects.create(name='UK')
+        region = Region.objects.create(name='London', country=country)
+        city = City.objects.create(name='Camden', region=region)
+        buildings = [
+            Building.objects.create(name=f'Building {i}', city=city, customer_ref='C1',
+                                    region_id=str(region.id), country_id=str(country.id))
+            for i in range(3)
+        ]
+        phase = Phase.objects.create(name='Frame')
+        files = DeliveryNoteFile.objects.bulk_create([DeliveryNoteFile(id=i + 1, file_name=f'scan {i}.pdf') for i in range(100)])
+        BestMatch.objects.bulk_create([
+            BestMatch(delivery_note_ref_no=f'DN{i:03d}', item_no=item, building_id=buildings[i % 3].id, phase_id=phase.id,
+                      account_number='W', entry_time=timezone.now(), filename=f'upload_{files[i].id}.pdf')
+            for i in range(100) for item in (1, 2)
+        ])
+
+        # Customer, buildings, notes, phases, files
+        with self.assertNumQueries(5):
+            response = APIClient().get('/api/get_document_data/', {'domain': 'example.com'})
+
+        notes = response.data['result']
+        self.assertEqual(len(notes), 100)
+        self.assertEqual(
+            (notes[4]['building_name'], notes[4]['phase_name'], notes[4]['filename']),
+            ('Building 1', 'Frame', 'scan 4.pdf'),
+        )
+
+
+@skipUnless(connection.vendor == 'postgresql', 'EXPLAIN plans are PostgreSQL specific')
+class HotQueryPlanTests(TestCase):
+
+    def setUp(self):
+        self.cursor = connection.cursor()
+        self.addCleanup(self.cursor.close)
+        # As in explain_hot_queries: a near-empty test table would make a sequential scan the cheapest plan
+        self.cursor.execute("SET LOCAL enable_seqscan = off")
+
+    def test_hot_queries_use_their_indexes(self):
+        for name, queryset, index in hot_queries():
+            with self.subTest(name):
+                plan, problem = check_plan(self.cursor, queryset, index)
+                self.assertIsNone(problem, plan)
+
+    def test_a_dropped_index_is_noticed(self):
+        name, queryset, index = next(query for query in hot_queries() if query[2] == 'deliverynote_ref_item_idx')
+        self.cursor.execute(f"DROP INDEX {index}")
+
+        plan, problem = check_plan(self.cursor, queryset, index)
+
+        self.assertEqual(problem, f"does not use {index}", plan)
+
+
+def grouped_note_counts(customer_ref, today):
+    """getCount's note counters as it used to compute them, one grouped query each."""
+    def notes(lines):
+        return lines.filter(customer_ref=customer_ref).values('delivery_note_ref_no').annotate(total_count=Count('id')).count()
+
+    def days(first, last):
+        return BestMatch.objects.filter(entry_time__date__range=[first, last])
+
+    first_day_this_month = today.replace(day=1)
+    last_day_last_month = first_day_this_month - timedelta(days=1)
+    return {
+        "total_delivery_notes_uploaded_last_month": notes(days(last_day_last_month.replace(day=1), last_day_last_month)),
+        "total_delivery_notes_uploaded_this_month": notes(days(first_day_this_month, today)),
+        "total_delivery_notes_uploaded_this_year": notes(days(today.replace(month=1, day=1), today)),
+        "total_delivery_notes_uploaded_through_web": notes(BestMatch.objects.filter(account_number='W')),
+        "total_delivery_notes_uploaded_through_mobile": notes(BestMatch.objects.exclude(account_number='W')),
+    }
+
+
+class DashboardCountTests(TestCase):
+
+    def test_the_single_aggregate_matches_the_grouped_counts(self):
+        today = datetime.now().date()
+        first_day_this_month = datetime.combine(today.replace(day=1), datetime.min.time())
+        first_day_last_month = datetime.combine((first_day_this_month - timedelta(days=1)).replace(day=1), datetime.min.time())
+        first_day_this_year = datetime.combine(today.replace(month=1, day=1), datetime.min.time())
+        # Each window's edges, and lines with no entry_time
+        entry_times = [None] + [timezone.make_aware(moment) for moment in (
+            datetime.combine(today, datetime.max.time()), datetime.combine(today, datetime.min.time()),
+            first_day_this_month, first_day_this_month - timedelta(microseconds=1),
+            first_day_last_month, first_day_last_month - timedelta(microseconds=1),
+            first_day_this_year, first_day_this_year - timedelta(microseconds=1),
+        )]
+        refs = ['DN1', 'DN2', None, 'DN3', 'DN1']
+        lines = []
+        for i, (entry_time, account_number) in enumerate(itertools.product(entry_times, ['W', 'M', None])):
+            for customer_ref in ['101', '202']:
+                lines.append(BestMatch(customer_ref=customer_ref, entry_time=entry_time, account_number=account_number,
+                                       delivery_note_ref_no=refs[i % len(refs)], item_no=i))
+        BestMatch.objects.bulk_create(lines)
+        # Only NULL-ref lines in a window still count as one note
+        BestMatch.objects.create(customer_ref='303', entry_time=entry_times[1], account_number=None, item_no=1)
+
+        for customer_ref in ['101', '202', '303', '404']:
+            with self.subTest(customer_ref):
+                counts = getCount().counts(customer_ref)
+                self.assertEqual({name: counts[name] for name in getCount.windows(today)},
+                                 grouped_note_counts(customer_ref, today))
+
+
+@skipUnless(connection.vendor == 'postgresql', 'change log ids only come from a sequence on PostgreSQL')
+class ChangeLogIdTests(UnmanagedTablesMixin, TransactionTestCase):
+    unmanaged_models = [AppDeliveryNoteChangeLog]
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        # The production table's id has no default; here it would come with a serial of the sequence's name
+        with connection.cursor() as cursor:
+            cursor.execute("ALTER TABLE app_deliverynote_change_log ALTER COLUMN id DROP DEFAULT")
+
+    def setUp(self):
+        self.reset_sequence()
+        self.addCleanup(self.reset_sequence)
+
+    def reset_sequence(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f"DROP SEQUENCE IF EXISTS {line_edits.CHANGE_LOG_SEQUENCE}")
+        line_edits._sequence_ready = False
+
+    def entry(self, entry_id):
+        return AppDeliveryNoteChangeLog(
+            id=entry_id, delivery_note_ref_no='DN1', item_id='1', product_description='Concrete', unit_of_measure='m3',
+            revised_product_description='Timber', revised_unit_of_measure='m3', customer_ref_no='C1',
+        )
+
+    def test_concurrent_writers_never_get_the_same_id(self):
+        # Written before the sequence existed, e.g. by the old max(id) + 1 scheme
+        AppDeliveryNoteChangeLog.objects.bulk_create([self.entry(500)])
+        threads = 8
+        start = threading.Barrier(threads)
+        allocated = []
+        errors = []
+        lock = threading.Lock()
+
+        def write():
+            try:
+                # Every thread races to create and set up the sequence on its first call
+                start.wait(5)
+                for _ in range(25):
+                    with transaction.atomic():
+                        ids = line_edits.next_change_log_ids(4)
+                        AppDeliveryNoteChangeLog.objects.bulk_create([self.entry(entry_id) for entry_id in ids])
+                    with lock:
+                        allocated.extend(ids)
+            except Exception as e:
+                with lock:
+                    errors.append(e)
+            finally:
+                connection.close()
+
+        workers = [threading.Thread(target=write) for _ in range(threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(len(allocated), threads * 25 * 4)
+        self.assertEqual(len(set(allocated)), len(allocated))
+        self.assertGreater(min(allocated), 500)
+        self.assertEqual(AppDeliveryNoteChangeLog.objects.count(), len(allocated) + 1)
+
+
+@skipUnless(connection.vendor == 'postgresql', 'full-text search is PostgreSQL only')
+class InvoiceSearchTriggerTests(TestCase):
+
+    def test_renaming_a_phase_updates_its_rows_search_vectors(self):
+        phase = Phase.objects.create(name='Groundworks')
+        other = Phase.objects.create(name='Groundworks extra')
+        invoice = InvoiceData.objects.create(material_name='Concrete', product_description='Ready-mix', phase_name=phase)
+        InvoiceData.objects.create(material_name='Steel', product_description='Rebar', phase_name=other)
+
+        phase.name = 'Substructure'
+        phase.save()
+
+        self.assertEqual(list(search(InvoiceData.objects.all(), ['substructure'])), [invoice])
+        self.assertEqual(search(InvoiceData.objects.all(), ['groundworks']).count(), 1)
+
+
+class CarbonSummaryMaintenanceTests(TestCase):
+    """carbon_summary as moved by the InvoiceData save/delete signals, against a full rebuild."""
+
+    def summary(self):
+        return sorted(CarbonSummary.objects.values_list(
+            'key', 'customer_ref', 'region_name', 'city_name', 'building_name', 'phase_name_id', 'material_name',
+            'data_source', 'month', 'kgco2', 'kgco2_count', 'row_count',
+        ))
+
+    def assertSummaryRebuilt(self):
+        maintained = self.summary()
+        rebuild_carbon_summary()
+        self.assertEqual(maintained, self.summary())
+
+    def test_saves_moves_and_deletes_keep_the_summary_exact(self):
+        phase = Phase.objects.create(name='Frame')
+        day = timezone.now().date()
+        moved = InvoiceData.objects.create(customer_ref=101, building_name='Library', phase_name=phase,
+                                           material_name='Concrete', kgco2=10, entry_time=day)
+        InvoiceData.objects.create(customer_ref=101, building_name='Library', phase_name=phase,
+                                   material_name='Concrete', kgco2=5, entry_time=day)
+        unfigured = InvoiceData.objects.create(customer_ref=None, building_name=None, material_name='Steel', kgco2=None)
+        self.assertSummaryRebuilt()
+
+        moved.customer_ref = 202
+        moved.building_name = 'School'
+        moved.entry_time = day - timedelta(days=40)
+        moved.save()
+        self.assertSummaryRebuilt()
+
+        unfigured.kgco2 = 7
+        unfigured.save()
+        self.assertSummaryRebuilt()
+
+        moved.delete()
+        self.assertSummaryRebuilt()
+        unfigured.delete()
+        self.assertSummaryRebuilt()
+        self.assertEqual([(row[1], row[4], row[9], row[11]) for row in self.summary()], [(101, 'Library', 5, 1)])
+
+
+class CarbonSummaryDeployTests(TestCase):
+
+    def test_migrate_fills_an_empty_summary_from_invoice_data(self):
+        # bulk_create sends no signals, like rows written before the summary existed
+        InvoiceData.objects.bulk_create([
+            InvoiceData(customer_ref=7, material_name='Concrete', kgco2=10, entry_time=timezone.now().date()),
+            InvoiceData(customer_ref=7, material_name='Concrete', kgco2=5, entry_time=timezone.now().date()),
+        ])
+        self.assertFalse(CarbonSummary.objects.exists())
+
+        fill_carbon_summary(sender=apps.get_app_config('app'))
+
+        summary = CarbonSummary.objects.get()
+        self.assertEqual((summary.customer_ref, summary.kgco2, summary.row_count), (7, 15, 2))
+
+
+class OptionsCacheTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+
+    def test_invalidate_retires_every_cached_payload(self):
+        options_cache.set('example.com', None, None, {'regions': ['London']})
+        options_cache.set('example.com', 'London', 'Camden', {'buildings': ['Library']})
+        self.assertEqual(options_cache.get('example.com'), {'regions': ['London']})
+
+        options_cache.invalidate()
+
+        self.assertIsNone(options_cache.get('example.com'))
+        self.assertIsNone(options_cache.get('example.com', 'London', 'Camden'))
+
+    def test_saving_a_region_invalidates_this_process_cache(self):
+        options_cache.set('example.com', None, None, {'regions': ['London']})
+        country = Country.objects.create(name='UK')
+        self.assertIsNone(options_cache.get('example.com'))
+
+        options_cache.set('example.com', None, None, {'regions': []})
+        Region.objects.create(name='London', country=country)
+        self.assertIsNone(options_cache.get('example.com'))
+
+
+class BulkEditLinesTests(UnmanagedTablesMixin, TestCase):
+    unmanaged_models = [ProductMapping, AppDeliveryNoteChangeLog, Unit_of_Measure]
+
+    def setUp(self):
+        line_edits._sequence_ready = False
+        self.line = BestMatch.objects.create(product_description='Ready-mix', unit_of_measure='m3', quantity=10,
+                                             delivery_note_ref_no='1001', item_no=1, error_code=0)
+
+    def test_keys_match_the_stored_column_types(self):
+        results = line_edits.bulk_edit_lines([
+            {"delivery_note_ref_no": 1001, "item_no": "01", "revised_quantity": "12"},
+            {"delivery_note_ref_no": "1001", "item_no": 1.0, "revised_quantity": "12"},
+            {"delivery_note_ref_no": "1001", "item_no": 1.5, "revised_quantity": "12"},
+            {"delivery_note_ref_no": "1001", "item_no": "one", "revised_quantity": "12"},
+        ])
+
+        self.assertEqual([result["status"] for result in results], [200, 200, 404, 404])
+        self.line.refresh_from_db()
+        self.assertEqual(self.line.revised_quantity, 12)
+
+    def test_unparseable_quantity_reports_the_carbon_error_code(self):
+        result, = line_edits.bulk_edit_lines([{"delivery_note_ref_no": "1001", "item_no": 1, "revised_quantity": "lots"}])
+
+        self.assertEqual((result["status"], result["error_code"]), (200, ERROR_QUANTITY))
+
+    def test_a_line_the_writes_would_reject_only_fails_itself(self):
+        Unit_of_Measure.objects.create(name='m3')
+        units_cache.invalidate()
+        BestMatch.objects.filter(id=self.line.id).update(customer_ref='101')
+        for item_no, customer_ref in [(2, '101'), (3, None), (4, '101'), (5, '101')]:
+            BestMatch.objects.create(product_description='Rebar', unit_of_measure='t', quantity=1, customer_ref=customer_ref,
+                                     delivery_note_ref_no='1001', item_no=item_no, error_code=0)
+
+        results = line_edits.bulk_edit_lines([
+            {"delivery_note_ref_no": "1001", "item_no": 1, "revised_product_description": "Ready-mix C32/40",
+             "revised_unit_of_measure": "m3", "revised_user_id": "reviewer@example.com"},
+            {"delivery_note_ref_no": "1001", "item_no": 2, "revised_phase_id": "Frame"},
+            # Not matched yet, so there is no customer_ref for the product mapping
+            {"delivery_note_ref_no": "1001", "item_no": 3, "revised_product_description": "Rebar B500B",
+             "revised_user_id": "reviewer@example.com"},
+            {"delivery_note_ref_no": "1001", "item_no": 4, "revised_quantity": "2"},
+            # Passes the checks but fails in the database: the change log's revised_unit_of_measure is NOT NULL
+            {"delivery_note_ref_no": "1001", "item_no": 5, "revised_product_description": "Rebar B500C",
+             "revised_user_id": "reviewer@example.com"},
+        ])
+
+        self.assertEqual([result["status"] for result in results], [200, 400, 400, 200, 500])
+        self.assertEqual(results[1]["error"], "revised_phase_id must be an integer")
+        self.assertEqual(list(ProductMapping.objects.values_list('customer_ref', 'mapped_product_description')),
+                         [('101', 'Ready-mix C32/40')])
+        self.assertEqual(list(AppDeliveryNoteChangeLog.objects.values_list('item_id', flat=True)), ['1'])
+        self.assertEqual(
+            sorted(BestMatch.objects.filter(revised_user_id__isnull=False).values_list('item_no', flat=True)), [1],
+        )
+        self.assertEqual(BestMatch.objects.get(item_no=4).revised_quantity, 2)
+        self.assertIsNone(BestMatch.objects.get(item_no=5).revised_product_description)
+
+
+class InvoiceDataPagingTests(UnmanagedTablesMixin, TestCase):
+    unmanaged_models = [Users]
+
+    def setUp(self):
+        Users.objects.create(User_ID='buyer@example.com', verification_status='verified', customer_ref='101')
+        day = timezone.now().date()
+        # NULL dates and runs of equal dates, interleaved by id, are where a keyset can skip or repeat rows
+        for i, entry_time in enumerate([None, day, day, None, day - timedelta(days=1), day, None, day, day - timedelta(days=1)]):
+            InvoiceData.objects.create(customer_ref=101, material_name='Concrete', product_description=f'Concrete {i}',
+                                       entry_time=entry_time, kgco2=i)
+        InvoiceData.objects.create(customer_ref=202, material_name='Concrete', entry_time=day, kgco2=1)
+        self.client = APIClient()
+
+    def pages(self, params):
+        ids = []
+        cursor = None
+        while True:
+            response = self.client.get('/api/search/results/', {**params, 'page_size': 2, **({'cursor': cursor} if cursor else {})})
+            self.assertEqual(response.status_code, 200)
+            ids += [row['id'] for row in response.data['results']]
+            cursor = response.data['next_cursor']
+            if cursor is None:
+                return ids
+
+    def test_pages_cover_every_row_once_in_date_order(self):
+        expected = list(
+            InvoiceData.objects.filter(customer_ref=101)
+            .order_by(F('entry_time').asc(nulls_last=True), 'id').values_list('id', flat=True)
+        )
+
+        self.assertEqual(self.pages({'email': 'buyer@example.com'}), expected)
+
+    @skipUnless(connection.vendor == 'postgresql', 'full-text search is PostgreSQL only')
+    def test_search_pages_follow_the_rank_cursor(self):
+        InvoiceData.objects.create(customer_ref=101, material_name='Concrete', product_description='Concrete concrete concrete')
+        expected = list(
+            search(InvoiceData.objects.filter(customer_ref=101), ['concrete'])
+            .order_by('-search_rank', 'id').values_list('id', flat=True)
+        )
+
+        ids = self.pages({'email': 'buyer@example.com', 'search': 'concrete'})
+
+        self.assertEqual(ids, expected)
+        self.assertEqual(len(ids), 10)
+
+    def test_tampered_or_foreign_cursors_are_rejected(self):
+        def encoded(position):
+            return base64.urlsafe_b64encode(json.dumps(position).encode()).decode()
+
+        for cursor in ['not a cursor', encoded(['x']), encoded({'entry_time': 'yesterday', 'id': 1}),
+                       encoded({'entry_time': 5, 'id': 1}), encoded({'rank': 0.5, 'id': 1}), encoded({'entry_time': None, 'id': 'x'})]:
+            with self.subTest(cursor):
+                response = self.client.get('/api/search/results/', {'email': 'buyer@example.com', 'cursor': cursor})
+                self.assertEqual(response.status_code, 400)
+                self.assertIn('cursor', response.data)
+
+    def test_exports_hold_the_same_rows_as_the_pages(self):
+        ids = self.pages({'email': 'buyer@example.com'})
+
+        ndjson = self.client.get('/api/search/results/', {'email': 'buyer@example.com', 'export': 'ndjson'})
+        rows = [json.loads(line) for line in b''.join(ndjson.streaming_content).decode().splitlines()]
+        self.assertEqual([row['id'] for row in rows], ids)
+        self.assertEqual(rows[0], self.client.get('/api/search/results/', {'email': 'buyer@example.com'}).json()['results'][0])
+
+        exported = self.client.get('/api/search/results/', {'email': 'buyer@example.com', 'export': 'csv'})
+        lines = list(csv.DictReader(io.StringIO(b''.join(exported.streaming_content).decode())))
+        self.assertEqual([int(line['id']) for line in lines], ids)
+        self.assertEqual(lines[0]['product_description'], rows[0]['product_description'])
+
+    def test_ordering_parameter_is_ignored(self):
+        self.assertEqual(self.pages({'email': 'buyer@example.com', 'ordering': '-kgco2'}),
+                         self.pages({'email': 'buyer@example.com'}))
+
+
+def per_level_rollup(queryset):
+    """InvoiceDataView's totals as it computed them before carbon_rollup(): one Sum() per level and group."""
+    def totals(rows, column):
+        return list(rows.values(column).annotate(total_kgco2=Sum('kgco2')).order_by(column))
+
+    overall = queryset.aggregate(total_kgco2=Sum('kgco2'))
+    estimate = queryset.filter(data_source='EPD').aggregate(total=Sum('kgco2'))['total'] or 0
+    actual = queryset.filter(data_source='Average').aggregate(total=Sum('kgco2'))['total'] or 0
+    total = overall['total_kgco2'] or 0
+    nested = []
+    for region in queryset.values_list('region_name', flat=True).distinct().order_by('region_name'):
+        in_region = queryset.filter(region_name=region)
+        cities = []
+        for city in in_region.values_list('city_name', flat=True).distinct().order_by('city_name'):
+            in_city = in_region.filter(city_name=city)
+            buildings = []
+            for building in in_city.values_list('building_name', flat=True).distinct().order_by('building_name'):
+                in_building = in_city.filter(building_name=building)
+                buildings.append({
+                    'building_name': building,
+                    'total_kgco2': in_building.aggregate(total=Sum('kgco2'))['total'],
+                    'phases': totals(in_building, 'phase_name__name'),
+                })
+            cities.append({'city_name': city, 'total_kgco2': in_city.aggregate(total=Sum('kgco2'))['total'], 'buildings': buildings})
+        nested.append({'region_name': region, 'total_kgco2': in_region.aggregate(total=Sum('kgco2'))['total'], 'cities': cities})
+    return {
+        'overall_aggregates': overall,
+        'material_name_aggregates': totals(queryset, 'material_name'),
+        'carbon_status_totals': {'estimate': {'total_kgco2': estimate}, 'actual': {'total_kgco2': actual}},
+        'carbon_status_percentage': {
+            'EPD': estimate / total * 100 if total > 0 else 0,
+            'average': actual / total * 100 if total > 0 else 0,
+        },
+        'region_aggregates': totals(queryset, 'region_name'),
+        'city_aggregates': totals(queryset, 'city_name'),
+        'building_aggregates': totals(queryset, 'building_name'),
+        'nested_structure': nested,
+    }
+
+
+@skipUnless(connection.vendor == 'postgresql', 'GROUPING SETS are PostgreSQL only here')
+class CarbonRollupTests(TestCase):
+
+    def invoices(self, buildings):
+        frame = Phase.objects.create(name='Frame')
+        fit_out = Phase.objects.create(name='Fit-out')
+        rows = []
+        for i in range(buildings):
+            for phase, source, kgco2 in [(frame, 'EPD', 10 + i), (fit_out, 'Average', 5), (None, None, None)]:
+                rows.append(InvoiceData(
+                    customer_ref=None if i % 4 == 3 else 101, material_name=f'Material {i % 3}', kgco2=kgco2,
+                    region_name=None if i % 5 == 4 else f'Region {i % 2}', city_name=f'City {i % 3}',
+                    building_name=None if i % 3 == 2 else f'Building {i}', phase_name=phase, data_source=source,
+                ))
+        InvoiceData.objects.bulk_create(rows)
+
+    def test_matches_the_per_level_aggregates(self):
+        self.invoices(12)
+
+        for label, queryset in [
+            ('everyone', InvoiceData.objects.all()),
+            ('one customer', InvoiceData.objects.filter(customer_ref=101)),
+            ('no customer', InvoiceData.objects.filter(customer_ref__isnull=True)),
+            ('no rows', InvoiceData.objects.none()),
+        ]:
+            with self.subTest(label):
+                self.assertEqual(carbon_rollup(queryset), per_level_rollup(queryset))
+
+    def test_summary_rollup_matches_the_raw_rows(self):
+        self.invoices(12)
+        rebuild_carbon_summary()
+
+        self.assertEqual(summary_rollup(), carbon_rollup(InvoiceData.objects.all()))
+        self.assertEqual(summary_rollup(101), carbon_rollup(InvoiceData.objects.filter(customer_ref=101)))
+
+    def test_one_query_however_many_buildings(self):
+        for buildings in (2, 40):
+            InvoiceData.objects.all().delete()
+            self.invoices(buildings)
+            with self.assertNumQueries(1):
+                carbon_rollup(InvoiceData.objects.filter(customer_ref=101))
@@ -0,0 +1,178 @@
+import logging
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+_client = None
+_lock = threading.Lock()
+
+
+class CircuitOpenError(requests.RequestException):
+    """Raised instead of calling BEST while the circuit breaker is open."""
+
+
+class CircuitBreaker:
+    """
+    Opens after `failure_threshold` consecutive failures and rejects calls for
+    `reset_timeout` seconds. After that a single trial call is let through;
+    its outcome closes the circuit again or re-opens it.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_flight = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at < self.reset_timeout or self.trial_in_flight:
+                return False
+            self.trial_in_flight = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self.trial_in_flight = False
+            if self.opened_at is not None or self.failures >= self.failure_threshold:
+                if self.opened_at is None:
+                    logger.error(f"BEST circuit opened after {self.failures} consecutive failures")
+                self.opened_at = time.monotonic()
+
+
+class BestClient:
+    """
+    Thread-safe client for the BEST API.
+
+    One requests.Session with a keep-alive pool sized to `max_in_flight` is
+    shared by every caller, and a semaphore caps concurrent requests at the
+    same number. Each request has connect/read timeouts and is retried on
+    connection errors, 429 and 5xx with jittered exponential backoff
+    (honouring Retry-After). Failures feed a CircuitBreaker.
+    """
+
+    def __init__(self, base_url, max_in_flight=8, timeout=(5, 60), max_retries=3,
+                 backoff_base=0.5, backoff_max=30, breaker=None):
+        self.base_url = base_url.rstrip('/') if base_url else ''
+        self.max_in_flight = max_in_flight
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.breaker = breaker or CircuitBreaker()
+        self._slots = threading.BoundedSemaphore(max_in_flight)
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_in_flight)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def url(self, path):
+        return path if path.startswith(('http://', 'https://')) else self.base_url + path
+
+    def backoff(self, attempt, response=None):
+        retry_after = response.headers.get('Retry-After') if response is not None else None
+        if retry_after and retry_after.isdigit():
+            return min(float(retry_after), self.backoff_max)
+        # Full jitter: uniform over [0, base * 2^attempt]
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    def request(self, method, path, **kwargs):
+        """
+        Send one request, retrying transient failures. Returns the last
+        response (callers check status_code as before) or raises
+        requests.RequestException once retries are exhausted.
+        """
+        kwargs.setdefault('timeout', self.timeout)
+        url = self.url(path)
+        attempt = 0
+        while True:
+            if not self.breaker.allow():
+                raise CircuitOpenError(f"BEST circuit open, not calling {url}")
+            response = None
+            try:
+                with self._slots:
+                    response = self.session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                self.breaker.record_failure()
+                if attempt >= self.max_retries:
+                    raise
+                logger.warning(f"BEST {method} {url} failed ({e}), retry {attempt + 1}/{self.max_retries}")
+            else:
+                if response.status_code not in RETRY_STATUSES:
+                    self.breaker.record_success()
+                    return response
+                self.breaker.record_failure()
+                if attempt >= self.max_retries:
+                    return response
+                logger.warning(f"BEST {method} {url} returned {response.status_code}, retry {attempt + 1}/{self.max_retries}")
+            time.sleep(self.backoff(attempt, response))
+            attempt += 1
+
+    def get(self, path, **kwargs):
+        return self.request('GET', path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request('POST', path, **kwargs)
+
+    def post_many(self, path, payloads, **kwargs):
+        """
+        POST each JSON payload concurrently (at most max_in_flight at once).
+        Returns a list aligned with `payloads` holding a Response or the
+        RequestException that request ended with.
+        """
+        def send(payload):
+            try:
+                return self.post(path, json=payload, **kwargs)
+            except requests.RequestException as e:
+                return e
+
+        if len(payloads) <= 1:
+            return [send(payload) for payload in payloads]
+        with ThreadPoolExecutor(max_workers=min(self.max_in_flight, len(payloads))) as pool:
+            return list(pool.map(send, payloads))
+
+
+def get_best_client():
+    """Return the process-wide BestClient, built from settings on first use."""
+    global _client
+    if _client is None:
+        with _lock:
+            if _client is None:
+                _client = BestClient(
+                    os.getenv("API_BASE_URL"),
+                    max_in_flight=getattr(settings, "BEST_API_MAX_IN_FLIGHT", 8),
+                    timeout=(
+                        getattr(settings, "BEST_API_CONNECT_TIMEOUT", 5),
+                        getattr(settings, "BEST_API_READ_TIMEOUT", 60),
+                    ),
+                    max_retries=getattr(settings, "BEST_API_MAX_RETRIES", 3),
+                    backoff_base=getattr(settings, "BEST_API_BACKOFF_BASE", 0.5),
+                    backoff_max=getattr(settings, "BEST_API_BACKOFF_MAX", 30),
+                    breaker=CircuitBreaker(
+                        failure_threshold=getattr(settings, "BEST_API_BREAKER_THRESHOLD", 5),
+                        reset_timeout=getattr(settings, "BEST_API_BREAKER_RESET", 30),
+                    ),
+                )
+    return _client
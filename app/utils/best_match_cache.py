@@ -0,0 +1,148 @@
+import logging
+import re
+import threading
+import time
+from collections import Counter, defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Q, Sum
+from django.utils import timezone
+
+from app.models import BestMatchCache
+
+logger = logging.getLogger(__name__)
+
+_whitespace = re.compile(r"\s+")
+
+
+def normalise(text):
+    return _whitespace.sub(" ", (text or "").strip()).lower()
+
+
+def cache_key(product_description, delivery_country):
+    """'Concrete  - Insitu - UK C32/40' / 'UK' and 'concrete - insitu - uk c32/40' / 'uk' share a key."""
+    return normalise(product_description) + "|" + normalise(delivery_country)
+
+
+class BestMatchResultCache:
+    """
+    Persistent BEST match results in front of the API, one row per
+    cache_key(). Entries older than BEST_MATCH_CACHE_TTL or written under a
+    different BEST_MATCH_CACHE_VERSION are treated as misses, so bumping the
+    version drops everything without a table scan.
+
+    Hits and misses are counted in process (stats()). Hits are also added to
+    the rows' hit_count, so table_stats() shows how many input items never
+    had to be sent; they are buffered and written by flush_hits() at most
+    every BEST_MATCH_CACHE_HIT_FLUSH_INTERVAL seconds rather than with an
+    UPDATE per lookup, so a process that dies loses up to that much of the
+    count.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self._pending_hits = Counter()
+        self._flushed_at = time.monotonic()
+
+    @property
+    def version(self):
+        return getattr(settings, "BEST_MATCH_CACHE_VERSION", 1)
+
+    @property
+    def ttl(self):
+        return timedelta(seconds=getattr(settings, "BEST_MATCH_CACHE_TTL", 7 * 24 * 3600))
+
+    @property
+    def hit_flush_interval(self):
+        return getattr(settings, "BEST_MATCH_CACHE_HIT_FLUSH_INTERVAL", 60)
+
+    def get_many(self, keys):
+        """Return {key: result} for the live entries among `keys` (one query; the hits are counted in flush_hits())."""
+        found = dict(
+            BestMatchCache.objects
+            .filter(key__in=keys, version=self.version, expires_at__gt=timezone.now())
+            .values_list("key", "result")
+        )
+        with self._lock:
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+            self._pending_hits.update(found.keys())
+            due = time.monotonic() - self._flushed_at >= self.hit_flush_interval
+        if due:
+            self.flush_hits()
+        return found
+
+    def flush_hits(self):
+        """Add the hits buffered since the last flush to hit_count, one UPDATE per distinct count."""
+        with self._lock:
+            pending, self._pending_hits = self._pending_hits, Counter()
+            self._flushed_at = time.monotonic()
+        keys_by_count = defaultdict(list)
+        for key, count in pending.items():
+            keys_by_count[count].append(key)
+        for count, keys in keys_by_count.items():
+            BestMatchCache.objects.filter(key__in=keys).update(hit_count=F("hit_count") + count)
+
+    def set_many(self, entries):
+        """Store {key: (product_description, delivery_country, result)}, replacing stale rows."""
+        if not entries:
+            return
+        now = timezone.now()
+        with transaction.atomic():
+            stale = BestMatchCache.objects.filter(key__in=list(entries))
+            # Refetched entries keep their hit history
+            hit_counts = dict(stale.values_list("key", "hit_count"))
+            stale.delete()
+            BestMatchCache.objects.bulk_create([
+                BestMatchCache(
+                    key=key,
+                    product_description=product_description,
+                    delivery_country=delivery_country,
+                    result=result,
+                    version=self.version,
+                    fetched_at=now,
+                    expires_at=now + self.ttl,
+                    hit_count=hit_counts.get(key, 0),
+                )
+                for key, (product_description, delivery_country, result) in entries.items()
+            ], ignore_conflicts=True)
+
+    def invalidate_descriptions(self, *descriptions):
+        """Drop the entries for these product descriptions in every country."""
+        prefixes = {normalise(description) + "|" for description in descriptions if description}
+        if not prefixes:
+            return 0
+        matches = Q()
+        for prefix in prefixes:
+            matches |= Q(key__startswith=prefix)
+        return BestMatchCache.objects.filter(matches).delete()[0]
+
+    def purge_expired(self):
+        stale = BestMatchCache.objects.filter(expires_at__lte=timezone.now()) | BestMatchCache.objects.exclude(version=self.version)
+        return stale.delete()[0]
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+            }
+
+    def table_stats(self):
+        self.flush_hits()
+        now = timezone.now()
+        live = BestMatchCache.objects.filter(version=self.version, expires_at__gt=now)
+        return {
+            "entries": BestMatchCache.objects.count(),
+            "live_entries": live.count(),
+            "api_items_saved": BestMatchCache.objects.aggregate(total=Sum("hit_count"))["total"] or 0,
+        }
+
+
+best_match_cache = BestMatchResultCache()
@@ -0,0 +1,147 @@
+import copy
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# What BEST answers for an input item, trimmed to the fields BestMatchEnricher reads
+STUB_RESULT = {
+    'best_product': {
+        'product_name': 'Stub product',
+        'product_company_name': 'Stub Ltd',
+        'product_match_score': 0.9,
+        'product_data': {
+            'material_facts': {
+                'global_warming_potential_fossil': {'A1A2A3': 250.0},
+                'declared_unit': 'm3',
+                'scaling_factors': {'m3': {'value': 1.0}, 'tonnes': {'value': 2.4}},
+                'data_source': 'EPD',
+            },
+        },
+    },
+    'best_material': {'material_data': {}},
+    'classification': {'material_type': 'Concrete'},
+    'quantity_info': {},
+}
+
+
+class StubTokenManager:
+    """Hands out a fixed token, for BestMatchEnricher runs against BestStubServer."""
+
+    def get_token(self):
+        return "stub-token"
+
+    def invalidate(self, token):
+        pass
+
+
+class BestStubServer:
+    """
+    A local stand-in for the BEST API, for tests and benchmarks.
+
+    POST /get_best_match/ answers every input item with `result` after
+    `latency` seconds, except items listed in `no_match` (left out of the
+    results, as BEST does when nothing matches). fail(status, count) makes
+    the next `count` requests (all of them when None) answer `status`
+    instead. The server counts requests and input items and records the
+    peak number of requests in flight.
+
+        with BestStubServer(latency=0.05) as stub:
+            client = BestClient(stub.url)
+    """
+
+    def __init__(self, latency=0.0, result=None):
+        self.latency = latency
+        self.result = result or STUB_RESULT
+        self.no_match = set()
+        self.requests = 0
+        self.items = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._failures = []
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def fail(self, status=503, count=None):
+        with self._lock:
+            self._failures = [(status, count)]
+
+    def recover(self):
+        with self._lock:
+            self._failures = []
+
+    def _next_failure(self):
+        with self._lock:
+            if not self._failures:
+                return None
+            status, count = self._failures[0]
+            if count is not None:
+                if count <= 1:
+                    self._failures = []
+                else:
+                    self._failures[0] = (status, count - 1)
+            return status
+
+    def _answer(self, payload):
+        items = payload.get('input_items', [])
+        with self._lock:
+            self.items += len(items)
+        return {'results': {item: copy.deepcopy(self.result) for item in items if item not in self.no_match}}
+
+    def start(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                with stub._lock:
+                    stub.requests += 1
+                    stub.in_flight += 1
+                    stub.max_in_flight = max(stub.max_in_flight, stub.in_flight)
+                try:
+                    if stub.latency:
+                        time.sleep(stub.latency)
+                    status = stub._next_failure()
+                    if status is None:
+                        status, answer = 200, stub._answer(json.loads(body or b'{}'))
+                    else:
+                        answer = {'detail': 'stub failure'}
+                finally:
+                    with stub._lock:
+                        stub.in_flight -= 1
+                data = json.dumps(answer).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._thread.join()
+            self._server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
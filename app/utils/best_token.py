@@ -0,0 +1,115 @@
+import logging
+import os
+import threading
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+
+from app.models import BestAPIToken
+from app.utils.best_client import get_best_client
+
+logger = logging.getLogger(__name__)
+
+
+class BestTokenError(Exception):
+    """Raised when no BEST API token could be obtained."""
+
+
+class BestTokenManager:
+    """
+    Keeps the BEST API token in memory and refreshes it before it expires.
+
+    In the steady state get_token() is a memory read with no DB query.
+    Refreshes are single-flight: a thread lock serialises them inside the
+    process and, on PostgreSQL, a transaction-scoped advisory lock keyed on
+    best_token_table serialises them across processes. Whoever waited on the
+    lock re-reads the row first and adopts a token another process just
+    stored instead of fetching its own.
+    """
+
+    def __init__(self, client=None):
+        self._client = client
+        self._token = None
+        self._expires_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        return self._client or get_best_client()
+
+    @property
+    def refresh_margin(self):
+        return timedelta(seconds=getattr(settings, "BEST_TOKEN_REFRESH_MARGIN", 300))
+
+    def _is_fresh(self, token, expires_at):
+        return bool(token) and expires_at is not None and timezone.now() < expires_at - self.refresh_margin
+
+    def get_token(self):
+        if self._is_fresh(self._token, self._expires_at):
+            return self._token
+        with self._lock:
+            if not self._is_fresh(self._token, self._expires_at):
+                self._refresh()
+        return self._token
+
+    def invalidate(self, token):
+        """
+        Drop a token BEST rejected (401) so the next get_token() fetches a
+        new one; the stored row is expired too, or the refresh would just
+        adopt it again.
+        """
+        with self._lock:
+            if self._token == token:
+                self._token = None
+                self._expires_at = None
+        BestAPIToken.objects.filter(TokenValue=token).update(TokenExpiryTime=timezone.now())
+
+    def _refresh(self):
+        with transaction.atomic():
+            if connection.vendor == "postgresql":
+                with connection.cursor() as cursor:
+                    cursor.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", [BestAPIToken._meta.db_table])
+
+            record = BestAPIToken.objects.order_by("id").first()
+            if record is not None and self._is_fresh(record.TokenValue, record.TokenExpiryTime):
+                self._token, self._expires_at = record.TokenValue, record.TokenExpiryTime
+                return
+
+            token_data = None
+            if record is not None and record.RefreshToken:
+                token_data = self._request_token("/token/refresh/", json={"refresh": record.RefreshToken}, method="POST")
+            if token_data is None:
+                token_data = self._request_token(
+                    "/token/getapitoken/",
+                    headers={"Authorization": "Bearer " + os.getenv("DEVELOPER_TOKEN", "")},
+                )
+            if token_data is None or not token_data.get("api_token"):
+                raise BestTokenError("Error occured While Generating Token")
+
+            expires_at = timezone.now() + timedelta(seconds=getattr(settings, "BEST_TOKEN_LIFETIME", 24 * 3600))
+            if record is None:
+                record = BestAPIToken()
+            record.TokenName = "BEST ACCESS TOKEN"
+            record.TokenValue = token_data.get("api_token")
+            record.RefreshToken = token_data.get("refresh_token") or record.RefreshToken
+            record.TokenExpiryTime = expires_at
+            record.save()
+
+        self._token, self._expires_at = record.TokenValue, record.TokenExpiryTime
+        logger.info("BEST API token refreshed")
+
+    def _request_token(self, path, method="GET", **kwargs):
+        try:
+            response = self.client.request(method, path, **kwargs)
+        except Exception as e:
+            logger.error(f"BEST token request to {path} failed: {e}")
+            return None
+        if response.status_code != 200:
+            logger.error(f"BEST token request to {path} returned {response.status_code}")
+            return None
+        return response.json()
+
+
+best_token_manager = BestTokenManager()
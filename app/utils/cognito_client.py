@@ -0,0 +1,68 @@
+import threading
+
+import boto3
+from botocore.config import Config
+from botocore.stub import Stubber
+from django.conf import settings
+
+_client = None
+_stubber = None
+_lock = threading.Lock()
+
+
+def _build_client():
+    config = Config(
+        region_name=settings.AWS_COGNITO_REGION,
+        max_pool_connections=getattr(settings, "AWS_COGNITO_MAX_POOL_CONNECTIONS", 20),
+        tcp_keepalive=getattr(settings, "AWS_COGNITO_TCP_KEEPALIVE", True),
+        connect_timeout=getattr(settings, "AWS_COGNITO_CONNECT_TIMEOUT", 5),
+        read_timeout=getattr(settings, "AWS_COGNITO_READ_TIMEOUT", 10),
+        retries={
+            "max_attempts": getattr(settings, "AWS_COGNITO_MAX_ATTEMPTS", 3),
+            "mode": getattr(settings, "AWS_COGNITO_RETRY_MODE", "standard"),
+        },
+    )
+    if getattr(settings, "AWS_COGNITO_CLIENT_STUB", False):
+        # Dummy credentials so botocore never goes looking for real ones
+        session = boto3.session.Session(aws_access_key_id="stub", aws_secret_access_key="stub")
+    else:
+        # boto3's default session is not safe to share while creating clients
+        session = boto3.session.Session()
+    return session.client("cognito-idp", config=config)
+
+
+def get_cognito_client():
+    """
+    Return the process-wide cognito-idp client.
+
+    Building a client loads the service model and opens a fresh HTTPS pool,
+    so it is done once; botocore clients are thread safe to share. With
+    AWS_COGNITO_CLIENT_STUB enabled the client is wrapped in an active
+    botocore Stubber and never touches the network.
+    """
+    global _client, _stubber
+    if _client is None:
+        with _lock:
+            if _client is None:
+                client = _build_client()
+                if getattr(settings, "AWS_COGNITO_CLIENT_STUB", False):
+                    _stubber = Stubber(client)
+                    _stubber.activate()
+                _client = client
+    return _client
+
+
+def get_cognito_stubber():
+    """The Stubber behind the shared client in stub mode (None otherwise), for queuing responses."""
+    get_cognito_client()
+    return _stubber
+
+
+def reset_cognito_client():
+    """Drop the shared client so the next call rebuilds it, e.g. after changing settings."""
+    global _client, _stubber
+    with _lock:
+        if _stubber is not None:
+            _stubber.deactivate()
+        _client = None
+        _stubber = None
@@ -0,0 +1,128 @@
+import logging
+import threading
+import time
+
+import jwt
+import requests
+from django.conf import settings
+from jwt.algorithms import RSAAlgorithm
+
+logger = logging.getLogger(__name__)
+
+
+class TokenVerificationError(Exception):
+    """The token is malformed, badly signed, expired or meant for another client."""
+
+
+class JWKSUnavailableError(Exception):
+    """The user pool's signing keys could not be fetched."""
+
+
+def get_cognito_issuer():
+    return f"https://cognito-idp.{settings.AWS_COGNITO_REGION}.amazonaws.com/{settings.AWS_COGNITO_USER_POOL_ID}"
+
+
+def fetch_jwks(url):
+    response = requests.get(url, timeout=getattr(settings, "AWS_COGNITO_JWKS_TIMEOUT", 5))
+    response.raise_for_status()
+    return response.json()
+
+
+class CognitoJWKSCache:
+    """
+    Keeps the user pool's public keys in memory, keyed by kid.
+
+    Keys are refetched once the TTL expires, or when a token shows up signed
+    with a kid we have not seen (Cognito rotating keys). Kid-miss refetches are
+    rate limited so garbage tokens cannot hammer the JWKS endpoint. `fetcher`
+    can be swapped out, e.g. to serve a locally generated key set offline.
+    """
+
+    def __init__(self, jwks_url=None, fetcher=None):
+        self.jwks_url = jwks_url
+        self.fetcher = fetcher or fetch_jwks
+        self._keys = {}
+        self._fetched_at = None
+        self._lock = threading.Lock()
+
+    def get_jwks_url(self):
+        return self.jwks_url or f"{get_cognito_issuer()}/.well-known/jwks.json"
+
+    def load(self, jwks):
+        """Replace the cached keys with the given JWKS document."""
+        keys = {key["kid"]: RSAAlgorithm.from_jwk(key) for key in jwks.get("keys", [])}
+        with self._lock:
+            self._keys = keys
+            self._fetched_at = time.monotonic()
+
+    def clear(self):
+        with self._lock:
+            self._keys = {}
+            self._fetched_at = None
+
+    def get_key(self, kid):
+        with self._lock:
+            now = time.monotonic()
+            if self._fetched_at is None:
+                self._refresh(now)
+            else:
+                age = now - self._fetched_at
+                ttl = getattr(settings, "AWS_COGNITO_JWKS_TTL", 3600)
+                min_interval = getattr(settings, "AWS_COGNITO_JWKS_MIN_REFRESH_INTERVAL", 60)
+                if age > ttl or (kid not in self._keys and age > min_interval):
+                    self._refresh(now)
+            return self._keys.get(kid)
+
+    def _refresh(self, now):
+        try:
+            jwks = self.fetcher(self.get_jwks_url())
+            # Parsed here too: a malformed key set counts as a failed fetch, not a server error
+            keys = {key["kid"]: RSAAlgorithm.from_jwk(key) for key in jwks.get("keys", [])}
+        except (requests.RequestException, ValueError, KeyError, TypeError, AttributeError, jwt.PyJWTError) as e:
+            if not self._keys:
+                raise JWKSUnavailableError(f"Could not fetch Cognito JWKS: {e}")
+            # Keep serving the keys we already have until the endpoint is back.
+            logger.warning(f"Cognito JWKS refresh failed, using cached keys: {e}")
+            self._fetched_at = now
+            return
+        self._keys = keys
+        self._fetched_at = now
+
+
+jwks_cache = CognitoJWKSCache()
+
+
+def verify_access_token(token, cache=None):
+    """
+    Validate a Cognito access token locally and return its claims.
+
+    Checks the RS256 signature against the cached JWKS, expiry, issuer,
+    token_use and the app client id.
+    """
+    cache = cache or jwks_cache
+    try:
+        header = jwt.get_unverified_header(token)
+    except jwt.InvalidTokenError as e:
+        raise TokenVerificationError(f"Invalid token format: {str(e)}")
+
+    key = cache.get_key(header.get("kid"))
+    if key is None:
+        raise TokenVerificationError("Invalid token or expired token")
+
+    try:
+        claims = jwt.decode(
+            token,
+            key=key,
+            algorithms=["RS256"],
+            issuer=get_cognito_issuer(),
+            options={"require": ["exp", "iss", "token_use"]},
+            leeway=getattr(settings, "AWS_COGNITO_JWT_LEEWAY", 0),
+        )
+    except jwt.InvalidTokenError:
+        raise TokenVerificationError("Invalid token or expired token")
+
+    if claims.get("token_use") != "access":
+        raise TokenVerificationError("Token is not an access token")
+    if claims.get("client_id") != settings.AWS_COGNITO_APP_CLIENT_ID:
+        raise TokenVerificationError("Token was not issued for this app client")
+    return claims
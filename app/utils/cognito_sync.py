@@ -0,0 +1,168 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, connection, transaction
+from django.utils import timezone
+
+from app.models import CustomUser
+from app.utils.cognito_client import get_cognito_client
+
+logger = logging.getLogger(__name__)
+
+# One background thread runs the single-user syncs the middleware asks for
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='cognito-sync')
+_pending = set()
+_pending_lock = threading.Lock()
+
+
+def is_sync_stale(user):
+    """True when the user's Cognito attributes have not been copied recently."""
+    if user.cognito_synced_at is None:
+        return True
+    max_age = timedelta(seconds=getattr(settings, 'COGNITO_SYNC_MAX_AGE', 900))
+    return timezone.now() - user.cognito_synced_at > max_age
+
+
+def _email_verified(attributes):
+    return any(attr['Name'] == 'email_verified' and attr['Value'] == 'true' for attr in attributes)
+
+
+def sync_user(user, client=None):
+    """Copy email_verified for a single user, writing only the two synced columns."""
+    client = client or get_cognito_client()
+    try:
+        response = client.admin_get_user(
+            UserPoolId=settings.AWS_COGNITO_USER_POOL_ID,
+            Username=user.email
+        )
+    except client.exceptions.UserNotFoundException:
+        return
+    user.email_verified = _email_verified(response['UserAttributes'])
+    user.cognito_synced_at = timezone.now()
+    CustomUser.objects.filter(pk=user.pk).update(
+        email_verified=user.email_verified,
+        cognito_synced_at=user.cognito_synced_at
+    )
+
+
+def schedule_sync(user):
+    """
+    Queue sync_user() for `user` on the background thread and return at
+    once, so no request waits on Cognito. A user already queued is not
+    queued again; returns whether this call queued one.
+    """
+    with _pending_lock:
+        if user.pk in _pending:
+            return False
+        _pending.add(user.pk)
+    _executor.submit(_sync_in_background, user.pk)
+    return True
+
+
+def _sync_in_background(user_id):
+    try:
+        user = CustomUser.objects.filter(pk=user_id).first()
+        # Another worker or sync_cognito_users may have got there first
+        if user is not None and is_sync_stale(user):
+            sync_user(user)
+    except Exception:
+        logger.exception(f"Background Cognito sync failed for user {user_id}")
+    finally:
+        with _pending_lock:
+            _pending.discard(user_id)
+        connection.close()
+
+
+def _save_synced(user):
+    """
+    Write a user's synced columns on their own, leaving cognito_sub out if
+    another account has taken it in the meantime.
+    """
+    synced = CustomUser.objects.filter(pk=user.pk)
+    try:
+        with transaction.atomic():
+            synced.update(email_verified=user.email_verified, cognito_sub=user.cognito_sub,
+                          cognito_synced_at=user.cognito_synced_at)
+    except IntegrityError:
+        logger.warning(f"Cognito sub {user.cognito_sub} of {user.email} already belongs to another user; not copied")
+        synced.update(email_verified=user.email_verified, cognito_synced_at=user.cognito_synced_at)
+
+
+def sync_email_verified(client=None, page_size=60):
+    """
+    Page through the whole user pool and copy email_verified onto CustomUser,
+    filling in cognito_sub for users created before it was stored (so their
+    tokens can be matched locally).
+
+    Each Cognito page costs one SELECT (email__in), one more checking the
+    subs about to be filled in, one bulk_update for the rows whose flag
+    actually changed and one UPDATE stamping cognito_synced_at on the rest.
+    A sub another account already holds is logged and left out rather than
+    failing the sync, as cognito_sub is unique. Returns (users_checked,
+    users_updated).
+    """
+    client = client or get_cognito_client()
+    request_kwargs = {'UserPoolId': settings.AWS_COGNITO_USER_POOL_ID, 'Limit': page_size}
+    checked = 0
+    updated = 0
+
+    while True:
+        response = client.list_users(**request_kwargs)
+
+        verified_by_email = {}
+        sub_by_email = {}
+        for cognito_user in response['Users']:
+            attributes = cognito_user.get('Attributes', [])
+            email = next((attr['Value'] for attr in attributes if attr['Name'] == 'email'), None)
+            if email:
+                verified_by_email[email] = _email_verified(attributes)
+                sub_by_email[email] = next((attr['Value'] for attr in attributes if attr['Name'] == 'sub'), None)
+
+        synced_at = timezone.now()
+        changed = []
+        unchanged_ids = []
+        users = list(
+            CustomUser.objects.filter(email__in=list(verified_by_email)).only('id', 'email', 'email_verified', 'cognito_sub')
+        )
+        missing_subs = {sub_by_email[user.email] for user in users if sub_by_email[user.email] and not user.cognito_sub}
+        held_subs = set(
+            CustomUser.objects.filter(cognito_sub__in=missing_subs).values_list('cognito_sub', flat=True)
+        ) if missing_subs else set()
+        for user in users:
+            verified = verified_by_email[user.email]
+            sub = sub_by_email[user.email]
+            if sub in held_subs and not user.cognito_sub:
+                logger.warning(f"Cognito sub {sub} of {user.email} already belongs to another user; not copied")
+                sub = None
+            if user.email_verified != verified or (sub and not user.cognito_sub):
+                user.email_verified = verified
+                user.cognito_sub = user.cognito_sub or sub
+                user.cognito_synced_at = synced_at
+                changed.append(user)
+            else:
+                unchanged_ids.append(user.id)
+
+        if changed:
+            try:
+                with transaction.atomic():
+                    CustomUser.objects.bulk_update(changed, ['email_verified', 'cognito_sub', 'cognito_synced_at'])
+            except IntegrityError:
+                # A sub was claimed since the check above (remember_cognito_sub()); write the page row by row
+                for user in changed:
+                    _save_synced(user)
+        if unchanged_ids:
+            CustomUser.objects.filter(id__in=unchanged_ids).update(cognito_synced_at=synced_at)
+
+        checked += len(changed) + len(unchanged_ids)
+        updated += len(changed)
+
+        pagination_token = response.get('PaginationToken')
+        if not pagination_token:
+            break
+        request_kwargs['PaginationToken'] = pagination_token
+
+    logger.info(f"Cognito sync checked {checked} users, updated {updated}")
+    return checked, updated
@@ -0,0 +1,46 @@
+import hashlib
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+
+
+class OptionsCache:
+    """
+    GetOptionsAPI payloads in the Django cache, one entry per
+    (domain, region, city). Keys embed a generation token, so invalidate()
+    retires every entry at once by swapping the token instead of deleting
+    keys one by one.
+
+    The token lives in the same cache as the entries, so invalidate() only
+    reaches the processes sharing that cache. The project runs on the
+    default per-process backend (CACHES is not configured): a change is
+    seen at once by the worker that made it, and by every other worker once
+    its entries expire, within OPTIONS_CACHE_TTL. Point CACHES at a shared
+    backend for immediate invalidation everywhere.
+    """
+
+    GENERATION_KEY = 'options:generation'
+
+    @property
+    def ttl(self):
+        return getattr(settings, 'OPTIONS_CACHE_TTL', 300)
+
+    def _generation(self):
+        return cache.get_or_set(self.GENERATION_KEY, lambda: uuid.uuid4().hex, None)
+
+    def _key(self, domain, region, city):
+        params = hashlib.md5(repr((domain, region, city)).encode()).hexdigest()
+        return f"options:{self._generation()}:{params}"
+
+    def get(self, domain, region=None, city=None):
+        return cache.get(self._key(domain, region, city))
+
+    def set(self, domain, region, city, payload):
+        cache.set(self._key(domain, region, city), payload, self.ttl)
+
+    def invalidate(self):
+        cache.set(self.GENERATION_KEY, uuid.uuid4().hex, None)
+
+
+options_cache = OptionsCache()
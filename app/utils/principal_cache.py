@@ -0,0 +1,97 @@
+import copy
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+
+
+class Principal:
+    """What a validated token resolves to: the Django user and their customer_ref."""
+
+    def __init__(self, user, customer_ref=None):
+        self.user = user
+        self.customer_ref = customer_ref
+
+
+def hash_token(token):
+    # Raw tokens never sit in memory as keys
+    return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+
+class PrincipalCache:
+    """
+    In-process LRU cache of token hash -> Principal.
+
+    Entries expire after PRINCIPAL_CACHE_TTL, or earlier if the token itself
+    expires first. The cache is bounded; the least recently used entry is
+    dropped once it is full.
+
+    A cached user is a snapshot: saving or deleting the user in this process
+    evicts it (see app.signals), but a change made by another process, such
+    as is_active or is_staff being switched off, only shows once the entry
+    expires, so PRINCIPAL_CACHE_TTL is the longest that can go unnoticed.
+    Each get() hands out its own copy of the user, so one request changing
+    request.user can't affect another.
+    """
+
+    def __init__(self, max_size=None, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _max_size(self):
+        return self.max_size or getattr(settings, 'PRINCIPAL_CACHE_MAX_SIZE', 1024)
+
+    def _ttl(self):
+        return self.ttl or getattr(settings, 'PRINCIPAL_CACHE_TTL', 300)
+
+    def get(self, token):
+        key = hash_token(token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                principal, expires_at = entry
+                if expires_at > time.time():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return Principal(copy.copy(principal.user), principal.customer_ref)
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def set(self, token, principal, expires_at=None):
+        """Cache a principal; `expires_at` is the token's exp claim (epoch seconds) if known."""
+        deadline = time.time() + self._ttl()
+        if expires_at is not None:
+            deadline = min(deadline, expires_at)
+        key = hash_token(token)
+        principal = Principal(copy.copy(principal.user), principal.customer_ref)
+        with self._lock:
+            self._entries[key] = (principal, deadline)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_size():
+                self._entries.popitem(last=False)
+
+    def invalidate_user(self, user_id):
+        with self._lock:
+            stale = [key for key, (principal, _) in self._entries.items() if principal.user.pk == user_id]
+            for key in stale:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self._entries)}
+
+
+principal_cache = PrincipalCache()
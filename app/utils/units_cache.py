@@ -0,0 +1,35 @@
+from django.conf import settings
+from django.core.cache import cache
+
+from app.models import Unit_of_Measure
+
+
+class UnitsCache:
+    """
+    Lower-cased Unit_of_Measure names in the Django cache, so validating a
+    delivery-note edit doesn't reload the table. unit_of_measure is
+    maintained outside Django, so entries simply expire after
+    UNITS_CACHE_TTL.
+    """
+
+    KEY = 'units:names'
+
+    @property
+    def ttl(self):
+        return getattr(settings, 'UNITS_CACHE_TTL', 300)
+
+    def names(self):
+        return cache.get_or_set(
+            self.KEY,
+            lambda: frozenset(name.lower() for name in Unit_of_Measure.objects.values_list('name', flat=True) if name),
+            self.ttl,
+        )
+
+    def is_valid(self, unit):
+        return unit.lower() in self.names()
+
+    def invalidate(self):
+        cache.delete(self.KEY)
+
+
+units_cache = UnitsCache()
@@ -1,22 +1,27 @@
+import base64
 import csv
 import io
+import json
 import logging
 import os
 import re
 from datetime import datetime, timedelta, date, time
+from itertools import islice
 
-import boto3
 import requests
 from dateutil.relativedelta import relativedelta
 from dotenv import load_dotenv
 from django import forms
 from django.conf import settings
+from django.core.cache import cache
 from django.db import IntegrityError, transaction
 from django.db.models import (
-    Case, Count, F, FloatField, IntegerField, OuterRef, Q, Subquery, Sum, Value, When, TextField, Min
+    BigIntegerField, Case, Count, Exists, ExpressionWrapper, F, FloatField, IntegerField, OuterRef, Q, Subquery, Sum,
+    Value, When, TextField, Min
 )
-from django.db.models.functions import Concat
-from django.http import Http404, HttpResponse, JsonResponse
+from django.db.models.functions import Cast, Coalesce, Concat
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import Http404, HttpResponse, JsonResponse, StreamingHttpResponse
 from django.urls import reverse_lazy
 from django.utils import timezone
 from django.utils.dateparse import parse_date
@@ -33,6 +38,12 @@ from elasticsearch import Elasticsearch
 from elasticsearch import NotFoundError 
 from .models import *
 from .serializers import *
+from .enrichment import building_gia_map, enqueue_job
+from .reports import carbon_rollup, summary_rollup
+from .line_edits import bulk_edit_lines
+from .search import full_text_available, search
+from .utils.cognito_client import get_cognito_client
+from .utils.options_cache import options_cache
 
 
 # Load environment variables from .env file
@@ -113,7 +124,7 @@ class UserSignUpAPI(generics.CreateAPIView):
 
     def perform_create(self, serializer):
         user = serializer.save()
-        client = boto3.client('cognito-idp', region_name=settings.AWS_COGNITO_REGION)
+        client = get_cognito_client()
         
         try:
             response = client.sign_up(
@@ -143,7 +154,7 @@ class UserDetailAPI(generics.RetrieveUpdateDestroyAPIView):
         return user
 
     def sync_with_cognito(self, user):
-        client = boto3.client('cognito-idp', region_name=settings.AWS_COGNITO_REGION)
+        client = get_cognito_client()
         try:
             response = client.admin_get_user(
                 UserPoolId=settings.AWS_COGNITO_USER_POOL_ID,
@@ -162,7 +173,7 @@ class UserDetailAPI(generics.RetrieveUpdateDestroyAPIView):
         self.update_cognito_user(user)
 
     def update_cognito_user(self, user):
-        client = boto3.client('cognito-idp', region_name=settings.AWS_COGNITO_REGION)
+        client = get_cognito_client()
         attributes = [
             {'Name': 'email', 'Value': user.email},
             {'Name': 'email_verified', 'Value': 'true' if user.email_verified else 'false'}
@@ -181,7 +192,7 @@ class UserDetailAPI(generics.RetrieveUpdateDestroyAPIView):
         super().perform_destroy(instance)
 
     def delete_cognito_user(self, user):
-        client = boto3.client('cognito-idp', region_name=settings.AWS_COGNITO_REGION)
+        client = get_cognito_client()
         try:
             client.admin_delete_user(
                 UserPoolId=settings.AWS_COGNITO_USER_POOL_ID,
@@ -203,7 +214,7 @@ class VerifyEmailAPI(APIView):
         email = serializer.validated_data['email']
         otp = serializer.validated_data['otp']
 
-        client = boto3.client('cognito-idp', region_name=settings.AWS_COGNITO_REGION)
+        client = get_cognito_client()
         try:
             # Confirm the user's email verification in Cognito
             client.confirm_sign_up(
@@ -237,7 +248,7 @@ class ResendConfirmationCodeAPI(generics.CreateAPIView):
         serializer.is_valid(raise_exception=True)
 
         email = serializer.validated_data['email']
-        client = boto3.client('cognito-idp', region_name=settings.AWS_COGNITO_REGION)
+        client = get_cognito_client()
         
         try:
             # Resend confirmation code via Cognito
@@ -268,7 +279,7 @@ class LoginAPI(generics.CreateAPIView):
 
         email = serializer.validated_data['email']
         password = serializer.validated_data['password']
-        client = boto3.client('cognito-idp', region_name=settings.AWS_COGNITO_REGION)
+        client = get_cognito_client()
 
         try:
             # Authenticate the user using AWS Cognito
@@ -300,47 +311,87 @@ class ListUsersAPI(APIView):
     """
     Retrieve a list of all users in the AWS Cognito User Pool,
     with additional fields from Django database.
+
+    Without parameters every page of the pool is streamed back as one JSON
+    array. The status is sent before the later pages are fetched, so if one
+    of them fails the array ends with an {"error": ..., "next_cursor": ...}
+    element instead of a user; resume from that cursor. Passing
+    ?page_size= and/or ?cursor= returns a single page instead,
+    as {"results": [...], "next_cursor": ...}; feed next_cursor back as
+    ?cursor= until it comes back null.
     """
+    PAGE_SIZE = 60  # Cognito's maximum for list_users
+
     def get(self, request, *args, **kwargs):
-        client = boto3.client('cognito-idp', region_name=settings.AWS_COGNITO_REGION)
+        client = get_cognito_client()
+        cursor = request.query_params.get('cursor')
         try:
-            # Use list_users to fetch all users in the user pool
-            response = client.list_users(
-                UserPoolId=settings.AWS_COGNITO_USER_POOL_ID,
-                Limit=60  # Adjust the limit if needed
-            )
-            
-            users = []
-            for user in response['Users']:
-                email = next((attr['Value'] for attr in user['Attributes'] if attr['Name'] == 'email'), None)
-                email_verified = any(attr['Value'] == 'true' for attr in user['Attributes'] if attr['Name'] == 'email_verified')
-                
-                # Retrieve additional fields from Django database if they exist
-                try:
-                    custom_user = CustomUser.objects.get(email=email)
-                    user_data = {
-                        'id': custom_user.id,
-                        'email': email,
-                        
-                        'email_verified': email_verified
-                    }
-                except CustomUser.DoesNotExist:
-                    # If user details don't exist in Django, default values
-                    user_data = {
-                        'id': None,
-                        'email': email,
-                        'email_verified': email_verified
-                    }
-                
-                users.append(user_data)
-            
-            serializer = UserListSerializer(users, many=True)
-            return Response(serializer.data, status=status.HTTP_200_OK)
+            page_size = min(int(request.query_params.get('page_size', self.PAGE_SIZE)), self.PAGE_SIZE)
+        except ValueError:
+            return Response({"error": "page_size must be an integer"}, status=status.HTTP_400_BAD_REQUEST)
+        if page_size < 1:
+            return Response({"error": "page_size must be positive"}, status=status.HTTP_400_BAD_REQUEST)
 
+        try:
+            # Fetched up front so pool/credential errors still get a proper status code
+            response = self.list_page(client, page_size, cursor)
         except client.exceptions.ResourceNotFoundException:
             return Response({"error": "User pool not found"}, status=status.HTTP_404_NOT_FOUND)
         except Exception as e:
             return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        if cursor is not None or 'page_size' in request.query_params:
+            return Response({
+                'results': self.join_page(response['Users']),
+                'next_cursor': response.get('PaginationToken'),
+            }, status=status.HTTP_200_OK)
+
+        stream = StreamingHttpResponse(self.stream_pages(client, page_size, response), content_type='application/json')
+        stream.status_code = status.HTTP_200_OK
+        return stream
+
+    def list_page(self, client, page_size, cursor=None):
+        request_kwargs = {'UserPoolId': settings.AWS_COGNITO_USER_POOL_ID, 'Limit': page_size}
+        if cursor:
+            request_kwargs['PaginationToken'] = cursor
+        return client.list_users(**request_kwargs)
+
+    def join_page(self, cognito_users):
+        """Attach Django ids to one page of Cognito users with a single email__in query."""
+        users = []
+        for user in cognito_users:
+            attributes = user.get('Attributes', [])
+            email = next((attr['Value'] for attr in attributes if attr['Name'] == 'email'), None)
+            email_verified = any(attr['Value'] == 'true' for attr in attributes if attr['Name'] == 'email_verified')
+            users.append({'id': None, 'email': email, 'email_verified': email_verified})
+
+        emails = [user['email'] for user in users if user['email']]
+        ids_by_email = dict(CustomUser.objects.filter(email__in=emails).values_list('email', 'id'))
+        for user in users:
+            user['id'] = ids_by_email.get(user['email'])
+
+        return UserListSerializer(users, many=True).data
+
+    def stream_pages(self, client, page_size, response):
+        """Yield a JSON array one Cognito page at a time, keeping a single page in memory."""
+        yield '['
+        first = True
+        while True:
+            for user in self.join_page(response['Users']):
+                yield ('' if first else ',') + json.dumps(user, cls=DjangoJSONEncoder)
+                first = False
+            pagination_token = response.get('PaginationToken')
+            if not pagination_token:
+                break
+            try:
+                response = self.list_page(client, page_size, pagination_token)
+            except Exception as e:
+                # The 200 is already sent, so the failure goes in the body where the client can't miss it
+                logger.error(f"ListUsersAPI stopped streaming: {str(e)}")
+                error = {'error': f"Listing stopped early: {str(e)}", 'next_cursor': pagination_token}
+                yield ('' if first else ',') + json.dumps(error)
+                break
+        yield ']'
         
 
 ############################################  APP DELIVERY NOTE BEST MATCH INVOICE ##############################################################
@@ -367,100 +418,6 @@ class BestMatchAPIView(generics.GenericAPIView,
          "Authorization": "Bearer "+os.getenv("DEVELOPER_TOKEN")
     }
     
-    @classmethod
-    def access_token(self):
-        try:
-            
-            response = requests.get(
-                self.API_BASE_URL + "/token/getapitoken/",
-                headers={
-                     "Authorization": "Bearer " + os.getenv("DEVELOPER_TOKEN")
-                    }
-                )
-            
-            
-            if response.status_code == 200:
-                current_time = datetime.now()
-                current_time_aware = timezone.make_aware(current_time, timezone.get_current_timezone())
-                expiration_time = current_time_aware + timedelta(hours=24)
-                token_data = response.json()
-                token = token_data.get("api_token")
-                Refresh_Token = token_data.get("refresh_token")
-
-
-                if BestAPIToken.objects.exists(): 
-                    record=BestAPIToken.objects.first()
-                    record.TokenName="BEST ACCESS TOKEN"
-                    record.TokenValue=token
-                    record.RefreshToken=Refresh_Token,
-                    record.TokenExpiryTime=expiration_time
-
-                    record.save()
-
-                else:
-                
-                    try:
-                        BestAPIToken.objects.create(
-                        TokenName="BEST ACCESS TOKEN",
-                        TokenValue=token,
-                        RefreshToken=Refresh_Token,
-                        TokenExpiryTime=expiration_time
-                        )
-                    except IntegrityError as e:
-                        logger.error(f"IntegrityError occurred: {e}")
-                    except Exception as e:
-                        logger.error(f"An error occurred while creating the token: {e}")       
-
-
-
-                return token
-        except:
-            logger.error("Error occured While Generating Token")
-
-    def is_token_expired(self,tokenexpirytime):
-        now = timezone.now()
-        if tokenexpirytime is not None:
-            if tokenexpirytime is None:
-                tokenexpirytime = timezone.make_aware(tokenexpirytime)
-            if tokenexpirytime < now:
-                return False  # Token has expired
-            else:
-                return True  # Token is still valid
-        else:
-            return False
-    @classmethod
-    def refresh_token(self):
-        try:
-            if BestAPIToken.objects.exists():
-                    tokens = BestAPIToken.objects.all()
-                    for token in tokens:
-                        refresh_token = token.RefreshToken
-            api_payload={
-                "refresh":refresh_token
-            }
-            response = requests.post(
-                self.API_BASE_URL + "/token/refresh/",
-                json=api_payload
-                )
-            if response.status_code == 200:
-                current_time = datetime.now()
-                current_time_aware = timezone.make_aware(current_time, timezone.get_current_timezone())
-                expiration_time = current_time_aware + timedelta(hours=24)
-                token_data = response.json()
-                token = token_data.get("api_token")
-                Refresh_Token = token_data.get("refresh_token")
-
-                record=BestAPIToken.objects.first()
-                record.TokenName="REFRESHED BEST ACCESS TOKEN"
-                record.TokenValue=token
-                record.RefreshToken=Refresh_Token,
-                record.TokenExpiryTime=expiration_time
-
-                record.save()
-                return token
-        except:
-            logger.error("Error occured While Generating Token")
-
     def convert_date_format(self, date_str):
         """Convert date from DD/MM/YYYY to YYYY-MM-DD format."""
         try:
@@ -472,209 +429,25 @@ class BestMatchAPIView(generics.GenericAPIView,
 
 
 
-    def process_unprocessed_records(self):
-        unprocessed_records = BestMatch.objects.filter(Q(processed=False, approved=False, error_code=0) | Q(processed=False, approved=True, error_code=0) | Q(processed=True, approved=True, error_code=0))
-
-        logger.info(f"Found {unprocessed_records.count()} unprocessed records")
-
-        for record in unprocessed_records:
-            if record.delivery_note_date:
-                # Convert delivery_note_date to string before passing to convert_date_format
-                converted_date = self.convert_date_format(record.delivery_note_date.strftime("%d/%m/%Y"))
-                if converted_date:
-                    record.delivery_note_date = converted_date
-                else:
-                    logger.error(f"Skipping record ID {record.id} due to invalid date format.")
-                    continue
-            product_desc = record.revised_product_description if record.revised_product_description else record.product_description
-            api_payload = {
-                "input_items": [product_desc + " " + record.delivery_country],
-                "include_product_data": True,
-                "include_material_data": True
-            }
-            try:
-                if BestAPIToken.objects.exists():
-                    tokens = BestAPIToken.objects.all()
-                    for token in tokens:
-                        if self.is_token_expired(token.TokenExpiryTime):
-                            access_token = token.TokenValue
-                        else:
-                            access_token= self.access_token()
-                else:
-                    access_token=self.access_token()
-                response = requests.post(self.API_URL, json=api_payload, headers={
-                            "Authorization": "Bearer " + access_token
-                            })
-                logger.info(f"API response status code: {response.status_code}")
-
-                if response.status_code == 200:
-                    api_data = response.json()
-                    # print("api_data",api_data)
-                    quality_info = api_data.get("results",{}).get(product_desc + " " + record.delivery_country, {}).get("quantity_info", {})
-                    product_info = api_data.get("results.best_product", {}).get(product_desc + " " + record.delivery_country, {})
-                    for key, item in api_data.get('results', {}).items():
-                        best_product = item.get('best_product', {})
-                        best_product[key] = {
-                            'product_name': best_product.get('product_name'),
-                            'company_name': best_product.get('product_company_name'),
-                            'manufacturing_emissions_intensity': best_product.get('product_manufacturing_emissions_intensity_factor'),
-                            'manufacturing_emissions_per_kg': best_product.get('product_manufacturing_emissions_per_kg'),
-                            'product_url': best_product.get('product_url'),
-                            'match_score': best_product.get('product_match_score')
-                        }
-
-                        best_material = item.get('best_material',{})
-                        best_material[key] = {
-                            'material_name': best_material.get('material_name'),
-                            'material_manufacturing_emissions_intensity_factor':  best_material.get('material_manufacturing_emissions_intensity_factor'),
-                            'material_manufacturing_emissions_intensity_unit':best_material.get('material_manufacturing_emissions_intensity_unit'),
-                            'material_data_source':best_material.get('material_data_source'),
-                            'material_id':best_material.get('material_id'),
-                            'material_match_score':best_material.get('material_match_score')
-
-                        }
-
-
-                        materialName = item.get('classification',{})
-                        materialName[key] = {
-                            'material_name': materialName.get('material_type')
-                        }
-                    material_facts = api_data.get("results",{}).get(product_desc + " " + record.delivery_country, {}).get("best_product", {}).get("product_data", {}).get("material_facts", {})
-                    scaling_factors = material_facts.get("scaling_factors", {})
-                    user_id = record.revised_user_id if record.revised_user_id else record.user_id
-
-                    result=Users.objects.filter(User_ID=user_id).first()
-                    if result is not None:
-                        customerref=result.customer_ref
-                    else:
-                        customerref=""
-                    unit_of_measure = record.revised_unit_of_measure if record.revised_unit_of_measure else record.unit_of_measure
-                    record.product_name = best_product.get("product_name") 
-                    record.material_name = materialName.get("material_type")
-                    record.product_company_name = best_product.get("product_company_name")
-                    record.product_match_score = best_product.get("product_match_score")
-                    record.global_warming_potential_fossil = material_facts.get("global_warming_potential_fossil", {}).get("A1A2A3")
-                    record.declared_unit = material_facts.get("declared_unit")
-                    record.scaling_factor = scaling_factors.get(record.unit_of_measure, {}).get("value")
-                    if record.revised_product_description:
-                        record.scaling_factor = scaling_factors.get(record.revised_unit_of_measure, {}).get("value")
-                    else:
-                        record.scaling_factor = scaling_factors.get(record.unit_of_measure, {}).get("value")
-                    if record.scaling_factor is None or not record.scaling_factor:
-                            error_code = 4
-
-                    print(record.scaling_factor)
-                    record.data_source = material_facts.get("data_source")
-                    record.processed = True
-                    record.processed_timestamp = timezone.now() 
-                    record.customer_ref=customerref
-                    record.package_unit_item_height = best_material.get('material_data',{}).get('thickness',{}) or None
-                    record.density =  best_product.get('product_data',{}).get('density') or None
-                    record.package_unit_item_dimension_uom = best_material.get('material_data',{}).get('length_units') or None
-                    record.mass_per_declared_unit =  best_product.get('product_data',{}).get('material_facts',{}).get('mass_per_declared_unit',{}) or None
-                    record.linear_density = best_product.get('product_data',{}).get('linear_density',{}) or None
-                    if quality_info :
-                        record.package_type = quality_info.get('package', {}).get('type') or None
-                        record.package_unit_type =  quality_info.get('item_details', {}).get('base_unit') or None
-                        record.package_unit_item_count = quality_info.get('package', {}).get('item_count') or None
-                        record.package_unit_item_length = quality_info.get('item_details', {}).get('length') or None
-                        record.package_unit_item_width = quality_info.get('item_details', {}).get('width') or None
-                        record.package_unit_item_dimension_uom = quality_info.get('item_details',{}).get('length_units') or None
-                        record.package_unit_item_area = quality_info.get('item_details', {}).get('area') or None
-                        record.package_unit_item_area_uom = quality_info.get('item_details', {}).get('area_units') or None
-                        record.package_unit_item_volume = None
-                        record.package_unit_item_volume_uom = None
-                        if(record.package_unit_item_height is None):
-                            record.package_unit_item_height = quality_info.get('item_details', {}).get('thickness') or None
-
-                    # break
-
-
-                    
-
-
-                    gia_values =  Building.objects.extra(select={'gia': 'gia'}).filter(id=record.building_id).values_list('gia', flat=True).first()
-                    #comment to check scaling facor
-
-                    error_code = 0  # Default to 0 (no error)
-                    valid_units = Unit_of_Measure.objects.values_list('name', flat=True)
-                    valid_units_lower = {unit.lower() for unit in valid_units}
-                    print(record.id,record.scaling_factor)
-                   
-                    try:
-                        record.quantity = float(record.revised_quantity) if record.revised_quantity is not None else (float(record.quantity) if record.quantity else None)
-                    except ValueError:
-                        error_code = 2  
-                    
-                    # # Calculate kgco2_per_m2 and assign it to kgco2
-                    if record.global_warming_potential_fossil and record.scaling_factor and record.quantity:
-                        kgco2_per_m2 = (float(record.global_warming_potential_fossil) / float(record.scaling_factor)) * (float(record.quantity) / gia_values) # (gia) 5000 should come from app_buildingtable
-                        record.kgco2 = kgco2_per_m2
-                        record.exception=""
-                    else:
-                        record.kgco2 = 0
-                        record.exception="Scaling factor is missing"
-                        record.scaling_factor=0
-                        error_code = 4
-                    try:
-                        record.error_code=error_code
-                        record.approved = False
-                        print(error_code)
-                        record.save()
-                    except Exception as e:
-                        logger.info(f"Errored ocuured for ID {record.id} The error is {e}.")
-                        
-                    logger.info(f"Record with ID {record.id} has been updated and saved check.")
-                
-
-                    # Fetch Phase instance
-                    try:
-                        phase_id = record.revised_phase_id if record.revised_phase_id else record.phase_id
-                        phase_instance = Phase.objects.get(pk=phase_id) if phase_id else None
-                    except Phase.DoesNotExist:
-                        phase_instance = None
-                        logger.error(f"Phase with ID {phase_id} does not exist for record ID {record.id}")
-
-                    # Copy data to InvoiceData model
-                    if record.scaling_factor != 0:
-                        InvoiceData.objects.create(
-                            delivery_note_ref_no=record.delivery_note_ref_no,
-                            supplier_name=record.supplier_name,
-                            data_source=record.data_source,
-                            product_description=product_desc,
-                            material_name=record.material_name,
-                            entry_time=record.entry_time.date() if record.entry_time else timezone.now().date(),
-                            quantity=record.quantity,
-                            unit_of_measure=record.unit_of_measure,
-                            phase_name=phase_instance,  # Assign the Phase instance
-                            kgco2=record.kgco2,
-                            product_manufacturing_company=record.product_company_name,
-                        )
-
-                        logger.info(f"Data copied to InvoiceData for record ID {record.id}")
-                else:
-                    error_code=1
-                    record.error_code=error_code
-                    record.approved = False
-                    record.save()
-                    logger.error(f"API request failed for record ID {record.id}: {response.status_code} - {response.text}")
-
-            except requests.RequestException as e:
-                error_code=1
-                record.error_code=error_code
-                record.approved =False
-                record.save()
-                logger.error(f"RequestException for record ID {record.id}: {e}")
+    def get_serializer(self, *args, **kwargs):
+        serializer = super().get_serializer(*args, **kwargs)
+        if args:
+            rows = args[0] if kwargs.get('many') else [args[0]]
+            # One query for the GIA of every building on the page, used by kgco2_per_m2
+            serializer.context['gia_by_building'] = building_gia_map(row.building_id for row in rows)
+        return serializer
 
     def get(self, request, pk=None):
-        self.process_unprocessed_records()
+        # Listing used to match pending rows inline; it now queues that for run_enrichment_worker
+        enqueue_job()
         if pk:
             return self.retrieve(request, pk)
         return self.list(request)
 
     def post(self, request):
-        self.process_unprocessed_records()
-        return Response({"message": "All unprocessed records have been processed."}, status=status.HTTP_200_OK)
+        # Matching happens in run_enrichment_worker; poll best_match/jobs/<id>/ for progress
+        job = enqueue_job()
+        return Response(EnrichmentJobSerializer(job).data, status=status.HTTP_202_ACCEPTED)
 
     def put(self, request, pk=None):
         return self.update(request, pk)
@@ -686,6 +459,11 @@ class BestMatchAPIView(generics.GenericAPIView,
 
 
 
+class EnrichmentJobAPIView(generics.RetrieveAPIView):
+    queryset = EnrichmentJob.objects.all()
+    serializer_class = EnrichmentJobSerializer
+
+
 class CustomSearchFilter(filters.SearchFilter):
     def get_search_terms(self, request):
         """
@@ -702,6 +480,10 @@ class CustomSearchFilter(filters.SearchFilter):
         if not search_terms:
             return queryset
 
+        if getattr(view, 'full_text_search', False) and full_text_available():
+            # Indexed prefix match on the search_vector column, ranked as search_rank
+            return search(queryset, search_terms)
+
         # Prepare queries for each term across all specified search fields
         combined_queries = Q()
         for search_term in search_terms:
@@ -714,20 +496,29 @@ class CustomSearchFilter(filters.SearchFilter):
             combined_queries |= query  # Use OR to combine queries for different terms
             logger.debug(f"Building query for term '{search_term}': {query}")
 
-        final_queryset = queryset.filter(combined_queries)
-        logger.debug(f"Final queryset count: {final_queryset.count()}")
-        return final_queryset
+        return queryset.filter(combined_queries)
 
 
-class  InvoiceDataView(generics.ListAPIView):
-    # queryset = InvoiceData.objects.all()
-    
+class InvoiceDataListMixin:
+    """
+    Customer scoping plus keyset pagination on (entry_time, id) for the
+    invoice_data search views, or on (search_rank, id) best match first
+    when searching. Pages are fetched with WHERE on the last row's key
+    instead of OFFSET, so every page costs the same however deep it is;
+    cursors are opaque and come back as next_cursor (null on the last page).
+    The keyset fixes the order, so ?ordering= is no longer honoured and is
+    ignored if sent.
+    """
     queryset = InvoiceData.objects.select_related('phase_name').all()
     serializer_class = InvoiceDataSerializer
-    filter_backends = (CustomSearchFilter, OrderingFilter)
+    filter_backends = (CustomSearchFilter,)
     search_fields = ('country_name', 'region_name', 'city_name', 'building_name', 'supplier_name','phase_name__name', 'data_source', 'entry_time', 'product_description', 'material_name')
+    full_text_search = True
+    PAGE_SIZE = 100
+    MAX_PAGE_SIZE = 1000
 
-    def list(self, request, *args, **kwargs):
+    def customer_queryset(self, request):
+        """The filtered rows for ?email='s customer, and that customer_ref."""
         email = request.query_params.get('email', None)
         result=Users.objects.filter(User_ID=email).first()
         customerref=result.customer_ref
@@ -735,121 +526,150 @@ class  InvoiceDataView(generics.ListAPIView):
 
         if customerref:
             queryset = queryset.filter(customer_ref=customerref)
+        return queryset, customerref
 
-        # Aggregate overall totals
-        aggregate_data = queryset.aggregate(
-            total_kgco2=Sum('kgco2')
-        )
+    def ranked(self, queryset):
+        return 'search_rank' in queryset.query.annotations
+
+    def keyset_ordered(self, queryset):
+        # NULL dates sort last, as in the index
+        if self.ranked(queryset):
+            return queryset.order_by('-search_rank', 'id')
+        return queryset.order_by(F('entry_time').asc(nulls_last=True), 'id')
+
+    def encode_cursor(self, row):
+        if hasattr(row, 'search_rank'):
+            position = {'rank': row.search_rank, 'id': row.id}
+        else:
+            position = {'entry_time': row.entry_time.isoformat() if row.entry_time else None, 'id': row.id}
+        return base64.urlsafe_b64encode(json.dumps(position).encode()).decode()
 
-        # Aggregate totals by material name (corrected)
-        material_name_aggregates = queryset.values('material_name').annotate(
-            total_kgco2=Sum('kgco2')
-        ).order_by('material_name')
-
-        # Aggregate carbon and kgco2 based on the status of 'Estimate' and 'Actual'
-        carbon_status_sums = queryset.aggregate(
-            estimate_kgco2=Sum(Case(
-                When(data_source='EPD', then='kgco2'),
-                output_field=IntegerField(),
-            )),
-            actual_kgco2=Sum(Case(
-                When(data_source='Average', then='kgco2'),
-                output_field=IntegerField(),
-            )),
+    def decode_cursor(self, cursor, ranked):
+        try:
+            position = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+            if ranked:
+                return float(position['rank']), int(position['id'])
+            entry_time = position['entry_time']
+            if entry_time is None:
+                return None, int(position['id'])
+            parsed = parse_date(entry_time)
+            if parsed is None:
+                # parse_date() answers None rather than raising for text that isn't a date
+                raise ValueError(entry_time)
+            return parsed, int(position['id'])
+        except (ValueError, TypeError, KeyError):
+            # Also a cursor from a search with different terms, or none
+            raise ValidationError({'cursor': 'Invalid cursor'})
+
+    def after_cursor(self, queryset, cursor):
+        if self.ranked(queryset):
+            rank, last_id = self.decode_cursor(cursor, ranked=True)
+            return queryset.filter(Q(search_rank__lt=rank) | Q(search_rank=rank, id__gt=last_id))
+        entry_time, last_id = self.decode_cursor(cursor, ranked=False)
+        if entry_time is None:
+            return queryset.filter(entry_time__isnull=True, id__gt=last_id)
+        return queryset.filter(
+            Q(entry_time=entry_time, id__gt=last_id) | Q(entry_time__gt=entry_time) | Q(entry_time__isnull=True)
         )
 
-        # Calculate percentages if total_kgco2 is not zero
-        total_kgco2 = aggregate_data['total_kgco2'] or 0  # Avoid division by zero
-        if total_kgco2 > 0:
-            estimate_percentage = (carbon_status_sums['estimate_kgco2'] or 0) / total_kgco2 * 100
-            actual_percentage = (carbon_status_sums['actual_kgco2'] or 0) / total_kgco2 * 100
+    def page_size(self, request):
+        try:
+            page_size = int(request.query_params.get('page_size', self.PAGE_SIZE))
+        except ValueError:
+            raise ValidationError({'page_size': 'page_size must be an integer'})
+        if page_size < 1:
+            raise ValidationError({'page_size': 'page_size must be positive'})
+        return min(page_size, self.MAX_PAGE_SIZE)
+
+    def keyset_page(self, request, queryset):
+        """One page of serialized rows after ?cursor=, and the cursor of the page after it."""
+        queryset = self.keyset_ordered(queryset)
+        cursor = request.query_params.get('cursor')
+        if cursor:
+            queryset = self.after_cursor(queryset, cursor)
+        page_size = self.page_size(request)
+        # One extra row tells us whether there is a next page without a COUNT
+        rows = list(queryset[:page_size + 1])
+        next_cursor = self.encode_cursor(rows[page_size - 1]) if len(rows) > page_size else None
+        return self.get_serializer(rows[:page_size], many=True).data, next_cursor
+
+
+class  InvoiceDataView(InvoiceDataListMixin, generics.ListAPIView):
+    """
+    Carbon totals for the customer's (optionally searched) invoice lines,
+    with the first page of the lines themselves. Later pages and full
+    exports come from InvoiceDataResultsView.
+    """
+
+    def list(self, request, *args, **kwargs):
+        queryset, customerref = self.customer_queryset(request)
+
+        if CustomSearchFilter().get_search_terms(request):
+            # Search terms reach columns carbon_summary doesn't keep, so total the matching rows
+            aggregates = carbon_rollup(queryset)
         else:
-            estimate_percentage = 0
-            actual_percentage = 0
-
-        # Aggregate by region
-        region_aggregates = queryset.values('region_name').annotate(
-            total_kgco2=Sum('kgco2')
-        ).order_by('region_name')
-
-        # Aggregate by city
-        city_aggregates = queryset.values('city_name').annotate(
-            total_kgco2=Sum('kgco2')
-        ).order_by('city_name')
-
-        # Aggregate by building name
-        building_aggregates = queryset.values('building_name').annotate(
-            total_kgco2=Sum('kgco2')
-        ).order_by('building_name')
-
-        # Nested aggregation structure
-        nested_structure = []
-        for region in queryset.values('region_name').distinct():
-            region_queryset = queryset.filter(region_name=region['region_name'])
-            region_total = region_queryset.aggregate(
-                total_kgco2=Sum('kgco2')
-            )
-            
-            cities_data = []
-            for city in region_queryset.values('city_name').distinct():
-                city_queryset = region_queryset.filter(city_name=city['city_name'])
-                city_total = city_queryset.aggregate(
-                    total_kgco2=Sum('kgco2')
-                )
-                
-                buildings_data = []
-                for building in city_queryset.values('building_name').distinct():
-                    building_queryset = city_queryset.filter(building_name=building['building_name'])
-                    building_total = building_queryset.aggregate(
-                        total_kgco2=Sum('kgco2')
-                    )
-                    
-                    phases_data = building_queryset.values('phase_name__name').annotate(
-                        total_kgco2=Sum('kgco2')
-                    ).order_by('phase_name__name')
-                    
-                    buildings_data.append({
-                        'building_name': building['building_name'],
-                        'total_kgco2': building_total['total_kgco2'],
-                        'phases': list(phases_data)
-                    })
-                
-                cities_data.append({
-                    'city_name': city['city_name'],
-                    'total_kgco2': city_total['total_kgco2'],
-                    'buildings': buildings_data
-                })
-            
-            nested_structure.append({
-                'region_name': region['region_name'],
-                'total_kgco2': region_total['total_kgco2'],
-                'cities': cities_data
-            })
+            aggregates = summary_rollup(customerref)
 
-        serializer = self.get_serializer(queryset, many=True)
+        results, next_cursor = self.keyset_page(request, queryset)
         return Response({
-            'results': serializer.data,
-            'overall_aggregates': aggregate_data,
-            'material_name_aggregates': list(material_name_aggregates),
-            'carbon_status_totals': {
-                'estimate': {
-                    'total_kgco2': carbon_status_sums['estimate_kgco2'] or 0
-                },
-                'actual': {
-                    'total_kgco2': carbon_status_sums['actual_kgco2'] or 0
-                }
-            },
-            'carbon_status_percentage': {
-                'EPD': estimate_percentage,
-                'average': actual_percentage,
-            },
-            'region_aggregates': list(region_aggregates),
-            'city_aggregates': list(city_aggregates),
-            'building_aggregates': list(building_aggregates),
-            'nested_structure': nested_structure  # Nested structure by region, city, building, and phases
+            'results': results,
+            'next_cursor': next_cursor,
+            # Every total, down to the region > city > building > phase tree, comes from one grouped query
+            **aggregates,
         })
 
 
+class InvoiceDataResultsView(InvoiceDataListMixin, generics.ListAPIView):
+    """
+    Invoice lines matching the same parameters as InvoiceDataView, without
+    the totals: {"results": [...], "next_cursor": ...} one keyset page at a
+    time, or with ?export=ndjson / ?export=csv every row streamed from a
+    server-side cursor, so memory stays flat however many lines there are.
+    """
+    EXPORT_CHUNK_SIZE = 2000
+
+    def list(self, request, *args, **kwargs):
+        queryset, customerref = self.customer_queryset(request)
+        export = request.query_params.get('export')
+        if export is None:
+            results, next_cursor = self.keyset_page(request, queryset)
+            return Response({'results': results, 'next_cursor': next_cursor})
+
+        if export == 'ndjson':
+            stream = StreamingHttpResponse(self.stream_ndjson(queryset), content_type='application/x-ndjson')
+        elif export == 'csv':
+            stream = StreamingHttpResponse(self.stream_csv(queryset), content_type='text/csv')
+            stream['Content-Disposition'] = 'attachment; filename="invoice_data.csv"'
+        else:
+            return Response({"error": "export must be ndjson or csv"}, status=status.HTTP_400_BAD_REQUEST)
+        return stream
+
+    def serialized_chunks(self, queryset):
+        """Serialized rows, EXPORT_CHUNK_SIZE at a time, read through .iterator()."""
+        rows = self.keyset_ordered(queryset).iterator(chunk_size=self.EXPORT_CHUNK_SIZE)
+        while True:
+            chunk = list(islice(rows, self.EXPORT_CHUNK_SIZE))
+            if not chunk:
+                break
+            yield self.get_serializer(chunk, many=True).data
+
+    def stream_ndjson(self, queryset):
+        for chunk in self.serialized_chunks(queryset):
+            yield ''.join(json.dumps(row, cls=DjangoJSONEncoder) + '\n' for row in chunk)
+
+    def stream_csv(self, queryset):
+        buffer = io.StringIO()
+        writer = csv.DictWriter(buffer, fieldnames=list(self.get_serializer().fields))
+        writer.writeheader()
+        for chunk in self.serialized_chunks(queryset):
+            writer.writerows(chunk)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        # Header only, for an empty export
+        yield buffer.getvalue()
+
+
 ######################## Works with Token ########################################
 # class  InvoiceDataView(generics.ListAPIView):
 #     # queryset = InvoiceData.objects.all()
@@ -992,6 +812,26 @@ class DesignDataAPIView(generics.GenericAPIView, mixins.ListModelMixin, mixins.C
     queryset = DesignData.objects.all().order_by('id')
     serializer_class = DesignDataSerializer
 
+    ELEMENT_FIELDS = [
+        'substructure', 'superstructure', 'façade', 'internal_walls_partitions', 'internal_finishes', 'ff_fe',
+        'frame', 'upper_floors', 'roofs', 'stairs_and_ramps', 'external_walls', 'windows_and_external_walls',
+        'internal_doors', 'wall_finishes', 'floor_finishes', 'ceiling_finishes',
+    ]
+    # "totals" keys, in ELEMENT_FIELDS order
+    TOTAL_KEYS = [
+        'substructure_total', 'superstructure_total', 'facade_total', 'internal_walls_partitions_total',
+        'internal_finishes_total', 'ff_fe_total', 'frame_total', 'upper_floors_total', 'roofs_total',
+        'stairs_and_ramps_total', 'external_walls_total', 'windows_and_external_walls_total',
+        'internal_doors_total', 'wall_finishes_total', 'floor_finishes_total', 'ceiling_finishes_total',
+    ]
+    # Elements summed into each row's "total" (the original layout) and "total_new"
+    TOTAL_FIELDS = ['substructure', 'superstructure', 'façade', 'internal_walls_partitions', 'internal_finishes', 'ff_fe']
+    TOTAL_NEW_FIELDS = [
+        'substructure', 'internal_walls_partitions', 'ff_fe', 'frame', 'upper_floors', 'roofs', 'stairs_and_ramps',
+        'external_walls', 'windows_and_external_walls', 'internal_doors', 'wall_finishes', 'floor_finishes',
+        'ceiling_finishes',
+    ]
+
     def get_object(self, id):
         try:
             return DesignData.objects.get(id=id)
@@ -1012,110 +852,27 @@ class DesignDataAPIView(generics.GenericAPIView, mixins.ListModelMixin, mixins.C
             return Response(serializer.data)
 
         else:
-            alldata = DesignData.objects.filter(customer_ref=customerref)
-
-            final_data = []
-
-            # Initialize all totals
-            totals = {
-                "substructure_total": 0,
-                "superstructure_total": 0,
-                "facade_total": 0,
-                "internal_walls_partitions_total": 0,
-                "internal_finishes_total": 0,
-                "ff_fe_total": 0,
-                "frame_total": 0,
-                "upper_floors_total": 0,
-                "roofs_total": 0,
-                "stairs_and_ramps_total": 0,
-                "external_walls_total": 0,
-                "windows_and_external_walls_total": 0,
-                "internal_doors_total": 0,
-                "wall_finishes_total": 0,
-                "floor_finishes_total": 0,
-                "ceiling_finishes_total": 0,
-            }
-
-            for data in alldata:
-                try:
-                    building = Building.objects.get(id=data.building_id)
-                    city_name = building.city.name
-                    region_name = Region.objects.get(id=building.region_id).name
-                    country_name = Country.objects.get(id=building.country_id).name
-
-                    # Update totals with null-safety
-                    totals["substructure_total"] += data.substructure or 0
-                    totals["superstructure_total"] += data.superstructure or 0
-                    totals["facade_total"] += data.façade or 0
-                    totals["internal_walls_partitions_total"] += data.internal_walls_partitions or 0
-                    totals["internal_finishes_total"] += data.internal_finishes or 0
-                    totals["ff_fe_total"] += data.ff_fe or 0
-                    totals["frame_total"] += data.frame or 0
-                    totals["upper_floors_total"] += data.upper_floors or 0
-                    totals["roofs_total"] += data.roofs or 0
-                    totals["stairs_and_ramps_total"] += data.stairs_and_ramps or 0
-                    totals["external_walls_total"] += data.external_walls or 0
-                    totals["windows_and_external_walls_total"] += data.windows_and_external_walls or 0
-                    totals["internal_doors_total"] += data.internal_doors or 0
-                    totals["wall_finishes_total"] += data.wall_finishes or 0
-                    totals["floor_finishes_total"] += data.floor_finishes or 0
-                    totals["ceiling_finishes_total"] += data.ceiling_finishes or 0
-
-                    total = (
-                        (data.substructure or 0) +
-                        (data.superstructure or 0) +
-                        (data.façade or 0) +
-                        (data.internal_walls_partitions or 0) +
-                        (data.internal_finishes or 0) +
-                        (data.ff_fe or 0)
-                    )
-
-                    total_new = (
-                        (data.substructure or 0) +
-                        (data.internal_walls_partitions or 0) +
-                        (data.ff_fe or 0) +
-                        (data.frame or 0) +
-                        (data.upper_floors or 0) +
-                        (data.roofs or 0) +
-                        (data.stairs_and_ramps or 0) +
-                        (data.external_walls or 0) +
-                        (data.windows_and_external_walls or 0) +
-                        (data.internal_doors or 0) +
-                        (data.wall_finishes or 0) +
-                        (data.floor_finishes or 0) +
-                        (data.ceiling_finishes or 0)
-                    )
+            # Rows whose building is gone are left out, totals included
+            alldata = self.with_geography(DesignData.objects.filter(customer_ref=customerref)).order_by('id')
+
+            final_data = [
+                {
+                    "id": row["id"],
+                    "region": row["building_region"],
+                    "city": row["building_city"],
+                    "country": row["building_country"],
+                    **{field: row[field] for field in ["building_name", *self.ELEMENT_FIELDS, "gia", "customer_ref", "total", "total_new"]},
+                }
+                for row in alldata.values(
+                    'id', 'building_region', 'building_city', 'building_country', 'building_name', *self.ELEMENT_FIELDS,
+                    'gia', 'customer_ref', 'total', 'total_new',
+                )
+            ]
 
-                    final_data.append({
-                        "id": data.id,
-                        "region": region_name,
-                        "city": city_name,
-                        "country": country_name,
-                        "building_name": data.building_name,
-                        "substructure": data.substructure,
-                        "superstructure": data.superstructure,
-                        "façade": data.façade,
-                        "internal_walls_partitions": data.internal_walls_partitions,
-                        "internal_finishes": data.internal_finishes,
-                        "ff_fe": data.ff_fe,
-                        "frame": data.frame,
-                        "upper_floors": data.upper_floors,
-                        "roofs": data.roofs,
-                        "stairs_and_ramps": data.stairs_and_ramps,
-                        "external_walls": data.external_walls,
-                        "windows_and_external_walls": data.windows_and_external_walls,
-                        "internal_doors": data.internal_doors,
-                        "wall_finishes": data.wall_finishes,
-                        "floor_finishes": data.floor_finishes,
-                        "ceiling_finishes": data.ceiling_finishes,
-                        "gia": data.gia,
-                        "customer_ref": data.customer_ref,
-                        "total": total,
-                        "total_new": total_new,
-                    })
-
-                except Building.DoesNotExist:
-                    continue
+            sums = alldata.aggregate(**{
+                total_key: Sum(field) for field, total_key in zip(self.ELEMENT_FIELDS, self.TOTAL_KEYS)
+            })
+            totals = {key: value or 0 for key, value in sums.items()}
 
             # Calculate grand total
             omit_keys = ["superstructure_total", "facade_total", "internal_finishes_total"]
@@ -1127,6 +884,33 @@ class DesignDataAPIView(generics.GenericAPIView, mixins.ListModelMixin, mixins.C
                 "grand_total": grand_total
             }, status=status.HTTP_200_OK)
 
+    def with_geography(self, queryset):
+        """
+        `queryset` annotated with its building's city, region and country
+        names (building_city etc.; DesignData's own region and city columns
+        are free text) and the per-row totals, as subqueries of the one SELECT.
+        DesignData.building_id and Building.region_id/country_id are plain
+        text columns rather than foreign keys, hence the casts.
+        """
+        building = Building.objects.filter(id=Cast(OuterRef('building_id'), BigIntegerField()))
+        return queryset.filter(Exists(building)).annotate(
+            building_city=Subquery(building.values('city__name')[:1]),
+            building_region_id=Subquery(building.values('region_id')[:1]),
+            building_country_id=Subquery(building.values('country_id')[:1]),
+        ).annotate(
+            building_region=Subquery(Region.objects.filter(id=Cast(OuterRef('building_region_id'), BigIntegerField())).values('name')[:1]),
+            building_country=Subquery(Country.objects.filter(id=Cast(OuterRef('building_country_id'), BigIntegerField())).values('name')[:1]),
+            total=self.row_sum(self.TOTAL_FIELDS),
+            total_new=self.row_sum(self.TOTAL_NEW_FIELDS),
+        )
+
+    def row_sum(self, fields):
+        terms = [Coalesce(field, 0) for field in fields]
+        expression = terms[0]
+        for term in terms[1:]:
+            expression = expression + term
+        return ExpressionWrapper(expression, output_field=IntegerField())
+
 
     def post(self, request, *args, **kwargs):
         data = request.data
@@ -1491,6 +1275,7 @@ class GetOptionsAPI(generics.GenericAPIView,
                     mixins.DestroyModelMixin):
 
     def get_Options(self, customer_domain, selected_region=None, selected_city=None):
+        """Dropdown options for a customer; five queries however many regions it spans."""
         try:
             customer_reference = (
                 CustomerMaster.objects.only("Customer_Ref")
@@ -1502,42 +1287,37 @@ class GetOptionsAPI(generics.GenericAPIView,
             if not customer_reference:
                 return {"error": "Customer not found"}
 
-            region_ids = list(Building.objects
-                              .filter(customer_ref=customer_reference)
-                              .values_list('region_id', flat=True)
-                              .order_by("id")
-                              .distinct())
+            customer_buildings = Building.objects.filter(customer_ref=customer_reference)
             if selected_region:
-                regions = list(Region.objects.filter(id__in=selected_region).order_by("id"))
+                regions = Region.objects.filter(id=selected_region)
             else:
-                regions = list(Region.objects.filter(id__in=region_ids).order_by("id"))
-            cities = []
-            countries = set()  
+                # Building.region_id is a text column
+                region_ids = customer_buildings.annotate(region_pk=Cast('region_id', BigIntegerField())).values('region_pk')
+                regions = Region.objects.filter(id__in=region_ids)
+            regions = list(regions.select_related('country').order_by("id"))
 
+            countries = {}
             for region in regions:
-                region_name = region.name
-                country_name = region.country.name.lower()  
-                cities.append({"value": region.id, "name": region_name.strip()})
-                countries.add((region.country.id, country_name))  
-                cities = [{"value": city.id, "name": city.name} for city in City.objects.filter(region_id=region.id)]
-           
-            query = Building.objects.all()
+                countries.setdefault(region.country.id, region.country.name.lower())
 
-            if selected_region:
-                buildings = list(query.filter(region_id=selected_region).values_list('id', 'name').order_by("id"))
+            if selected_city:
+                cities = City.objects.filter(id=selected_city)
             else:
-                buildings = list(query.values_list('id', 'name').order_by("id"))
+                cities = City.objects.filter(region_id__in=[region.id for region in regions])
+            cities = [{"value": city.id, "name": city.name} for city in cities.order_by("id")]
+
+            buildings = customer_buildings
+            if selected_region:
+                buildings = buildings.filter(region_id=selected_region)
             if selected_city:
-                cities = [{"value": city.id, "name": city.name} for city in City.objects.filter(id=selected_city).order_by("id")]
-                query = query.filter(city_id=selected_city)
-            if selected_region and selected_city:
-                buildings = list(query.filter(city_id=selected_city).values_list('id', 'name').order_by("id"))
+                buildings = buildings.filter(city_id=selected_city)
+            buildings = list(buildings.values_list('id', 'name').order_by("id"))
 
             phases = list(Phase.objects.all().values_list('id', 'name').order_by("id"))
             response_data = {
                 "Regions": [{"value": region.id, "name": region.name} for region in (regions or [])],
                 "Cities": cities or [],
-                "Countries": [{"value": country[0], "name": country[1]} for country in (countries or [])],
+                "Countries": [{"value": country_id, "name": name} for country_id, name in countries.items()],
                 "Buildings": [{"value": building[0], "name": building[1]} for building in (buildings or [])],
                 "Phases": [{"value": phase[0], "name": phase[1]} for phase in (phases or [])],
             }
@@ -1558,7 +1338,12 @@ class GetOptionsAPI(generics.GenericAPIView,
         if not customer_domain:
             return Response({"error": "Domain name is required in query params."}, status=400)
 
-        options_data = self.get_Options(customer_domain, selected_region, selected_city)
+        options_data = options_cache.get(customer_domain, selected_region, selected_city)
+        if options_data is None:
+            options_data = self.get_Options(customer_domain, selected_region, selected_city)
+            # Errors aren't cached, so a customer added a moment later shows up straight away
+            if "error" not in options_data:
+                options_cache.set(customer_domain, selected_region, selected_city, options_data)
 
         return Response(options_data)
 
@@ -1571,6 +1356,21 @@ class Get_App_Deleivery_Note_API(generics.GenericAPIView,
                     mixins.RetrieveModelMixin, 
                     mixins.DestroyModelMixin):
 
+    FILE_ID_PATTERN = re.compile(r'_(\d+)\.pdf$')
+
+    @staticmethod
+    def notes(building_ids, start_date, end_date):
+        """The first web-uploaded line of each delivery note for `building_ids`, optionally within YYYY-MM-DD dates."""
+        filter_kwargs = {"building_id__in": building_ids,"account_number": "W"}
+
+        if start_date:
+            filter_kwargs["entry_time__gte"] = datetime.combine(datetime.strptime(start_date, '%Y-%m-%d'), time(0, 0, 0))
+
+        if end_date:
+            filter_kwargs["entry_time__lte"] = datetime.combine(datetime.strptime(end_date, '%Y-%m-%d'), time(23, 59, 59))
+
+        return BestMatch.objects.filter(**filter_kwargs).values("delivery_note_ref_no", "id", "building_id", "phase_id", "processed", "entry_time", "filename", "account_number").distinct('delivery_note_ref_no').order_by('delivery_note_ref_no', 'id')
+
     def get_app_deleivery_Note(self, customer_domain,start_date,end_date):
         try:
             customer_reference = (
@@ -1579,43 +1379,31 @@ class Get_App_Deleivery_Note_API(generics.GenericAPIView,
                 .values_list('Customer_Ref', flat=True)
                 .first()
             )
-            buildings = list(Building.objects.filter(customer_ref=customer_reference).values_list('id', 'name'))
-            building_ids = [building[0] for building in buildings]  # Extract only the IDs
-
-            filter_kwargs = {"building_id__in": building_ids,"account_number": "W"}
-
-            if start_date:
-                filter_kwargs["entry_time__gte"] = datetime.combine(datetime.strptime(start_date, '%Y-%m-%d'), time(0, 0, 0))
-
-            if end_date:
-                filter_kwargs["entry_time__lte"] = datetime.combine(datetime.strptime(end_date, '%Y-%m-%d'), time(23, 59, 59))
+            if not customer_reference:
+                return {"error": "Customer not found"}
 
-            App_Deleivery_Note_Data = list(BestMatch.objects.filter(**filter_kwargs).values("delivery_note_ref_no", "id", "building_id", "phase_id", "processed", "entry_time", "filename", "account_number").distinct('delivery_note_ref_no').order_by('delivery_note_ref_no', 'id'))
+            buildings = dict(Building.objects.filter(customer_ref=customer_reference).values_list('id', 'name'))
+            building_ids = list(buildings)  # Extract only the IDs
 
+            App_Deleivery_Note_Data = list(self.notes(building_ids, start_date, end_date))
 
-            building_ids = {item["building_id"] for item in App_Deleivery_Note_Data if item["building_id"]}
             phase_ids = {item["phase_id"] for item in App_Deleivery_Note_Data if item["phase_id"]}
-
-            buildings = {b.id: b.name for b in Building.objects.filter(id__in=building_ids)}
             phases = {p.id: p.name for p in Phase.objects.filter(id__in=phase_ids)}
 
+            # Stored names look like "<anything>_<DeliveryNoteFile id>.pdf"; resolve them all in one query
+            file_ids = {}
+            for item in App_Deleivery_Note_Data:
+                match = self.FILE_ID_PATTERN.search(item.get("filename") or "")
+                file_ids[item["id"]] = int(match.group(1)) if match else None
+            file_names = dict(
+                DeliveryNoteFile.objects.filter(id__in={file_id for file_id in file_ids.values() if file_id is not None})
+                .values_list('id', 'file_name')
+            )
+
             for item in App_Deleivery_Note_Data:
                 item["building_name"] = buildings.get(item.get("building_id"))
                 item["phase_name"] = phases.get(item.get("phase_id"))
-                fileName = item.get("filename")
-                match = re.search(r'_(\d+)\.pdf$', fileName)
-                
-
-                if match:
-                    fileId = match.group(1)
-                    delivery_note_file = DeliveryNoteFile.objects.filter(id=fileId).first() if match else ""
-                    item['filename'] = delivery_note_file.file_name if delivery_note_file else ""
-                else:
-                    item['filename'] = ""
-
-
-            if not customer_reference:
-                return {"error": "Customer not found"}
+                item['filename'] = file_names.get(file_ids[item["id"]], "")
 
             response_data = {
                 "result": App_Deleivery_Note_Data 
@@ -1689,6 +1477,12 @@ class Get_Building_User_API(generics.GenericAPIView,
 
 
 class getCount(generics.ListAPIView):
+    """
+    Dashboard counters for the caller's customer_ref. They are cached for
+    DASHBOARD_COUNTS_CACHE_TTL seconds and nothing invalidates them: the
+    delivery-note lines are written outside this app (and in bulk, without
+    signals), so a new upload shows in the counts up to that long after.
+    """
 
     def get(self, request):
         email = request.query_params.get('email', None)
@@ -1705,87 +1499,68 @@ class getCount(generics.ListAPIView):
 
         result=Users.objects.filter(User_ID=email).first()
         customerref=result.customer_ref
-        
-        today = datetime.now().date()
-
-# Get the first and last day of the previous month
-        first_day_last_month = today.replace(day=1) - relativedelta(months=1)
-        last_day_last_month = today.replace(day=1) - timedelta(days=1)
-
-# Ensure first day starts at 12:00 AM and last day ends at 11:59:59 PM
-        first_day_last_month = make_aware(datetime.combine(first_day_last_month, datetime.min.time()))
-        last_day_last_month = make_aware(datetime.combine(last_day_last_month, datetime.max.time()))
-
-# Print the results
-
-
-        delivery_notes_grouped = (
-    BestMatch.objects.filter(entry_time__date__range=[first_day_last_month, last_day_last_month],customer_ref=customerref)
-    .values("delivery_note_ref_no")  # Group by delivery note reference
-    .annotate(total_count=Count("id"))  # Count records per delivery note
-)
-        
-        total_unique_delivery_notes = delivery_notes_grouped.count()
-
-        
-
-        first_day_this_month = make_aware(datetime.combine(today.replace(day=1), datetime.min.time()))
-        last_day_this_month = make_aware(datetime.combine(today, datetime.max.time()))
-
-# Query to count records grouped by delivery_note_Ref_no for this month
-        delivery_notes_this_month = (
-    BestMatch.objects.filter(entry_time__date__range=[first_day_this_month, last_day_this_month],customer_ref=customerref)
-    .values("delivery_note_ref_no")  # Group by delivery note reference
-    .annotate(total_count=Count("id"))  # Count records per delivery note
-)
-        
-
-        first_day_this_year = make_aware(datetime.combine(today.replace(month=1, day=1), datetime.min.time()))
-        last_day_this_year = make_aware(datetime.combine(today, datetime.max.time()))
-
-        delivery_notes_this_year = (
-    BestMatch.objects.filter(entry_time__date__range=[first_day_this_year, last_day_this_year],customer_ref=customerref)
-    .values("delivery_note_ref_no")  # Group by delivery note reference
-    .annotate(total_count=Count("id"))  # Count records per delivery note
-)
-        
-        
-
-        delivery_notes_webapp = (
-    BestMatch.objects.filter(account_number='W',customer_ref=customerref)
-    .values("delivery_note_ref_no")  # Group by delivery note reference
-    .annotate(total_count=Count("id"))  # Count records per delivery note
-)
-        
-
-        delivery_notes_mobileapp = (
-    BestMatch.objects.exclude(account_number='W').filter(customer_ref=customerref)
-    .values("delivery_note_ref_no")  # Group by delivery note reference
-    .annotate(total_count=Count("id"))  # Count records per delivery note
-)
-       
-
-        building_count = (
-            AppBuilding.objects.filter(customer_ref=customerref)
-        ).count()
-
-
-        responsedata={
-            "total_delivery_notes_uploaded_last_month":total_unique_delivery_notes,
-            "total_delivery_notes_uploaded_this_month":delivery_notes_this_month.count(),
-            "total_delivery_notes_uploaded_this_year":delivery_notes_this_year.count(),
-            "total_delivery_notes_uploaded_through_web":delivery_notes_webapp.count(),
-            "total_delivery_notes_uploaded_through_mobile":delivery_notes_mobileapp.count(),
-            "building_count":building_count
-            
-        }
 
+        cache_key = f"dashboard_counts:{customerref}"
+        responsedata = cache.get(cache_key)
+        if responsedata is None:
+            responsedata = self.counts(customerref)
+            cache.set(cache_key, responsedata, getattr(settings, 'DASHBOARD_COUNTS_CACHE_TTL', 60))
         return responsedata
 # Print results
      except Exception as e :
          return {"error": str(e)}
         # return customer_ref
 
+    def counts(self, customerref):
+        """
+        Every counter in one pass over the customer's delivery-note lines.
+        Each counts distinct delivery_note_ref_no values, with lines that have
+        none counted as one more note, as grouping by the column did. Date
+        windows are half-open entry_time ranges so the index on
+        (customer_ref, entry_time) applies.
+        """
+        windows = self.windows(datetime.now().date())
+        totals = BestMatch.objects.filter(customer_ref=customerref).aggregate(**self.aggregates(windows))
+
+        responsedata = {name: totals[name] + min(totals[name + "_unreferenced"], 1) for name in windows}
+        responsedata["building_count"] = AppBuilding.objects.filter(customer_ref=customerref).count()
+        return responsedata
+
+    @staticmethod
+    def windows(today):
+        """The Q() each counter counts lines under, by response field."""
+        first_day_this_month = today.replace(day=1)
+        first_day_last_month = first_day_this_month - relativedelta(months=1)
+        first_day_this_year = today.replace(month=1, day=1)
+        tomorrow = make_aware(datetime.combine(today + timedelta(days=1), datetime.min.time()))
+
+        windows = {
+            "total_delivery_notes_uploaded_last_month": Q(
+                entry_time__gte=make_aware(datetime.combine(first_day_last_month, datetime.min.time())),
+                entry_time__lt=make_aware(datetime.combine(first_day_this_month, datetime.min.time())),
+            ),
+            "total_delivery_notes_uploaded_this_month": Q(
+                entry_time__gte=make_aware(datetime.combine(first_day_this_month, datetime.min.time())),
+                entry_time__lt=tomorrow,
+            ),
+            "total_delivery_notes_uploaded_this_year": Q(
+                entry_time__gte=make_aware(datetime.combine(first_day_this_year, datetime.min.time())),
+                entry_time__lt=tomorrow,
+            ),
+            "total_delivery_notes_uploaded_through_web": Q(account_number='W'),
+            "total_delivery_notes_uploaded_through_mobile": ~Q(account_number='W'),
+        }
+        return windows
+
+    @staticmethod
+    def aggregates(windows):
+        """A distinct note count per window, plus <name>_unreferenced: its lines with no delivery_note_ref_no."""
+        aggregates = {}
+        for name, window in windows.items():
+            aggregates[name] = Count("delivery_note_ref_no", distinct=True, filter=window)
+            aggregates[name + "_unreferenced"] = Count("id", filter=window & Q(delivery_note_ref_no__isnull=True))
+        return aggregates
+
 
 class Get_Phases_API(generics.GenericAPIView, 
                      mixins.ListModelMixin, 
@@ -1826,144 +1601,29 @@ class Get_UnitofMeasure_API(generics.GenericAPIView,
 class UpdateDeliveryNoteAPI(APIView):
 
     def post(self, request):
-        data = request.data
-        print("data",data)
-        delivery_note_ref_no = data.get("delivery_note_ref_no")
-        item_no = data.get("item_no")
-        revised_phase_id = data.get("revised_phase_id")
-        revised_product_description = data.get("revised_product_description")
-        revised_unit_of_measure = data.get("revised_unit_of_measure")
-        revised_quantity = data.get("revised_quantity")
-        revised_user_id = data.get("revised_user_id")
-        current_timestamp = now()
-
-        if not delivery_note_ref_no or not item_no:
-            return Response({"error": "delivery_note_ref_no and item_no are required"}, status=400)
+        result = bulk_edit_lines([request.data])[0]
+        status_code = result.pop("status")
+        result.pop("delivery_note_ref_no")
+        result.pop("item_no")
+        return Response(result, status=status_code)
 
-        try:
-            # Fetch existing record
-            delivery_note = BestMatch.objects.get(delivery_note_ref_no=delivery_note_ref_no, item_no=item_no)
-        except AppDeliveryNoteData.DoesNotExist:
-            return Response({"error": "Record not found"}, status=404)
-
-        # Store old values
-        old_phase_id = delivery_note.phase_id
-        old_desc = delivery_note.product_description
-        old_uom = delivery_note.unit_of_measure
-        old_qty = delivery_note.quantity
-        approved = delivery_note.approved
-        customer_ref =delivery_note.customer_ref
-        user_id=delivery_note.user_id
-        old_delivery_note_ref= delivery_note.delivery_note_ref_no
-        old_item_id = delivery_note.item_no
-        old_revised_phase_id = delivery_note.revised_phase_id
-        old_revised_product_description = delivery_note.revised_product_description
-        old_revised_unit_of_measure = delivery_note.revised_unit_of_measure
-        old_revised_quantity = delivery_note.revised_quantity
-
-        # Validate Unit_of_measure (case-insensitive check)
-        valid_units = Unit_of_Measure.objects.values_list('name', flat=True)
-        valid_units_lower = {unit.lower() for unit in valid_units}
-
-        error_code = 0  # Default to 0 (no error)
-        if revised_unit_of_measure and revised_unit_of_measure.lower() not in valid_units_lower:
-            error_code = 1  # Unit_of_measure not valid
-
-        # Validate Quantity
-        try:
-            revised_quantity = float(revised_quantity) if revised_quantity else None
-        except ValueError:
-            error_code = 2  # Invalid quantity
-
-        # Track if fields were updated test
-        updated_fields = []
-        if old_revised_phase_id:
-            if revised_phase_id and revised_phase_id != old_revised_phase_id:
-                 delivery_note.revised_phase_id = revised_phase_id
-                 updated_fields.append("revised_phase_id")
-        elif revised_phase_id and revised_phase_id != old_phase_id:
-            delivery_note.revised_phase_id = revised_phase_id
-            updated_fields.append("revised_phase_id")
-        if old_revised_product_description:
-                if revised_product_description and revised_product_description != old_revised_product_description : #check revised also
-                    delivery_note.revised_product_description = revised_product_description
-                    updated_fields.append("revised_product_description")
-        elif revised_product_description and revised_product_description != old_desc : #check revised also
-                    delivery_note.revised_product_description = revised_product_description
-                    updated_fields.append("revised_product_description")
-        if old_revised_unit_of_measure:
-            if revised_unit_of_measure and revised_unit_of_measure.lower() != (old_revised_unit_of_measure.lower() if old_revised_unit_of_measure else ""):
-                delivery_note.revised_unit_of_measure = revised_unit_of_measure
-                updated_fields.append("revised_unit_of_measure")
-        elif revised_unit_of_measure and revised_unit_of_measure.lower() != (old_uom.lower() if old_uom else ""):
-                delivery_note.revised_unit_of_measure = revised_unit_of_measure
-                updated_fields.append("revised_unit_of_measure")
-        if old_revised_quantity:
-            if revised_quantity and revised_quantity != old_revised_quantity:
-                delivery_note.revised_quantity = revised_quantity
-                updated_fields.append("revised_quantity")
-        elif revised_quantity and revised_quantity != old_qty:
-                delivery_note.revised_quantity = revised_quantity
-                updated_fields.append("revised_quantity")
-        if updated_fields:
-            delivery_note.revised_user_id = revised_user_id
-            delivery_note.revised_date = current_timestamp
-            updated_fields.append("revised_user_id")
-            updated_fields.append("revised_date")
-
-            if revised_phase_id or revised_product_description or revised_unit_of_measure or revised_quantity:
-                delivery_note.approved = True
-                updated_fields.append("approved")
-
-            delivery_note.error_code = error_code
-            updated_fields.append("error_code")
-            with transaction.atomic():
-                print("update")
-                delivery_note.save(update_fields=updated_fields)
-
-                # Insert into ProductMapping
-                if revised_product_description and revised_product_description.strip():
-                    is_duplicate = ProductMapping.objects.filter(
-                        customer_ref=customer_ref,
-                        product_description=old_desc,
-                        mapped_product_description=revised_product_description
-                    ).exists()
-                    if is_duplicate:
-                        return Response({
-                            "error": "Duplicate mapped_product_description already exists for this customer_ref and product_description"
-                        }, status=409)
-                    if not is_duplicate:
-                        ProductMapping.objects.create(
-                            customer_ref=customer_ref,
-                            product_description=old_desc,
-                            mapped_product_description=revised_product_description,
-                            user_id=revised_user_id
-                        )
-                    try:
-                        last_log = AppDeliveryNoteChangeLog.objects.latest('id')
-                        new_id = last_log.id + 1
-                    except AppDeliveryNoteChangeLog.DoesNotExist:
-                        new_id = 1 
-                # Insert into AppDeliveryNoteChangeLog
-                    AppDeliveryNoteChangeLog.objects.create(
-                        id=new_id,
-                        delivery_note_ref_no = old_delivery_note_ref,
-                        item_id = old_item_id,
-                        product_description = old_desc,
-                        unit_of_measure = old_uom,
-                        quantity = old_qty,
-                        phase_id=old_phase_id,
-                        revised_product_description=revised_product_description,
-                        revised_unit_of_measure=revised_unit_of_measure,
-                        revised_quantity = revised_quantity,
-                        revised_phase_id=revised_phase_id,
-                        revised_user_id =revised_user_id,
-                        revised_date = delivery_note.revised_date,
-                        customer_ref_no = customer_ref,
-                    )
-                    return Response({"message": "Record updated successfully", "error_code": error_code})
-                else:
-                    return Response({"message": "revised_product_description is null", "error_code": 400})
+
+class BulkUpdateDeliveryNoteAPI(APIView):
+    """
+    UpdateDeliveryNoteAPI for many lines at once: {"edits": [<the
+    single-line request body>, ...]}, applied in one transaction. Every
+    edit gets a result with the status the single-line endpoint would have
+    answered, so one bad line doesn't hold up the rest.
+    """
+
+    def post(self, request):
+        edits = request.data.get("edits") if isinstance(request.data, dict) else None
+        if not isinstance(edits, list) or not edits:
+            return Response({"error": "edits must be a non-empty list"}, status=400)
+        max_lines = getattr(settings, "DELIVERY_NOTE_BULK_EDIT_MAX_LINES", 1000)
+        if len(edits) > max_lines:
+            return Response({"error": f"At most {max_lines} edits per request"}, status=400)
+        return Response({"results": bulk_edit_lines(edits)})
 
 
 class ProductMappingListAPI(generics.ListAPIView):
@@ -1988,6 +1648,40 @@ class DeliveryNoteListByCustomerRefAPI(generics.GenericAPIView, mixins.ListModel
 
     queryset = BestMatch.objects.all().order_by('id')
 
+    @staticmethod
+    def notes(customer_ref, from_day, to_day):
+        """The customer's delivery notes entered from `from_day` to `to_day` inclusive, totalled per note."""
+        return (
+            BestMatch.objects.filter(
+                # Half-open range on the column itself, so deliverynote_counts_idx applies
+                customer_ref=customer_ref,
+                entry_time__gte=make_aware(datetime.combine(from_day, time.min)),
+                entry_time__lt=make_aware(datetime.combine(to_day + timedelta(days=1), time.min)),
+            )
+            .values(
+                'delivery_note_ref_no',
+                'supplier_name',
+                'entry_time',
+                'filename',
+                'customer_ref',
+                'user_id',
+                'building_id'
+            )
+            .annotate(
+                total_KgCO2=Sum('kgco2'),
+                error_code=Sum('error_code'),
+                site_address=Concat(
+                    F('delivery_address_line_1'), Value(', '),
+                    F('delivery_city'), Value(', '),
+                    F('delivery_post_code'), Value(', '),
+                    F('delivery_country'),
+                    output_field=TextField()
+                ),
+                earliest_id=Min('id')
+            )
+            .order_by('earliest_id')
+        )
+
     def get(self, request):
         user_email = request.GET.get('user_email')
 
@@ -2007,35 +1701,16 @@ class DeliveryNoteListByCustomerRefAPI(generics.GenericAPIView, mixins.ListModel
        
         # print(customer_ref)
 
+        try:
+            from_day = parse_date(from_date)
+            to_day = parse_date(to_date)
+        except ValueError:
+            from_day = to_day = None
+        if not (from_day and to_day):
+            return Response({"error": "from_date and to_date must be YYYY-MM-DD"}, status=400)
+
         # Fetch delivery notes with aggregation
-        delivery_notes = (
-    BestMatch.objects.filter(
-        customer_ref=customer_ref,
-        entry_time__date__range=[from_date, to_date]
-    )
-    .values(
-        'delivery_note_ref_no',
-        'supplier_name',
-        'entry_time',
-        'filename',
-        'customer_ref',
-        'user_id',
-        'building_id'
-    )
-    .annotate(
-        total_KgCO2=Sum('kgco2'),
-        error_code=Sum('error_code'),
-        site_address=Concat(
-            F('delivery_address_line_1'), Value(', '),
-            F('delivery_city'), Value(', '),
-            F('delivery_post_code'), Value(', '),
-            F('delivery_country'),
-            output_field=TextField()
-        ),
-        earliest_id=Min('id') 
-    )
-    .order_by('earliest_id')  
-)
+        delivery_notes = self.notes(customer_ref, from_day, to_day)
 
 
         
@@ -2076,10 +1751,9 @@ class DeliveryNoteListByCustomerRefAPI(generics.GenericAPIView, mixins.ListModel
 class DeliveryNoteListByDeliveryNoteRefNoAPI(generics.GenericAPIView, mixins.ListModelMixin):
     queryset = BestMatch.objects.all().order_by('id')
 
-    def get(self, request):
-        delivery_note_ref_no = request.GET.get('delivery_note_ref_no')
-        user_email = request.GET.get('user_email')
-
+    @staticmethod
+    def lines(delivery_note_ref_no, user_email):
+        """Lines in id order, narrowed to a delivery note and/or an uploader when given."""
         # Base queryset
         delivery_notes = BestMatch.objects.all().order_by('id')
 
@@ -2088,6 +1762,13 @@ class DeliveryNoteListByDeliveryNoteRefNoAPI(generics.GenericAPIView, mixins.Lis
             delivery_notes = delivery_notes.filter(delivery_note_ref_no=delivery_note_ref_no)
         if user_email:
             delivery_notes = delivery_notes.filter(user_id=user_email)
+        return delivery_notes
+
+    def get(self, request):
+        delivery_note_ref_no = request.GET.get('delivery_note_ref_no')
+        user_email = request.GET.get('user_email')
+
+        delivery_notes = self.lines(delivery_note_ref_no, user_email)
 
         # Annotate with additional fields
         delivery_notes = delivery_notes.annotate(
@@ -2115,6 +1796,20 @@ class DeliveryNoteListByDeliveryNoteRefNoAPI(generics.GenericAPIView, mixins.Lis
 
 
 class DeliveryNoteListByUserAPI(generics.GenericAPIView, mixins.ListModelMixin):
+
+    @staticmethod
+    def matches(user_email, from_date, to_date):
+        """One line per distinct entry_time the user uploaded between `from_date` and `to_date`."""
+        return BestMatch.objects.filter(
+            user_id=user_email,
+            entry_time__range=(from_date, to_date)
+        ).values(
+            'delivery_note_ref_no',
+            'supplier_name',
+            'entry_time',
+            'building_id'
+        ).order_by('entry_time').distinct('entry_time')
+
     def get(self, request):
         user_email = request.GET.get('email')
         from_date = request.GET.get('from_date')
@@ -2135,15 +1830,7 @@ class DeliveryNoteListByUserAPI(generics.GenericAPIView, mixins.ListModelMixin):
 
 
         # Step 4: Final Query
-        matches = BestMatch.objects.filter(
-            user_id=user_email,
-            entry_time__range=(from_date_obj, to_date_obj)
-        ).values(
-            'delivery_note_ref_no',
-            'supplier_name',
-            'entry_time',
-            'building_id'
-        ).order_by('entry_time').distinct('entry_time')
+        matches = self.matches(user_email, from_date_obj, to_date_obj)
 
         # Step 2: Get related buildings (in bulk to reduce DB hits)
         building_ids = [match['building_id'] for match in matches]
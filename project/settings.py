@@ -178,6 +178,75 @@ AWS_COGNITO_USER_POOL_ID = 'us-east-1_dLP0Kmi19'
 AWS_COGNITO_APP_CLIENT_ID = '3c807b97idpaqco89adod9giic'
 AWS_COGNITO_REGION = 'us-east-1'
 
+# 'local' verifies access tokens against the cached user pool JWKS, 'remote' calls Cognito get_user per request
+AWS_COGNITO_TOKEN_VERIFICATION = os.getenv('AWS_COGNITO_TOKEN_VERIFICATION', 'local')
+# Set to True to fall back to get_user when the JWKS cannot be fetched or the token's user cannot be matched
+# locally; off by default, so a failed local check never costs a Cognito call. With it on, users created before
+# cognito_sub was stored are matched this way once, and their sub is recorded.
+AWS_COGNITO_GET_USER_FALLBACK = os.getenv('AWS_COGNITO_GET_USER_FALLBACK', 'False') == 'True'
+AWS_COGNITO_JWKS_TTL = 3600  # seconds
+AWS_COGNITO_JWKS_MIN_REFRESH_INTERVAL = 60  # seconds between refetches on an unknown kid
+AWS_COGNITO_JWKS_TIMEOUT = 5
+AWS_COGNITO_JWT_LEEWAY = 0
+
+# Shared cognito-idp client (app/utils/cognito_client.py)
+AWS_COGNITO_MAX_POOL_CONNECTIONS = 20
+AWS_COGNITO_TCP_KEEPALIVE = True
+AWS_COGNITO_CONNECT_TIMEOUT = 5
+AWS_COGNITO_READ_TIMEOUT = 10
+AWS_COGNITO_MAX_ATTEMPTS = 3
+AWS_COGNITO_RETRY_MODE = 'standard'
+# Wrap the client in a botocore Stubber so nothing reaches the network (tests/local runs)
+AWS_COGNITO_CLIENT_STUB = os.getenv('AWS_COGNITO_CLIENT_STUB', 'False') == 'True'
+
+# In-process token -> CustomUser/customer_ref cache used by CognitoJWTAuthentication
+PRINCIPAL_CACHE_MAX_SIZE = 1024
+PRINCIPAL_CACHE_TTL = 300  # seconds, never longer than the token's own expiry; also how long another process's change to a user can go unseen
+
+# SyncCognitoMiddleware only calls Cognito for users not synced by sync_cognito_users within this window
+COGNITO_SYNC_MAX_AGE = 900  # seconds
+
+# GetOptionsAPI payloads are cached per (domain, region, city); Building/Region/City/Country/Phase saves clear them
+# in the saving process's cache only; other workers' copies age out within this TTL (see app/utils/options_cache.py)
+OPTIONS_CACHE_TTL = 300  # seconds
+
+# getCount dashboard counters are cached per customer_ref for this long, and nothing invalidates them,
+# so it is also how long a new upload can be missing from the counts
+DASHBOARD_COUNTS_CACHE_TTL = 60  # seconds
+
+# Unit_of_Measure names used to validate delivery-note edits are cached for this long
+UNITS_CACHE_TTL = 300  # seconds
+# Most line edits accepted by one BulkUpdateDeliveryNoteAPI request
+DELIVERY_NOTE_BULK_EDIT_MAX_LINES = 1000
+
+# Input items sent per /get_best_match/ request by app.enrichment.BestMatchEnricher
+BEST_MATCH_BATCH_SIZE = 50
+# Only rematch processed rows revised since their last enrichment (False rematches every approved row)
+BEST_MATCH_INCREMENTAL = True
+# A worker leases the rows it is matching for this long; rows of a worker that died are picked up once it lapses
+BEST_MATCH_CLAIM_TIMEOUT = 900  # seconds, longer than a chunk's BEST requests can take with retries
+# app/utils/best_match_cache.py: BEST results cached per normalised description + country
+BEST_MATCH_CACHE_TTL = 7 * 24 * 3600  # seconds
+BEST_MATCH_CACHE_VERSION = 1  # bump to discard every cached match
+BEST_MATCH_CACHE_HIT_FLUSH_INTERVAL = 60  # seconds between hit_count writes
+# Shared BEST API client (app/utils/best_client.py)
+BEST_API_MAX_IN_FLIGHT = 8  # concurrent requests and keep-alive pool size
+BEST_API_CONNECT_TIMEOUT = 5
+BEST_API_READ_TIMEOUT = 60
+BEST_API_MAX_RETRIES = 3  # on connection errors, 429 and 5xx
+BEST_API_BACKOFF_BASE = 0.5  # seconds, doubled per retry with full jitter
+BEST_API_BACKOFF_MAX = 30
+BEST_API_BREAKER_THRESHOLD = 5  # consecutive failures before the circuit opens
+BEST_API_BREAKER_RESET = 30  # seconds before a trial request is let through
+# app/utils/best_token.py: tokens are valid for a day and refreshed this long before they expire
+BEST_TOKEN_LIFETIME = 24 * 3600  # seconds
+BEST_TOKEN_REFRESH_MARGIN = 300  # seconds
+# partition_deliverynotes keeps this many future monthly partitions of app_deliverynote_data (opt-in, see app/partitions.py)
+BEST_MATCH_PARTITION_MONTHS_AHEAD = 3
+# A running EnrichmentJob not finished within this window is assumed dead and handed to another worker
+ENRICHMENT_JOB_TIMEOUT = 3600  # seconds
+ENRICHMENT_RETRY_DELAY = 60  # seconds before a job stopped by a BEST outage is retried
+
 CORS_ORIGIN_ALLOW_ALL=True
 CORS_ALLOW_HEADERS = [
     'accept',
@@ -43,6 +43,7 @@ urlpatterns = [
 
     #################################### App Delivery Note or Best Match ######################################################
     path('api/search/', InvoiceDataView.as_view()),
+    path('api/search/results/', InvoiceDataResultsView.as_view()),
 
     
     path('api/design/', DesignDataAPIView.as_view()),
@@ -50,6 +51,7 @@ urlpatterns = [
 
     path('best_match/', BestMatchAPIView.as_view(), name='best-match-list-create'),
     path('best_match/<int:pk>/', BestMatchAPIView.as_view(), name='best-match-retrieve-update-delete'),
+    path('best_match/jobs/<int:pk>/', EnrichmentJobAPIView.as_view(), name='best-match-job-detail'),
 
     ###################### Compare Carbon ###################################
     path('api/your_material/', YourMaterialAPIView.as_view()),
@@ -81,6 +83,7 @@ urlpatterns = [
     path('api/phases/', Get_Phases_API.as_view()),
     path('api/unitofmeasure/', Get_UnitofMeasure_API.as_view()),
     path('api/UpdateDeliveryNoteAPI/',UpdateDeliveryNoteAPI.as_view()),
+    path('api/BulkUpdateDeliveryNoteAPI/',BulkUpdateDeliveryNoteAPI.as_view()),
     path('api/product-mapping/', ProductMappingListAPI.as_view(), name='product-mapping-list'),
     path('api/deliverynoteref/', DeliveryNoteListByCustomerRefAPI.as_view(), name='DeliveryNoteListByCustomerRefAPI'),
     path('api/deliverynotelistBydeliverynoterefno/', DeliveryNoteListByDeliveryNoteRefNoAPI.as_view(), name='DeliveryNoteListByDeliveryNoteRefNoAPI'),